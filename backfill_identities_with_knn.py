@@ -14,6 +14,7 @@ from sklearn.metrics import precision_score
 from tqdm import tqdm
 
 import schema
+from resolved_labels import get_resolved_labelers, update_resolved_labels
 from util import get_db_session
 
 
@@ -40,16 +41,15 @@ def load_embs(fname):
     return tmp['ids'], tmp['data']
 
 
-def sample_pos_face_ids(conn, identity_id, identity_labeler_id,
-                        frame_sampler_id):
-    cur = conn.cursor()
-    sql = """
+def get_sample_pos_face_ids_sql(identity_id, identity_labeler_id,
+                                frame_sampler_id):
+    return """
         SELECT face.id FROM face_identity
         JOIN face ON face.id = face_id
         JOIN frame ON frame.id = frame_id
         JOIN video ON video.id = video_id
         WHERE (
-        	DATE_PART('year', video.time) >= {year} AND
+        	video.time >= '{year}-01-01' AND
         	frame.sampler_id = {frame_sampler} AND
         	face_identity.labeler_id = {identity_labeler} AND
         	face_identity.identity_id = {identity}
@@ -58,26 +58,35 @@ def sample_pos_face_ids(conn, identity_id, identity_labeler_id,
         year=MIN_SAMPLE_YEAR, frame_sampler=frame_sampler_id,
         identity_labeler=identity_labeler_id,
         identity=identity_id, n=N_POS_SAMPLES)
-    cur.execute(sql)
-    return set(x[0] for x in cur)
 
 
-def sample_neg_face_ids(conn, identity_id, frame_sampler_id):
+def sample_pos_face_ids(conn, identity_id, identity_labeler_id,
+                        frame_sampler_id):
     cur = conn.cursor()
-    sql = """
+    cur.execute(get_sample_pos_face_ids_sql(
+        identity_id, identity_labeler_id, frame_sampler_id))
+    return set(x[0] for x in cur)
+
+
+def get_sample_neg_face_ids_sql(identity_id, frame_sampler_id):
+    return """
         SELECT face.id FROM face
         LEFT JOIN face_identity ON face.id = face_identity.face_id
         JOIN frame ON frame.id = frame_id
         JOIN video ON video.id = video_id
         WHERE (
-        	DATE_PART('year', video.time) >= {year} AND
+        	video.time >= '{year}-01-01' AND
         	frame.sampler_id = {frame_sampler} AND
         	face_identity.identity_id != {identity}
         ) ORDER BY random() LIMIT {n}
     """.format(
         year=MIN_SAMPLE_YEAR, frame_sampler=frame_sampler_id,
         identity=identity_id, n=N_NEG_SAMPLES)
-    cur.execute(sql)
+
+
+def sample_neg_face_ids(conn, identity_id, frame_sampler_id):
+    cur = conn.cursor()
+    cur.execute(get_sample_neg_face_ids_sql(identity_id, frame_sampler_id))
     return set(x[0] for x in cur)
 
 
@@ -179,21 +188,24 @@ def main(person_name, face_emb_dir, db_name, db_user):
     global WORKER_INIT_ARGS
     WORKER_INIT_ARGS = face_emb_dir, clf
 
-    new_label_count = 0
+    new_face_ids = []
     with Pool() as p:
         for pred in tqdm(
                 p.imap_unordered(predict_for_video_wrapper, pred_videos),
                 desc='Running predictions', total=len(pred_videos)
         ):
-            new_label_count += len(pred)
             for face_id, score in pred:
+                new_face_ids.append(face_id)
                 face_ident = schema.FaceIdentity(
                     face_id=face_id, identity_id=identity_object.id,
                     labeler_id=backfill_labeler_object.id,
                     score=score)
                 session.add(face_ident)
 
-    print('Predicted {} new faces'.format(new_label_count))
+    print('Predicted {} new faces'.format(len(new_face_ids)))
+    session.flush()
+    update_resolved_labels(session, get_resolved_labelers(session),
+                           new_face_ids)
     session.commit()
     print('Done!')
 
@@ -12,14 +12,20 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('pipeline_output_dir')
     parser.add_argument('out_dir')
+    parser.add_argument('--zstd', action='store_true',
+                        help='Write .tar.zst archives instead of .tar.gz')
     return parser.parse_args()
 
 
 def compress_worker(args):
-    video, out_dir = args
-
-    tmp_file = '{}.tar.gz'.format(video)
-    cmd = ' '.join(['tar', '-czf', tmp_file, video])
+    video, out_dir, zstd = args
+
+    if zstd:
+        tmp_file = '{}.tar.zst'.format(video)
+        cmd = ' '.join(['tar', '--zstd', '-cf', tmp_file, video])
+    else:
+        tmp_file = '{}.tar.gz'.format(video)
+        cmd = ' '.join(['tar', '-czf', tmp_file, video])
     print('Run:', cmd)
     check_call(cmd, shell=True)
 
@@ -28,7 +34,7 @@ def compress_worker(args):
     shutil.move(tmp_file, out_file)
 
 
-def main(pipeline_output_dir, out_dir):
+def main(pipeline_output_dir, out_dir, zstd):
     out_dir = os.path.abspath(out_dir)
     os.makedirs(out_dir, exist_ok=True)
 
@@ -36,7 +42,7 @@ def main(pipeline_output_dir, out_dir):
     worker_args = []
     for video in os.listdir():
         if os.path.isdir(video):
-            worker_args.append((video, out_dir))
+            worker_args.append((video, out_dir, zstd))
 
     with Pool() as p:
         for _ in tqdm(
@@ -8,37 +8,159 @@ videos.json
 faces.ilist.bin
 commercials.iset.bin
 people/<each identity with substantial screen time>.ilist.bin
-face-bboxes/<each video>.json
-
-This script opens a very large number of file descriptors (40k or so), so it may require
-you to raise the system and/or per process limit. You can edit /etc/security/limits.conf
-to change the per process limit.
-
-It runs in approximately 3 hours.
+face-bboxes/<each video>.json (or a packed store, with --bbox-format packed)
+
+The people files (40k or so) are written through a pool that keeps at most
+--max-open-files of them open at once, so the default per process limit suffices.
+
+It runs in approximately 3 hours. The face_best_identity and face_resolved_gender
+tables must be populated first (see resolved_labels.py).
+
+With --incremental, the manifest written by the previous run (export-manifest.json)
+is used to find videos that were added, removed, or had faces or labels added
+since, and only those are re-queried and spliced into the existing files. If labels
+on previously exported faces changed (e.g., after a backfill), a full export is run
+instead. In-place updates to existing labels are not detected. Only an export run
+with --incremental counts the labels for this check, so the first incremental
+export after one without it is a full export. The manifest also keeps the screen
+time of each identity, which the next incremental export updates from the changed
+videos to select the identities, rather than running the selection query again.
+
+With --workers N, a full face export is split by video id range across N processes,
+each with its own connection reading from a shared snapshot.
+
+With --copy-binary, the faces are streamed with COPY (...) TO STDOUT WITH
+(FORMAT binary) and decoded into numpy columns in large chunks, rather than
+fetched through a server side cursor (see misc/bench_face_sources.py).
+
+A single process full export saves a checkpoint (export-checkpoint.json) every
+few minutes, at a video boundary, with the size of each output file at that
+point. If the export dies, --resume truncates the files to those sizes and
+queries only the faces of the videos after the last checkpointed one.
+
+With --single-pass, a full export selects the identities by the screen time of
+their exported faces as they stream by, rather than with a separate query over
+the face tables. This counts only the best identity of each face, so it can
+select slightly fewer identities than the query, which counts every label.
+It cannot be combined with --incremental, and an incremental export after a
+single pass one runs a full export.
+
+With --concurrent-stages, the host, video and commercial exports each run in a
+thread with its own connection while the faces are exported, and the identities
+are selected on another connection while the face query starts, rather than
+one after the other.
+
+With --pipelined, the face rows are fetched in one thread, turned into
+intervals and bboxes in another and written in a third (with a small pool of
+threads for the json bbox files), with bounded queues in between, so the
+database keeps streaming rows while files are written.
+
+With --coalesce, the intervals of a video with the same payload that follow
+each other (at most --coalesce-tolerance ms apart) are merged, e.g., the
+1000 ms intervals of a host on screen for minutes, which shrinks the people
+files and faces.ilist.bin. Faces on screen at the same time are not merged, so
+screen time is unchanged with a tolerance of 0.
+
+With --exclude-commercials, faces.ilist.bin and the people files are also written
+to no-commercials/ with the time in commercials cut out of their intervals, so
+that the viewer does not have to intersect them with commercials.iset.bin at
+query time.
+
+With --partition, faces.ilist.bin, commercials.iset.bin and the people files are
+also split by year, or by month for videos sampled at 1s, into
+partitions/<year or month>/, each with a manifest (partition-manifest.json) of
+its dates and video id ranges, so that the viewer can load only the partitions
+it needs. An incremental export only rewrites the partitions of the videos
+that changed, which is usually just the current month.
+
+With --since/--until (dates), --channel and/or --video-ids-file, only the
+matching videos are exported, with the filter pushed into every query, to a
+staging directory that merge_export.py merges over a full export. Pass the
+full export as --identities-from to use its selected identities, which a merge
+requires, instead of selecting them by the screen time in the filtered videos.
+
+With --metrics-file, the time of each stage, broken down into waiting on the
+database, the Python loop and writing each output, as well as the rows and
+bytes written, open files and peak memory, are appended to a file as JSON lines,
+with periodic samples during the face export (see telemetry.py).
 """
 
 import argparse
+import bisect
 import csv
+import datetime
+import functools
+import heapq
 import json
+import multiprocessing
 import os
+import queue
+import shutil
+import struct
+import tempfile
+import threading
 import time
-from collections import defaultdict
-from typing import List, Tuple
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Set, Tuple
+import numpy as np
 import psycopg2
 import tqdm
 from sqlalchemy import func
 
 import schema
+from face_bboxes import (
+    NO_IDENTITY, FaceBboxStoreWriter, FaceColumns, concat_face_bbox_stores,
+    splice_face_bbox_store)
+from interval_format import INTERVAL_SET_DTYPE, get_interval_list_dtype
+from interval_reader import IntervalFileReader
+from pg_copy import iter_copy_batches
+from telemetry import NULL_METRICS, StageMetrics, Telemetry
 from util import get_db_session
 
 
 # Adapted from https://github.com/scanner-research/rs-intervalset/blob/master/rs_intervalset/writer.py
+#
+# Each entry is packed into a single buffer with numpy rather than writing
+# every u32 separately, and the file is opened with a large write buffer, so
+# a video costs a handful of Python calls instead of one per field.
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+U32 = struct.Struct('<I')
+U32_PAIR = struct.Struct('<II')
+
+def check_intervals(intervals: np.ndarray) -> None:
+    invalid = np.nonzero(intervals['end'] <= intervals['start'])[0]
+    assert len(invalid) == 0, 'invalid interval: ({}, {})'.format(
+        intervals['start'][invalid[0]], intervals['end'][invalid[0]])
+
+
+def pack_entry(id_: int, intervals: np.ndarray) -> bytes:
+    check_intervals(intervals)
+    return U32_PAIR.pack(id_, len(intervals)) + intervals.tobytes()
+
+
+# Open a file for appending after truncating it to offset bytes (e.g., to
+# resume writing from a checkpoint)
+def open_truncated(path: str, offset: int):
+    fp = open(path, 'r+b', buffering=WRITE_BUFFER_SIZE)
+    fp.truncate(offset)
+    fp.seek(offset)
+    return fp
+
+
 class IntervalListMappingWriter(object):
 
-    def __init__(self, path: str, payload_len: int):
-        self._fp = open(path, 'wb')
+    def __init__(self, path: str, payload_len: int, resume_offset: int = None):
+        if resume_offset is None:
+            self._fp = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        else:
+            self._fp = open_truncated(path, resume_offset)
         self._path = path
         self._payload_len = payload_len
+        self._dtype = get_interval_list_dtype(payload_len)
+        self.bytes_written = resume_offset or 0
 
     def __enter__(self) -> 'IntervalListMappingWriter':
         return self
@@ -46,21 +168,21 @@ class IntervalListMappingWriter(object):
     def __exit__(self, type, value, tb) -> None:
         self.close()
 
-    def __fmt_u32(self, v: int) -> bytes:
-        return v.to_bytes(4, byteorder='little')
-
-    def __fmt_payload(self, v: int) -> bytes:
-        return v.to_bytes(self._payload_len, byteorder='little')
-
     def write(self, id_: int, intervals: List[Tuple[int, int, int]]) -> None:
+        self.write_array(id_, np.array(intervals, dtype=self._dtype))
+
+    def write_array(self, id_: int, intervals: np.ndarray) -> None:
+        """Write intervals already packed with get_interval_list_dtype()"""
         assert self._fp is not None
-        self._fp.write(self.__fmt_u32(id_))
-        self._fp.write(self.__fmt_u32(len(intervals)))
-        for a, b, c in intervals:
-            assert b > a, 'invalid interval: ({}, {})'.format(a, b)
-            self._fp.write(self.__fmt_u32(a))
-            self._fp.write(self.__fmt_u32(b))
-            self._fp.write(self.__fmt_payload(c))
+        assert intervals.dtype == self._dtype
+        data = pack_entry(id_, intervals)
+        self._fp.write(data)
+        self.bytes_written += len(data)
+
+    def checkpoint(self) -> int:
+        """Flush the file and return its size"""
+        self._fp.flush()
+        return self._fp.tell()
 
     def close(self) -> None:
         if self._fp is not None:
@@ -71,8 +193,9 @@ class IntervalListMappingWriter(object):
 class IntervalSetMappingWriter(object):
 
     def __init__(self, path: str):
-        self._fp = open(path, 'wb')
+        self._fp = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
         self._path = path
+        self.bytes_written = 0
 
     def __enter__(self) -> 'IntervalSetMappingWriter':
         return self
@@ -80,17 +203,16 @@ class IntervalSetMappingWriter(object):
     def __exit__(self, type, value, tb):
         self.close()
 
-    def __fmt_u32(self, v: int) -> bytes:
-        return v.to_bytes(4, byteorder='little')
-
     def write(self, id_: int, intervals: List[Tuple[int, int]]) -> None:
+        self.write_array(id_, np.array(intervals, dtype=INTERVAL_SET_DTYPE))
+
+    def write_array(self, id_: int, intervals: np.ndarray) -> None:
+        """Write intervals already packed with INTERVAL_SET_DTYPE"""
         assert self._fp is not None
-        self._fp.write(self.__fmt_u32(id_))
-        self._fp.write(self.__fmt_u32(len(intervals)))
-        for a, b in intervals:
-            assert b > a, 'invalid interval: ({}, {})'.format(a, b)
-            self._fp.write(self.__fmt_u32(a))
-            self._fp.write(self.__fmt_u32(b))
+        assert intervals.dtype == INTERVAL_SET_DTYPE
+        data = pack_entry(id_, intervals)
+        self._fp.write(data)
+        self.bytes_written += len(data)
 
     def close(self) -> None:
         if self._fp is not None:
@@ -98,6 +220,468 @@ class IntervalSetMappingWriter(object):
             self._fp = None
 
 
+# Most systems default to a limit of 1024 open files per process
+MAX_OPEN_FILES = 512
+
+# Buffered entries for an id are written once they reach this size
+POOL_BLOCK_SIZE = 64 * 1024
+
+# When the buffers for all ids exceed this size, the largest are written
+POOL_MAX_BUFFERED_BYTES = 256 * 1024 * 1024
+
+
+class IntervalListWriterPool(object):
+    """
+    Writes the interval lists of many ids (e.g., identities), each to its own
+    ilist file, with at most max_open_files files open at once.
+
+    Entries are buffered in memory per id and written in blocks, so rarely
+    seen ids cost few syscalls. When a file has to be opened and the pool is
+    full, the least recently used file is closed. Each file is truncated the
+    first time it is opened and appended to after that.
+    """
+
+    def __init__(self, ids, get_path, payload_len: int,
+                 max_open_files: int = MAX_OPEN_FILES,
+                 create_empty: bool = True):
+        self._ids = set(ids)
+        self._get_path = get_path
+        self._dtype = get_interval_list_dtype(payload_len)
+        self._max_open_files = max_open_files
+        # Whether to create files for ids that were never written to
+        self._create_empty = create_empty
+
+        self._buffers = defaultdict(list)
+        self._buffer_sizes = defaultdict(int)
+        self._buffered_bytes = 0
+        self._open_files = OrderedDict()
+        self._created = set()
+        # Bytes written to the file of each id
+        self._sizes = defaultdict(int)
+        # Including buffered bytes
+        self.bytes_written = 0
+
+    def __enter__(self) -> 'IntervalListWriterPool':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def __contains__(self, id_: int) -> bool:
+        return id_ in self._ids
+
+    def write(self, id_: int, video_id: int,
+              intervals: List[Tuple[int, int, int]]) -> None:
+        self.write_entry(
+            id_, pack_entry(video_id, np.array(intervals, dtype=self._dtype)))
+
+    def write_entry(self, id_: int, data: bytes) -> None:
+        """Write an already packed entry (see pack_entry)"""
+        assert id_ in self._ids, 'Unknown id: {}'.format(id_)
+        self._buffers[id_].append(data)
+        self._buffer_sizes[id_] += len(data)
+        self._buffered_bytes += len(data)
+        self.bytes_written += len(data)
+
+        if self._buffer_sizes[id_] >= POOL_BLOCK_SIZE:
+            self._flush(id_)
+        if self._buffered_bytes > POOL_MAX_BUFFERED_BYTES:
+            for largest_id in sorted(self._buffer_sizes,
+                                     key=self._buffer_sizes.get, reverse=True):
+                self._flush(largest_id)
+                if self._buffered_bytes <= POOL_MAX_BUFFERED_BYTES // 2:
+                    break
+
+    def _get_file(self, id_: int):
+        fp = self._open_files.get(id_)
+        if fp is not None:
+            self._open_files.move_to_end(id_)
+            return fp
+        if len(self._open_files) >= self._max_open_files:
+            _, lru_fp = self._open_files.popitem(last=False)
+            lru_fp.close()
+        fp = open(self._get_path(id_), 'ab' if id_ in self._created else 'wb')
+        self._created.add(id_)
+        self._open_files[id_] = fp
+        return fp
+
+    def _flush(self, id_: int) -> None:
+        buffer = self._buffers.pop(id_, None)
+        if buffer:
+            size = self._buffer_sizes.pop(id_)
+            self._buffered_bytes -= size
+            self._get_file(id_).write(b''.join(buffer))
+            self._sizes[id_] += size
+
+    def checkpoint(self) -> Dict[int, int]:
+        """Write out every buffer and return the size of each file written
+        to so far"""
+        for id_ in list(self._buffers):
+            self._flush(id_)
+        for fp in self._open_files.values():
+            fp.flush()
+        return {id_: self._sizes[id_] for id_ in self._created}
+
+    def resume(self, sizes: Dict[int, int]) -> None:
+        """Continue from a checkpoint, truncating the files to the sizes
+        that it returned. Files of other ids will be overwritten."""
+        assert not self._created, 'Resume before writing'
+        for id_, size in sizes.items():
+            assert id_ in self._ids, 'Unknown id: {}'.format(id_)
+            open_truncated(self._get_path(id_), size).close()
+            self._created.add(id_)
+            self._sizes[id_] = size
+            self.bytes_written += size
+
+    def close(self) -> None:
+        for id_ in list(self._buffers):
+            self._flush(id_)
+        for fp in self._open_files.values():
+            fp.close()
+        self._open_files = OrderedDict()
+        if self._create_empty:
+            for id_ in self._ids - self._created:
+                open(self._get_path(id_), 'wb').close()
+                self._created.add(id_)
+
+
+class IdentitySpillWriter(object):
+    """
+    Stands in for an IntervalListWriterPool when the identities to export are
+    not known yet. The interval lists of every identity are appended to a
+    single file, each entry prefixed by the identity id, and the screen time
+    of each identity is added up along the way. Use replay_identity_spill to
+    write the entries of the identities that turn out to be selected.
+    """
+
+    def __init__(self, path: str, payload_len: int,
+                 uncounted_video_ids: Set[int]):
+        self.path = path
+        self._dtype = get_interval_list_dtype(payload_len)
+        # Videos whose faces do not count towards screen time
+        self._uncounted_video_ids = uncounted_video_ids
+        # Identity id to milliseconds
+        self.screen_time = defaultdict(int)
+        self._fp = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.bytes_written = 0
+
+    def __enter__(self) -> 'IdentitySpillWriter':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def __contains__(self, id_: int) -> bool:
+        return id_ is not None
+
+    def write(self, id_: int, video_id: int,
+              intervals: List[Tuple[int, int, int]],
+              screen_time: int = None) -> None:
+        """screen_time is the milliseconds to count for the identity, if not
+        the total time of intervals (e.g., if they were coalesced)"""
+        intervals = np.array(intervals, dtype=self._dtype)
+        data = pack_entry(video_id, intervals)
+        self._fp.write(U32.pack(id_))
+        self._fp.write(data)
+        self.bytes_written += U32.size + len(data)
+        if video_id not in self._uncounted_video_ids:
+            if screen_time is None:
+                screen_time = int(
+                    (intervals['end'] - intervals['start']).sum())
+            self.screen_time[id_] += screen_time
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    # Closes the spill file after a failed export, before it is removed
+    def discard(self) -> None:
+        self.close()
+
+
+class DeferredIdentityWriter(object):
+    """
+    Stands in for an IntervalListWriterPool while the identities to export
+    are still being selected, given as a future. Until the selection is done,
+    the interval lists of every identity are spilled as by an
+    IdentitySpillWriter. Then the spilled entries of the selected identities
+    are written to the pool returned by get_pool(selected_identities), and
+    later entries go straight to it.
+    """
+
+    def __init__(self, selection, get_pool, spill_path: str, payload_len: int):
+        self._selection = selection
+        self._get_pool = get_pool
+        self._payload_len = payload_len
+        self._spill = IdentitySpillWriter(spill_path, payload_len, set())
+        self._pool = None
+        self.selected_identities = None
+        # Seconds spent waiting for the selection
+        self.wait_time = 0.
+
+    def __enter__(self) -> 'DeferredIdentityWriter':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def __contains__(self, id_: int) -> bool:
+        if self._pool is None:
+            return id_ is not None
+        return id_ in self._pool
+
+    @property
+    def bytes_written(self) -> int:
+        if self._pool is None:
+            return self._spill.bytes_written
+        return self._pool.bytes_written
+
+    def _get_selected_pool(self) -> IntervalListWriterPool:
+        if self._pool is None:
+            start_time = time.time()
+            self.selected_identities = self._selection.result()
+            self.wait_time = time.time() - start_time
+            self._pool = self._get_pool(self.selected_identities)
+            self._spill.close()
+            replay_identity_spill(self._spill.path, self._payload_len, self._pool)
+            os.remove(self._spill.path)
+        return self._pool
+
+    def write(self, id_: int, video_id: int,
+              intervals: List[Tuple[int, int, int]]) -> None:
+        if self._pool is None and not self._selection.done():
+            self._spill.write(id_, video_id, intervals)
+            return
+        pool = self._get_selected_pool()
+        # Entries of a video that was started before the selection was done
+        if id_ in pool:
+            pool.write(id_, video_id, intervals)
+
+    def checkpoint(self) -> Dict[int, int]:
+        return self._get_selected_pool().checkpoint()
+
+    def close(self) -> None:
+        self._get_selected_pool().close()
+
+    # Closes the spill and the pool after a failed export, without waiting
+    # for the selection
+    def discard(self) -> None:
+        self._spill.close()
+        if self._pool is not None:
+            self._pool.close()
+
+
+def replay_identity_spill(path: str, payload_len: int,
+                          writers: IntervalListWriterPool) -> None:
+    """Write the entries of an IdentitySpillWriter file that belong to the
+    identities in writers, in file order"""
+    entry_size = 8 + payload_len
+    with open(path, 'rb', buffering=WRITE_BUFFER_SIZE) as fp:
+        while True:
+            header = fp.read(U32.size + U32_PAIR.size)
+            if not header:
+                break
+            assert len(header) == U32.size + U32_PAIR.size, \
+                'Truncated file: {}'.format(path)
+            id_ = U32.unpack_from(header)[0]
+            n = U32_PAIR.unpack_from(header, U32.size)[1]
+            body = fp.read(n * entry_size)
+            assert len(body) == n * entry_size, 'Truncated file: {}'.format(path)
+            if id_ in writers:
+                writers.write_entry(id_, header[U32.size:] + body)
+
+
+def iter_interval_file_entries(path: str, payload_len: int):
+    """Yield (id, raw bytes) for each entry in an ilist (or iset, with a
+    payload_len of 0) file, in file order"""
+    entry_size = 8 + payload_len
+    with open(path, 'rb', buffering=WRITE_BUFFER_SIZE) as fp:
+        while True:
+            header = fp.read(U32_PAIR.size)
+            if not header:
+                break
+            assert len(header) == U32_PAIR.size, 'Truncated file: {}'.format(path)
+            id_, n = U32_PAIR.unpack(header)
+            body = fp.read(n * entry_size)
+            assert len(body) == n * entry_size, 'Truncated file: {}'.format(path)
+            yield id_, header + body
+
+
+def splice_interval_file(path: str, delta_path: str, drop_ids: Set[int],
+                         payload_len: int) -> None:
+    """Rewrite path, dropping the entries in drop_ids and merging in every
+    entry from delta_path, if it exists. Both files must be sorted by id."""
+    base_entries = []
+    if os.path.exists(path):
+        base_entries = (
+            x for x in iter_interval_file_entries(path, payload_len)
+            if x[0] not in drop_ids)
+    delta_entries = []
+    if os.path.exists(delta_path):
+        delta_entries = iter_interval_file_entries(delta_path, payload_len)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as fp:
+        for _, data in heapq.merge(base_entries, delta_entries,
+                                   key=lambda x: x[0]):
+            fp.write(data)
+    os.replace(tmp_path, path)
+
+
+class IntervalCoalescer(object):
+    """
+    Merges the intervals of a video that have the same payload and follow
+    each other, with at most tolerance ms between them, e.g., the 1000 ms
+    intervals of a host on screen for minutes. Intervals with the same start
+    and payload (e.g., two faces on screen at once) are kept apart, so that
+    the total time (screen time) does not change, unless the tolerance fills
+    in gaps or intervals overlap slightly.
+
+    The number of intervals and their total time before and after are
+    counted for each output.
+    """
+
+    def __init__(self, tolerance: int = 0):
+        self.tolerance = tolerance
+        # Output to [intervals in, intervals out, ms in, ms out]
+        self.stats = defaultdict(lambda: [0, 0, 0, 0])
+
+    def coalesce(self, intervals: np.ndarray, output: str) -> np.ndarray:
+        """Coalesce the intervals (get_interval_list_dtype) of a video"""
+        result = self._coalesce(intervals)
+        stats = self.stats[output]
+        stats[0] += len(intervals)
+        stats[1] += len(result)
+        stats[2] += int((intervals['end'] - intervals['start']).sum())
+        stats[3] += int((result['end'] - result['start']).sum())
+        return result
+
+    def _coalesce(self, intervals: np.ndarray) -> np.ndarray:
+        if len(intervals) <= 1:
+            return intervals
+        start = intervals['start'].astype(np.int64)
+        end = intervals['end'].astype(np.int64)
+        payload = intervals['payload']
+
+        # The rank of each interval among those with the same payload and
+        # start, so that the i-th of them is only merged with the i-th of the
+        # next ones
+        order = np.lexsort((start, payload))
+        index = np.arange(len(order))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = ((payload[order][1:] != payload[order][:-1])
+                     | (start[order][1:] != start[order][:-1]))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = index - np.maximum.accumulate(np.where(first, index, 0))
+
+        # Within each (payload, rank) group, sorted by start, a run continues
+        # while an interval starts at most tolerance after the end of the run.
+        # The groups are offset in time so that they never continue each other.
+        order = np.lexsort((start, rank, payload))
+        start, end, payload, rank = (
+            start[order], end[order], payload[order], rank[order])
+        group_start = np.ones(len(order), dtype=bool)
+        group_start[1:] = ((payload[1:] != payload[:-1])
+                           | (rank[1:] != rank[:-1]))
+        offset = (np.cumsum(group_start) - 1) << 33
+        run_end = np.maximum.accumulate(end + offset)
+        run_start = np.ones(len(order), dtype=bool)
+        run_start[1:] = start[1:] + offset[1:] > run_end[:-1] + self.tolerance
+        run_start_index = np.nonzero(run_start)[0]
+
+        result = np.empty(len(run_start_index), dtype=intervals.dtype)
+        result['start'] = start[run_start_index]
+        result['end'] = np.maximum.reduceat(end, run_start_index)
+        result['payload'] = payload[run_start_index]
+        return result[np.lexsort(
+            (result['end'], result['payload'], result['start']))]
+
+    def merge(self, stats: Dict[str, List[int]]) -> None:
+        for output, counts in stats.items():
+            self.stats[output] = [
+                a + b for a, b in zip(self.stats[output], counts)]
+
+    def print_stats(self) -> None:
+        for output, (n_in, n_out, ms_in, ms_out) in sorted(self.stats.items()):
+            print('Coalesced {}: {} -> {} intervals ({:.1f}%), {:.1f} -> {:.1f} '
+                  'hours'.format(output, n_in, n_out,
+                                 100 * n_out / n_in if n_in else 100,
+                                 ms_in / 3600000, ms_out / 3600000))
+
+
+def merge_overlapping(starts: np.ndarray, ends: np.ndarray):
+    """Union of sorted (by start) intervals, as disjoint (starts, ends)"""
+    if len(starts) <= 1:
+        return starts, ends
+    run_end = np.maximum.accumulate(ends)
+    run_start = np.ones(len(starts), dtype=bool)
+    run_start[1:] = starts[1:] > run_end[:-1]
+    index = np.nonzero(run_start)[0]
+    return starts[index], np.maximum.reduceat(ends, index)
+
+
+def subtract_intervals(intervals: np.ndarray, excluded_starts: np.ndarray,
+                       excluded_ends: np.ndarray) -> np.ndarray:
+    """
+    Remove the time in the disjoint, sorted excluded intervals from each
+    interval, keeping the payload. An interval that straddles an excluded
+    one is cut in two. The result is sorted by start.
+    """
+    if len(intervals) == 0 or len(excluded_starts) == 0:
+        return intervals
+    start = intervals['start'].astype(np.int64)
+    end = intervals['end'].astype(np.int64)
+    excluded_starts = excluded_starts.astype(np.int64)
+    excluded_ends = excluded_ends.astype(np.int64)
+
+    # The excluded intervals that overlap each interval are first:last
+    first = np.searchsorted(excluded_ends, start, side='right')
+    last = np.searchsorted(excluded_starts, end, side='left')
+    count = np.maximum(last - first, 0)
+
+    # An interval overlapping n excluded intervals has n + 1 candidate pieces:
+    # from its start to the first excluded start, between excluded intervals,
+    # and from the last excluded end to its end
+    owner = np.repeat(np.arange(len(intervals)), count + 1)
+    k = np.arange(len(owner)) - np.repeat(np.cumsum(count + 1) - (count + 1),
+                                          count + 1)
+    max_index = len(excluded_starts) - 1
+    piece_start = np.where(
+        k == 0, start[owner],
+        excluded_ends[np.minimum(first[owner] + k - 1, max_index)])
+    piece_end = np.where(
+        k == count[owner], end[owner],
+        excluded_starts[np.minimum(first[owner] + k, max_index)])
+    keep = piece_start < piece_end
+    owner, piece_start, piece_end = (
+        owner[keep], piece_start[keep], piece_end[keep])
+
+    order = np.argsort(piece_start, kind='stable')
+    result = np.empty(len(order), dtype=intervals.dtype)
+    result['start'] = piece_start[order]
+    result['end'] = piece_end[order]
+    result['payload'] = intervals['payload'][owner[order]]
+    return result
+
+
+def concat_files(path: str, src_paths: List[str]) -> None:
+    with open(path, 'wb') as fp:
+        for src_path in src_paths:
+            if os.path.exists(src_path):
+                with open(src_path, 'rb') as src_fp:
+                    shutil.copyfileobj(src_fp, fp, WRITE_BUFFER_SIZE)
+
+
+# Videos from 2019 on are sampled (and labeled for commercials) at 1s, and
+# older videos at 3s. Comparing video.time against a constant, rather than
+# extracting the year, lets these predicates use the index on video.time.
+SAMPLER_1S_START_TIME = '2019-01-01'
+
+# Screen time before this is not counted when selecting identities
+MIN_SELECTED_IDENTITY_TIME = '2010-01-01'
+
+
 def encode_payload(is_male, is_nonbinary, is_host, height):
     ret = 0
     if is_male:
@@ -128,22 +712,61 @@ def get_gender(session, name):
     return session.query(schema.Gender).filter_by(name=name).one()
 
 
-# Given a connection to a database, get all identity ids and names with at
-# least X minutes of screentime. Takes about 20 minutes.
-def get_selected_identities(conn, session, min_person_screen_time=30):
-    sampler_3s = get_frame_sampler(session, '3s')
-    sampler_1s = get_frame_sampler(session, '1s')
-
+# An SQL filter on the video table (joined as video), appended to a WHERE
+# clause, and the query parameters it binds
+class VideoFilter(NamedTuple):
+    sql: str
+    params: Dict[str, object]
+
+    def __bool__(self):
+        return bool(self.sql)
+
+
+NO_VIDEO_FILTER = VideoFilter('', {})
+
+
+# Returns the VideoFilter for a partial export: videos from since and before
+# until (dates), on the given channels and/or with the given ids.
+# NO_VIDEO_FILTER if there is no filter.
+def get_video_filter(since=None, until=None, channels=None, video_ids=None):
+    filters = ''
+    params = {}
+    if since is not None:
+        filters += ' AND video.time >= %(since)s'
+        params['since'] = datetime.date.fromisoformat(since).isoformat()
+    if until is not None:
+        filters += ' AND video.time < %(until)s'
+        params['until'] = datetime.date.fromisoformat(until).isoformat()
+    if channels:
+        filters += """ AND video.show_id IN (
+            SELECT show.id FROM show
+            INNER JOIN channel ON channel.id = show.channel_id
+            WHERE channel.name = ANY(%(channels)s))"""
+        params['channels'] = list(channels)
+    if video_ids is not None:
+        filters += ' AND video.id = ANY(%(video_ids)s::integer[])'
+        params['video_ids'] = [int(x) for x in sorted(video_ids)]
+    return VideoFilter(filters, params)
+
+
+# The ids of the identity labelers whose labels count towards screen time
+def get_screen_time_labeler_str(session):
     aws_identity_labeler = get_labeler(session, 'face-identity-rekognition')
     aws_prop_identity_labeler = get_labeler(
         session, 'face-identity-rekognition:augmented-l2-dist=0.7')
     aws_backfill_identity_labelers = get_backfill_labelers(session)
-    identity_str = ','.join(str(x.id) for x in [
+    return ','.join(str(x.id) for x in [
         aws_identity_labeler, aws_prop_identity_labeler,
         *(aws_backfill_identity_labelers)])
 
-    cur = conn.cursor()
-    cur.execute("""
+
+def get_selected_identities_sql(session, min_person_screen_time=30,
+                                video_filter=NO_VIDEO_FILTER):
+    sampler_3s = get_frame_sampler(session, '3s')
+    sampler_1s = get_frame_sampler(session, '1s')
+    identity_str = get_screen_time_labeler_str(session)
+
+    return """
         SELECT identity.id, identity.name
         FROM face_identity
         INNER JOIN identity ON identity.id = face_identity.identity_id
@@ -153,39 +776,150 @@ def get_selected_identities(conn, session, min_person_screen_time=30):
         WHERE NOT video.is_corrupt AND NOT video.is_duplicate AND (
             face_identity.labeler_id IN ({identities}) -- Only rekognition
         ) AND (
-        	(DATE_PART('year', video.time) >= 2019 AND frame.sampler_id = {sampler_1s}) OR
-            (DATE_PART('year', video.time) < 2019 AND frame.sampler_id = {sampler_3s})
-        ) AND DATE_PART('year', video.time) >= 2010
+            (video.time >= '{start_1s}' AND frame.sampler_id = {sampler_1s}) OR
+            (video.time < '{start_1s}' AND frame.sampler_id = {sampler_3s})
+        ) AND video.time >= '{min_time}'{video_filter}
         GROUP BY identity.id, identity.name
         HAVING SUM(CASE WHEN frame.sampler_id = {sampler_3s} THEN 3 ELSE 1 END) >= {seconds}
     """.format(
         sampler_3s=sampler_3s.id,
         sampler_1s=sampler_1s.id,
+        start_1s=SAMPLER_1S_START_TIME,
+        min_time=MIN_SELECTED_IDENTITY_TIME,
         identities=identity_str,
-        seconds=60 * min_person_screen_time
-    ))
+        seconds=60 * min_person_screen_time,
+        video_filter=video_filter.sql
+    )
+
+
+# Given a connection to a database, get all identity ids and names with at
+# least X minutes of screentime. Takes about 20 minutes. With a video_filter
+# (see get_video_filter), only the screen time in those videos counts.
+def get_selected_identities(conn, session, min_person_screen_time=30,
+                            video_filter=NO_VIDEO_FILTER):
+    cur = conn.cursor()
+    cur.execute(get_selected_identities_sql(
+        session, min_person_screen_time, video_filter), video_filter.params)
     return cur.fetchall()
 
 
+# Same screen time as get_selected_identities_sql, in seconds, of every
+# identity with labels on faces up to max_face_id (the export's watermark).
+# seconds_columns are the summed columns, with {seconds} standing in for the
+# screen time of a label, and filters restrict the labels counted.
+def get_identity_screen_time_sql(session, seconds_columns, filters):
+    sampler_3s = get_frame_sampler(session, '3s')
+    sampler_1s = get_frame_sampler(session, '1s')
+    return """
+        SELECT face_identity.identity_id, {columns}
+        FROM face_identity
+        INNER JOIN face ON face_id = face.id
+        INNER JOIN frame ON face.frame_id = frame.id
+        INNER JOIN video ON frame.video_id = video.id
+        WHERE face_identity.labeler_id IN ({identities}) AND (
+            (video.time >= '{start_1s}' AND frame.sampler_id = {sampler_1s}) OR
+            (video.time < '{start_1s}' AND frame.sampler_id = {sampler_3s})
+        ) AND video.time >= '{min_time}'
+        AND face_identity.face_id <= %(max_face_id)s{filters}
+        GROUP BY face_identity.identity_id
+    """.format(
+        columns=seconds_columns.format(seconds=(
+            'CASE WHEN frame.sampler_id = {} THEN 3 ELSE 1 END'.format(
+                sampler_3s.id))),
+        sampler_3s=sampler_3s.id,
+        sampler_1s=sampler_1s.id,
+        start_1s=SAMPLER_1S_START_TIME,
+        min_time=MIN_SELECTED_IDENTITY_TIME,
+        identities=get_screen_time_labeler_str(session),
+        filters=filters
+    )
+
+
+# The screen time in seconds of every identity in the exported videos, keyed
+# by identity id (as a string, like the manifest's JSON object keys)
+def get_identity_screen_times(conn, session, max_face_id):
+    cur = conn.cursor()
+    cur.execute(get_identity_screen_time_sql(
+        session, 'SUM({seconds})',
+        ' AND NOT video.is_corrupt AND NOT video.is_duplicate'),
+        {'max_face_id': max_face_id})
+    return {str(id): seconds for id, seconds in cur.fetchall()}
+
+
+# Update the screen times of a previous export (see get_identity_screen_times)
+# from only the videos that changed since: the screen time of their labels up
+# to the previous watermark is subtracted if they were exported then, and
+# that of their labels up to the new watermark added if they are exported
+# now. Labels on the previously exported faces are unchanged (see
+# check_incremental_export), so the other videos contribute the same.
+def update_identity_screen_times(conn, session, screen_times, max_face_id,
+                                 prev_max_face_id, video_ids, prev_video_ids):
+    cur = conn.cursor()
+    cur.execute(get_identity_screen_time_sql(
+        session,
+        """SUM(CASE WHEN frame.video_id = ANY(%(video_ids)s::integer[])
+                THEN {seconds} ELSE 0 END),
+            SUM(CASE WHEN frame.video_id = ANY(%(prev_video_ids)s::integer[])
+                AND face_identity.face_id <= %(prev_max_face_id)s
+                THEN {seconds} ELSE 0 END)""",
+        ' AND frame.video_id = ANY(%(all_video_ids)s::integer[])'), {
+            'max_face_id': max_face_id,
+            'prev_max_face_id': prev_max_face_id,
+            'video_ids': sorted(video_ids),
+            'prev_video_ids': sorted(prev_video_ids),
+            'all_video_ids': sorted(video_ids | prev_video_ids)
+        })
+    screen_times = dict(screen_times)
+    for id, added, removed in cur.fetchall():
+        seconds = screen_times.get(str(id), 0) + added - removed
+        if seconds > 0:
+            screen_times[str(id)] = seconds
+        else:
+            screen_times.pop(str(id), None)
+    return screen_times
+
+
+# The identities with at least X minutes of screen time (see
+# get_selected_identities), given the screen times
+def select_identities(conn, screen_times, min_person_screen_time=30):
+    return [(id, name) for id, name in get_all_identities(conn)
+            if screen_times.get(str(id), 0) >= 60 * min_person_screen_time]
+
+
 def get_all_identities(conn):
     cur = conn.cursor()
     cur.execute('SELECT identity.id, identity.name FROM identity')
     return cur.fetchall()
 
 
-def export_commercials(conn, session, widget_data_dir):
-    start_time = time.time()
-    commercial_interval_file = os.path.join(widget_data_dir, 'commercials.iset.bin')
-
+# Videos whose faces do not count towards the screen time of identities
+def get_uncounted_video_ids(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM video WHERE time < '{}'".format(
+        MIN_SELECTED_IDENTITY_TIME))
+    return {x[0] for x in cur.fetchall()}
+
+
+# Run fn(conn, session) on a new connection and session, e.g., in a thread
+# alongside other exports
+def run_with_new_connection(conn_args, fn):
+    conn = psycopg2.connect(**conn_args)
+    session = get_db_session(
+        conn_args['user'], conn_args['password'], conn_args['dbname'])
+    try:
+        result = fn(conn, session)
+        conn.commit()
+        return result
+    finally:
+        session.close()
+        session.get_bind().dispose()
+        conn.close()
+
+
+def get_commercials_sql(session, video_filter=NO_VIDEO_FILTER):
     comm_labeler = get_labeler(session, 'commercials')
     comm_labeler_1s = get_labeler(session, 'commercials-1s')
-
-    # By default, psychopg2 loads the entire dataset in memory. Specifying a name
-    # for the cursor makes it a server side cursor, which fetches data in chunks.
-    cur = conn.cursor(name="commercial_cursor")
-    # This query should run in about 6 seconds
-    print("Starting commercial export")
-    cur.execute("""
+    return """
         SELECT
             video_id,
             min_frame / fps * 1000 as start_ms,
@@ -193,11 +927,25 @@ def export_commercials(conn, session, widget_data_dir):
         FROM commercial
         LEFT JOIN video ON commercial.video_id = video.id
         WHERE NOT is_corrupt AND NOT is_duplicate AND (
-            (DATE_PART('year', video.time) >= 2019 AND commercial.labeler_id={comm_labeler_1s}) OR
-            (DATE_PART('year', video.time) < 2019 AND commercial.labeler_id={comm_labeler})
-        )
+            (video.time >= '{start_1s}' AND commercial.labeler_id={comm_labeler_1s}) OR
+            (video.time < '{start_1s}' AND commercial.labeler_id={comm_labeler})
+        ){video_filter}
         ORDER BY video_id, start_ms
-    """.format(comm_labeler=comm_labeler.id, comm_labeler_1s=comm_labeler_1s.id))
+    """.format(comm_labeler=comm_labeler.id, comm_labeler_1s=comm_labeler_1s.id,
+               start_1s=SAMPLER_1S_START_TIME, video_filter=video_filter.sql)
+
+
+def export_commercials(conn, session, widget_data_dir, video_filter=NO_VIDEO_FILTER):
+    start_time = time.time()
+    commercial_interval_file = os.path.join(widget_data_dir, 'commercials.iset.bin')
+
+    # By default, psychopg2 loads the entire dataset in memory. Specifying a name
+    # for the cursor makes it a server side cursor, which fetches data in chunks.
+    cur = conn.cursor(name="commercial_cursor")
+    # This query should run in about 6 seconds
+    print("Starting commercial export")
+    cur.execute(get_commercials_sql(session, video_filter),
+                video_filter.params)
 
     with IntervalSetMappingWriter(commercial_interval_file) as interval_writer:
         cur_video_id = None
@@ -215,84 +963,61 @@ def export_commercials(conn, session, widget_data_dir):
     print("Finished commercial export in {:.3f} seconds".format(time.time() - start_time))
 
 
-# Join faces against just about every other table, and return a cursor for the
-# results. It takes about 90 minutes total.
-def get_faces_and_identities_from_db(conn, session):
-    aws_identity_labeler = get_labeler(session, 'face-identity-rekognition')
-    aws_prop_identity_labeler = get_labeler(
-        session, 'face-identity-rekognition:augmented-l2-dist=0.7')
-    aws_backfill_identity_labelers = get_backfill_labelers(session)
-    manual_gender_labeler = get_labeler(session, 'handlabeled-gender')
-    knn_gender_labeler = get_labeler(session, 'knn-gender')
-
+# Returns an SQL filter restricting the face query to a set of videos, a
+# range of video ids, the videos after a video id and/or a set of identities.
+def get_face_filters(video_ids, identity_ids, video_id_range, after_video_id=None):
+    filters = ''
+    if video_ids is not None:
+        filters += ' AND frame.video_id IN ({})'.format(
+            ','.join(str(int(x)) for x in sorted(video_ids)) or 'NULL')
+    if video_id_range is not None:
+        min_video_id, max_video_id = video_id_range
+        filters += ' AND frame.video_id BETWEEN {} AND {}'.format(
+            int(min_video_id), int(max_video_id))
+    if after_video_id is not None:
+        filters += ' AND frame.video_id > {}'.format(int(after_video_id))
+    if identity_ids is not None:
+        filters += ' AND identities.identity_id IN ({})'.format(
+            ','.join(str(int(x)) for x in sorted(identity_ids)) or 'NULL')
+    return filters
+
+
+# The identity and gender of each face come from the face_best_identity and
+# face_resolved_gender tables, which are maintained by resolved_labels.py. The
+# results can be restricted to a subset or range of videos and/or identities
+# (used by the incremental and parallel exports).
+def get_faces_and_identities_sql(session, video_ids=None, identity_ids=None,
+                                 video_id_range=None, after_video_id=None,
+                                 null_sentinels=False, video_filter=NO_VIDEO_FILTER):
     sampler_3s = get_frame_sampler(session, '3s')
     sampler_1s = get_frame_sampler(session, '1s')
 
-    identity_str = ','.join(str(x.id) for x in [
-        aws_identity_labeler, aws_prop_identity_labeler,
-        *(aws_backfill_identity_labelers)])
-
-    sql = """
-    WITH identities AS (
-        -- Get the most confident identity for each face (10 minutes)
-        SELECT DISTINCT ON (face_identity.face_id) face_identity.identity_id, face_identity.score, face_identity.face_id
-        FROM face_identity
-        INNER JOIN (
-            SELECT face_id, MAX(score) AS max_score
-            FROM face_identity
-            WHERE labeler_id IN ({identities}) -- Only rekognition
-            GROUP BY face_id
-        ) AS t
-        ON face_identity.face_id = t.face_id AND face_identity.score = t.max_score
-        WHERE face_identity.labeler_id IN ({identities}) -- Only rekognition
-        ),
-
-    -- Get the gender for each face, with manual relabeling taking precedence (5 minutes)
-        genders AS (
-        SELECT
-            CASE WHEN manual_gender.face_id IS NULL
-                THEN knn_gender.face_id
-                ELSE manual_gender.face_id
-            END AS face_id,
-            CASE WHEN manual_gender.face_id IS NULL
-                THEN knn_gender.gender_id
-                ELSE manual_gender.gender_id
-            END AS gender_id,
-            CASE WHEN manual_gender.face_id IS NULL
-                THEN knn_gender.score
-                ELSE manual_gender.score
-            END AS score
-        FROM (
-            SELECT face_id, gender_id, score
-            FROM face_gender
-            WHERE labeler_id = {manual_gender} -- manual assignment (nonbinary override)
-        ) manual_gender
-        FULL OUTER JOIN (
-            SELECT face_id, gender_id, score
-            FROM face_gender
-            WHERE labeler_id = {knn_gender} -- KNN-gender
-        ) AS knn_gender
-        ON manual_gender.face_id = knn_gender.face_id
-        )
+    # Binary COPY output is decoded as fixed width rows, so the nullable
+    # columns are replaced by sentinels
+    def nullable(column, sentinel):
+        if null_sentinels:
+            return 'COALESCE({}, {})'.format(column, sentinel)
+        return column
 
+    return """
     -- Join face with gender, identity, hosts, and frames (45 minutes)
     SELECT
         face.id as face_id,
         frame.video_id,
         frame.sampler_id,
         CAST(frame.number * (1000.0 / video.fps) AS INTEGER) AS start_ms,
-        genders.gender_id,
-        genders.score AS gender_score,
-        identities.identity_id,
-        identities.score as identity_score,
+        {gender_id} AS gender_id,
+        {gender_score} AS gender_score,
+        {identity_id} AS identity_id,
+        {identity_score} as identity_score,
         (channel_host.identity_id IS NOT NULL or canonical_show_host.identity_id IS NOT NULL) AS is_host,
         face.bbox_x1,
         face.bbox_x2,
         face.bbox_y1,
         face.bbox_y2
     FROM face
-    LEFT JOIN identities ON identities.face_id = face.id
-    LEFT JOIN genders ON genders.face_id = face.id
+    LEFT JOIN face_best_identity AS identities ON identities.face_id = face.id
+    LEFT JOIN face_resolved_gender AS genders ON genders.face_id = face.id
     LEFT JOIN frame ON face.frame_id = frame.id
     LEFT JOIN video ON frame.video_id = video.id
     LEFT JOIN show ON video.show_id = show.id
@@ -303,9 +1028,9 @@ def get_faces_and_identities_from_db(conn, session):
         show.canonical_show_id = canonical_show_host.canonical_show_id AND identities.identity_id = canonical_show_host.identity_id
     )
     WHERE NOT video.is_corrupt AND NOT video.is_duplicate AND (
-        (DATE_PART('year', video.time) >= 2019 AND frame.sampler_id = {sampler_1s}) OR
-        (DATE_PART('year', video.time) < 2019 AND frame.sampler_id = {sampler_3s})
-    )
+        (video.time >= '{start_1s}' AND frame.sampler_id = {sampler_1s}) OR
+        (video.time < '{start_1s}' AND frame.sampler_id = {sampler_3s})
+    ){extra_filters}
     ORDER BY
         frame.video_id,
         frame.number,
@@ -313,17 +1038,112 @@ def get_faces_and_identities_from_db(conn, session):
         identities.identity_id
     """.format(sampler_1s=sampler_1s.id,
                sampler_3s=sampler_3s.id,
-               knn_gender=knn_gender_labeler.id,
-               manual_gender=manual_gender_labeler.id,
-               identities=identity_str)
+               start_1s=SAMPLER_1S_START_TIME,
+               gender_id=nullable('genders.gender_id', NULL_ID),
+               gender_score=nullable('genders.score', "'NaN'"),
+               identity_id=nullable('identities.identity_id', NULL_ID),
+               identity_score=nullable('identities.score', "'NaN'"),
+               extra_filters=get_face_filters(
+                   video_ids, identity_ids, video_id_range, after_video_id)
+               + video_filter.sql)
+
+
+# Join faces against just about every other table, and return the results as
+# batches of numpy columns (see FACE_COPY_COLUMNS). It takes about 45 minutes
+# total. The rows are fetched with a server side cursor and turned into
+# columns, or with copy_binary, streamed with COPY as columns (see
+# get_face_batches_from_db).
+def get_faces_and_identities_from_db(conn, session, video_ids=None,
+                                     identity_ids=None, video_id_range=None,
+                                     after_video_id=None, copy_binary=False,
+                                     video_filter=NO_VIDEO_FILTER):
+    if copy_binary:
+        return get_face_batches_from_db(
+            conn, session, video_ids=video_ids, identity_ids=identity_ids,
+            video_id_range=video_id_range, after_video_id=after_video_id,
+            video_filter=video_filter)
+
+    sql = get_faces_and_identities_sql(
+        session, video_ids=video_ids, identity_ids=identity_ids,
+        video_id_range=video_id_range, after_video_id=after_video_id,
+        video_filter=video_filter)
     print(sql)
 
     print("Starting the big query")
     # By default, psychopg2 loads the entire dataset in memory. Specifying a name
     # for the cursor makes it a server side cursor, which fetches data in chunks.
     cur = conn.cursor(name="face_cursor")
-    cur.execute(sql)
-    return cur
+    cur.execute(sql, video_filter.params)
+    return iter_face_batches(cur)
+
+
+# Columns of get_faces_and_identities_sql and their types in binary COPY output
+FACE_COPY_COLUMNS = [
+    ('face_id', '>i4'),
+    ('video_id', '>i4'),
+    ('sampler_id', '>i4'),
+    ('start_ms', '>i4'),
+    ('gender_id', '>i4'),
+    ('gender_score', '>f8'),
+    ('identity_id', '>i4'),
+    ('identity_score', '>f8'),
+    ('is_host', '?'),
+    ('bbox_x1', '>f8'),
+    ('bbox_x2', '>f8'),
+    ('bbox_y1', '>f8'),
+    ('bbox_y2', '>f8'),
+]
+
+# Stands in for a NULL gender or identity id in the binary COPY output
+NULL_ID = -1
+
+
+# Same rows as get_faces_and_identities_from_db, streamed with
+# COPY (...) TO STDOUT WITH (FORMAT binary) and yielded as batches of numpy
+# columns (see FACE_COPY_COLUMNS). This avoids the fetch round trips of the
+# named cursor and building a Python tuple for every row. A NULL gender_id or
+# identity_id is NULL_ID and a NULL score is NaN.
+def get_face_batches_from_db(conn, session, video_ids=None, identity_ids=None,
+                             video_id_range=None, after_video_id=None,
+                             video_filter=NO_VIDEO_FILTER):
+    sql = get_faces_and_identities_sql(
+        session, video_ids=video_ids, identity_ids=identity_ids,
+        video_id_range=video_id_range, after_video_id=after_video_id,
+        null_sentinels=True, video_filter=video_filter)
+    print(sql)
+
+    print("Starting the big query (binary COPY)")
+    return iter_copy_batches(
+        conn, sql, FACE_COPY_COLUMNS, params=video_filter.params)
+
+
+# Rows per batch when the rows of the cursor are turned into columns
+FACE_BATCH_SIZE = 10000
+
+
+# Turn the rows of a cursor into batches of numpy columns, like those of
+# get_face_batches_from_db. The cursor is closed when the batches are.
+def iter_face_batches(cur, batch_size=FACE_BATCH_SIZE):
+    try:
+        while True:
+            batch_rows = cur.fetchmany(batch_size)
+            if not batch_rows:
+                return
+            batch = {}
+            for (name, dtype), values in zip(FACE_COPY_COLUMNS,
+                                             zip(*batch_rows)):
+                if name in ('gender_id', 'identity_id'):
+                    # None becomes NaN, then NULL_ID
+                    ids = np.array(values, dtype=np.float64)
+                    batch[name] = np.where(
+                        np.isnan(ids), NULL_ID, ids).astype(np.int32)
+                else:
+                    # A None score becomes NaN
+                    batch[name] = np.array(
+                        values, dtype=np.dtype(dtype).newbyteorder('='))
+            yield batch
+    finally:
+        cur.close()
 
 
 # If the query in get_faces_and_identities_from_db has already been run, exporting to a
@@ -357,126 +1177,793 @@ def get_identities_from_file(path):
             )
 
 
-def export_faces_and_identities(conn, session, widget_data_dir):
-    identity_interval_dir = os.path.join(widget_data_dir, 'people')
-    os.makedirs(identity_interval_dir, exist_ok=True)
+def get_identity_ilist_path(identity_interval_dir, name):
+    return os.path.join(identity_interval_dir, '{}.ilist.bin'.format(name.lower()))
 
-    face_bbox_dir = os.path.join(widget_data_dir, 'face-bboxes')
-    os.makedirs(face_bbox_dir, exist_ok=True)
 
-    start_time = time.time()
-    selected_identities = get_selected_identities(conn, session)
-    print("Fetched {} selected identities in {:.3f} seconds".format(
-        len(selected_identities), time.time() - start_time))
-
-    identity_ilist_writers = {
-        id : IntervalListMappingWriter(
-            os.path.join(identity_interval_dir, '{}.ilist.bin'.format(name.lower())), 1
-        ) for id, name in selected_identities
-    }
+# Returns the size of the file. faces is a FaceColumns.
+def save_bboxes_for_video(face_bbox_dir, identity_id_to_name, video_id, faces):
+    face_bbox_file = os.path.join(face_bbox_dir, '{}.json'.format(video_id))
+    # The output is ascii, so the length is the size in bytes
+    data = faces.to_json(identity_id_to_name)
+    with open(face_bbox_file, 'w') as fp:
+        fp.write(data)
+    return len(data)
 
-    # Get just the ids and turn it into a set for faster search
-    selected_identities = {id for id, name in selected_identities}
 
-    def flush_identity_accumulators(video_id, ilist_accumulators):
-        for identity_id, face_ilist in ilist_accumulators.items():
-            identity_ilist_writers[identity_id].write(video_id, face_ilist)
+# Videos whose bbox files can be waiting to be written by the threads of a
+# FaceBboxJsonWriter
+MAX_PENDING_BBOX_FILES = 64
 
-    # Lookup identity id to name
-    identity_id_to_name = dict(get_all_identities(conn))
 
-    def save_bboxes_for_video(video_id, faces):
-        identity_ids = {f['i'] for f in faces if 'i' in f}
-        identities = [(identity_id_to_name.get(i, ''), i) for i in sorted(identity_ids)]
-        face_bbox_file = os.path.join(face_bbox_dir, '{}.json'.format(video_id))
-        with open(face_bbox_file, 'w') as fp:
-            json.dump({
-                'faces': faces,
-                'ids': identities
-            }, fp)
+# Writes face-bboxes/<video_id>.json files, with the same interface as
+# face_bboxes.FaceBboxStoreWriter. With threads, the files are written by a
+# thread pool; checkpoint and close wait for all of them.
+class FaceBboxJsonWriter(object):
 
-    male_gender_id = get_gender(session, 'M').id
-    non_binary_gender_id = get_gender(session, 'U').id
+    def __init__(self, face_bbox_dir, identity_id_to_name, threads=0):
+        os.makedirs(face_bbox_dir, exist_ok=True)
+        self._face_bbox_dir = face_bbox_dir
+        self._identity_id_to_name = identity_id_to_name
+        self._executor = ThreadPoolExecutor(threads) if threads > 0 else None
+        self._pending = deque()
+        self.bytes_written = 0
+
+    def __enter__(self):
+        return self
 
-    sampler_1s_id = get_frame_sampler(session, '1s').id
-    sampler_3s_id = get_frame_sampler(session, '3s').id
+    def __exit__(self, type, value, tb):
+        self.close()
 
-    curr_video_id = None
+    def write(self, video_id, faces):
+        if self._executor is None:
+            self.bytes_written += save_bboxes_for_video(
+                self._face_bbox_dir, self._identity_id_to_name, video_id, faces)
+            return
+        self._pending.append(self._executor.submit(
+            save_bboxes_for_video, self._face_bbox_dir,
+            self._identity_id_to_name, video_id, faces))
+        while self._pending and (
+            self._pending[0].done()
+            or len(self._pending) > MAX_PENDING_BBOX_FILES
+        ):
+            self.bytes_written += self._pending.popleft().result()
+
+    def _wait(self):
+        while self._pending:
+            self.bytes_written += self._pending.popleft().result()
+
+    def checkpoint(self):
+        # Every file is complete once written
+        self._wait()
+        return None
+
+    def close(self):
+        self._wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+BBOX_FORMATS = ['json', 'packed']
+
+# Name of the face-bboxes directory (json) or of the packed store (see
+# face_bboxes.py)
+FACE_BBOX_NAME = 'face-bboxes'
+
+
+# threads only applies to the json format
+def get_face_bbox_writer(path, bbox_format, identity_id_to_name,
+                         resume_state=None, threads=0):
+    if bbox_format == 'json':
+        return FaceBboxJsonWriter(path, identity_id_to_name, threads=threads)
+    elif bbox_format == 'packed':
+        return FaceBboxStoreWriter(path, identity_id_to_name,
+                                   resume_state=resume_state)
+    raise Exception('Unknown bbox format: {}'.format(bbox_format))
+
+
+# Pipelined face export (see write_faces_and_identities):
+# Batches (and videos) buffered between the threads
+PIPELINE_QUEUE_SIZE = 8
+
+# Threads writing json face bbox files
+PIPELINE_BBOX_THREADS = 4
+
+
+# Yield the items of iterator, which is consumed in a thread, at most
+# queue_size items ahead
+def iter_in_thread(iterator, queue_size=PIPELINE_QUEUE_SIZE):
+    item_queue = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    return
+                item_queue.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            item_queue.put(None)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    done = False
+    try:
+        while True:
+            item = item_queue.get()
+            if item is None:
+                break
+            yield item
+        done = True
+    finally:
+        if not done:
+            # The consumer stopped early
+            stop.set()
+            while item_queue.get() is not None:
+                pass
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class BackgroundWorker(object):
+    """
+    Calls fn on each item that is put, in order, in a thread. At most
+    queue_size items wait, so put blocks while fn is behind. An exception in
+    fn is raised by the next put or by close.
+    """
+
+    def __init__(self, fn, queue_size=PIPELINE_QUEUE_SIZE):
+        self._fn = fn
+        self._queue = queue.Queue(queue_size)
+        self._errors = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # After an error, keep taking items so that put does not block
+            if not self._errors:
+                try:
+                    self._fn(item)
+                except Exception as e:
+                    self._errors.append(e)
+
+    def put(self, item):
+        if self._errors:
+            raise self._errors[0]
+        self._queue.put(item)
+
+    def close(self, raise_errors=True):
+        self._queue.put(None)
+        self._thread.join()
+        if raise_errors and self._errors:
+            raise self._errors[0]
+
+
+# Consume the face batches from get_faces_and_identities_from_db, writing the
+# intervals of each video to all_faces_writer and to the writer of each
+# identity in identity_ilist_writers (an IntervalListWriterPool), and the bboxes
+# to face_bbox_writer (see get_face_bbox_writer). all_faces_writer and
+# face_bbox_writer may be None to skip those outputs. on_video_done is called
+# with the id of each video once all of its outputs have been written. The
+# time blocked on face_batches and spent on each output, and the rows and
+# bytes written, are added to metrics (see telemetry.py).
+#
+# With pipelined, the batches are fetched by a thread (see iter_in_thread) and
+# the outputs of each video are written by another (a BackgroundWorker), while
+# the calling thread turns the columns into intervals and bboxes, so the
+# database is not kept waiting while files are written. The outputs (and
+# on_video_done) are still written in video order, by one thread.
+def write_faces_and_identities(
+    conn, session, face_batches, face_count, all_faces_writer,
+    identity_ilist_writers, face_bbox_writer, show_progress=True,
+    on_video_done=None, metrics=NULL_METRICS, pipelined=False, coalescer=None
+):
+    # Bytes of previous calls with the same metrics (e.g., in an incremental
+    # export)
+    base_bytes = dict(metrics.bytes)
+
+    def update_bytes():
+        for output, writer in [('faces', all_faces_writer),
+                               ('people', identity_ilist_writers),
+                               ('face_bboxes', face_bbox_writer)]:
+            if writer is not None:
+                metrics.set_bytes(
+                    output, base_bytes.get(output, 0) + writer.bytes_written)
+
+    def flush_identity_accumulators(video_id, ilist_accumulators,
+                                    screen_times=None):
+        for identity_id, face_ilist in ilist_accumulators.items():
+            if screen_times is None:
+                identity_ilist_writers.write(identity_id, video_id, face_ilist)
+            else:
+                identity_ilist_writers.write(
+                    identity_id, video_id, face_ilist,
+                    screen_time=screen_times[identity_id])
+
+    def flush_video(video_id, ilist_accumulators, video_intervals, video_faces):
+        screen_times = None
+        if coalescer is not None:
+            if isinstance(identity_ilist_writers, IdentitySpillWriter):
+                # The identities are selected by the time of their faces,
+                # like get_selected_identities, without the gaps that the
+                # coalescing fills in
+                screen_times = {
+                    i: int((x['end'] - x['start']).sum())
+                    for i, x in ilist_accumulators.items()}
+            with metrics.timer('coalesce'):
+                video_intervals = coalescer.coalesce(video_intervals, 'faces')
+                ilist_accumulators = {
+                    i: coalescer.coalesce(x, 'people')
+                    for i, x in ilist_accumulators.items()}
+        with metrics.timer('write:people'):
+            flush_identity_accumulators(
+                video_id, ilist_accumulators, screen_times)
+        if all_faces_writer is not None and len(video_intervals) > 0:
+            with metrics.timer('write:faces'):
+                all_faces_writer.write_array(video_id, video_intervals)
+        if face_bbox_writer is not None and len(video_faces) > 0:
+            with metrics.timer('write:face_bboxes'):
+                face_bbox_writer.write(video_id, video_faces)
+        metrics.add_rows(len(video_faces))
+        if on_video_done is not None:
+            with metrics.timer('checkpoint'):
+                on_video_done(video_id)
+        if metrics.sample_due():
+            update_bytes()
+            metrics.sample()
+
+    face_batches = metrics.timed_iter(face_batches)
+    if pipelined:
+        metrics.set_overlapping()
+        fetched_batches = iter_in_thread(face_batches)
+        face_batches = metrics.timed_iter(fetched_batches, 'wait:fetch')
+        video_writer = BackgroundWorker(lambda args: flush_video(*args))
+
+        def emit_video(*args):
+            with metrics.timer('wait:write'):
+                video_writer.put(args)
+    else:
+        emit_video = flush_video
+
+    try:
+        encode_faces(session, face_batches, face_count, identity_ilist_writers,
+                     emit_video, show_progress)
+    except BaseException:
+        if pipelined:
+            fetched_batches.close()
+            video_writer.close(raise_errors=False)
+        raise
+    if pipelined:
+        video_writer.close()
+    update_bytes()
+
+
+# Split batches of face columns, sorted by video, at the video boundaries, and
+# yield the id and the columns of each video
+def iter_video_columns(face_batches):
+    # Pieces of batches with the faces of the current video
+    pending = []
+    for batch in face_batches:
+        video_id = batch['video_id']
+        bounds = (np.flatnonzero(video_id[1:] != video_id[:-1]) + 1).tolist()
+        for start, end in zip([0] + bounds, bounds + [len(video_id)]):
+            if start == end:
+                continue
+            if pending and pending[0]['video_id'][0] != video_id[start]:
+                yield int(pending[0]['video_id'][0]), concat_columns(pending)
+                pending = []
+            pending.append({name: x[start:end] for name, x in batch.items()})
+    if pending:
+        yield int(pending[0]['video_id'][0]), concat_columns(pending)
+
+
+def concat_columns(batches):
+    if len(batches) == 1:
+        return batches[0]
+    return {name: np.concatenate([x[name] for x in batches])
+            for name in batches[0]}
+
+
+# Turn batches of face columns into the intervals and bboxes of each video, and
+# pass them to emit_video(video_id, ilist_accumulators, video_intervals,
+# video_faces). The faces are encoded with numpy a video at a time.
+def encode_faces(session, face_batches, face_count, identity_ilist_writers,
+                 emit_video, show_progress=True):
+    gender_ids = {
+        'male': get_gender(session, 'M').id,
+        'non_binary': get_gender(session, 'U').id,
+    }
+    sampler_ids = {
+        'sampler_1s': get_frame_sampler(session, '1s').id,
+        'sampler_3s': get_frame_sampler(session, '3s').id,
+    }
 
-    # Count the number of faces for a progress bar estimate
-    face_count = session.query(func.count(schema.Face.id)).scalar()
+    prev_face_id = None
+    with tqdm.tqdm(total=face_count, disable=not show_progress) as pbar:
+        for video_id, columns in iter_video_columns(face_batches):
+            face_id = columns['face_id']
+            assert face_id[0] != prev_face_id, \
+                'Duplicate face id! {}'.format(prev_face_id)
+            prev_face_id = int(face_id[-1])
+            emit_video(video_id, *encode_video_faces(
+                columns, identity_ilist_writers, gender_ids, sampler_ids))
+            pbar.update(len(face_id))
+
+
+# Returns the ilist accumulators (identity id to intervals, for the identities
+# in identity_ilist_writers), intervals and FaceColumns of the face columns of
+# a video
+def encode_video_faces(columns, identity_ilist_writers, gender_ids,
+                       sampler_ids):
+    face_id = columns['face_id']
+    duplicate = np.nonzero(face_id[1:] == face_id[:-1])[0]
+    assert len(duplicate) == 0, 'Duplicate face id! {}'.format(
+        face_id[duplicate[0]])
+
+    frame_sampler_id = columns['sampler_id']
+    start_ms = columns['start_ms'].astype(np.int64)
+    is_1s = frame_sampler_id == sampler_ids['sampler_1s']
+    is_3s = frame_sampler_id == sampler_ids['sampler_3s']
+    unknown = np.nonzero(~(is_1s | is_3s))[0]
+    if len(unknown) > 0:
+        raise Exception('Unknown frame sampler: {}'.format(
+            frame_sampler_id[unknown[0]]))
+    end_ms = start_ms + np.where(is_1s, 1000, 3000)
+
+    is_male = columns['gender_id'] == gender_ids['male']
+    is_non_binary = columns['gender_id'] == gender_ids['non_binary']
+    has_identity = columns['identity_id'] != NULL_ID
+    identity_id = np.where(
+        has_identity, columns['identity_id'], NO_IDENTITY).astype(np.int64)
+
+    bbox = np.stack([columns['bbox_x1'], columns['bbox_y1'],
+                     columns['bbox_x2'], columns['bbox_y2']],
+                    axis=1).astype(np.float64)
+    height = bbox[:, 3] - bbox[:, 1]
+    assert np.all(height > 0)
+
+    # Same bits as encode_payload
+    payload = (
+        is_male.astype(np.uint8)
+        | (is_non_binary.astype(np.uint8) << 1)
+        | (columns['is_host'].astype(np.uint8) << 2)
+        | (np.minimum(np.rint(height * 31), 31).astype(np.uint8) << 3))
+
+    video_intervals = np.empty(len(face_id), dtype=get_interval_list_dtype(1))
+    video_intervals['start'] = start_ms
+    video_intervals['end'] = end_ms
+    video_intervals['payload'] = payload
+
+    # In the order in which the identities first appear
+    ilist_accumulators = {}
+    identity_ids, first_index = np.unique(
+        identity_id[has_identity], return_index=True)
+    for i in identity_ids[np.argsort(first_index)].tolist():
+        if i in identity_ilist_writers:
+            ilist_accumulators[i] = video_intervals[identity_id == i]
+
+    gender = np.where(is_non_binary, 'u', np.where(is_male, 'm', 'f'))
+    video_faces = FaceColumns(start_ms, end_ms, bbox, gender, identity_id)
+    return ilist_accumulators, video_intervals, video_faces
+
+
+# Select the identities by the screen time added up by IdentitySpillWriters,
+# and write the people files of the selected identities from the spills. spills
+# is a list of (path, screen_time) in video order.
+def write_spilled_identities(conn, identity_interval_dir, spills,
+                             max_open_files=MAX_OPEN_FILES,
+                             min_person_screen_time=30):
+    start_time = time.time()
+    screen_time = defaultdict(int)
+    for _, spill_screen_time in spills:
+        for identity_id, ms in spill_screen_time.items():
+            screen_time[identity_id] += ms
+    selected_identities = [
+        (id, name) for id, name in sorted(get_all_identities(conn))
+        if screen_time[id] >= min_person_screen_time * 60 * 1000
+    ]
+
+    identity_id_to_name = dict(selected_identities)
+    with IntervalListWriterPool(
+        identity_id_to_name,
+        lambda i: get_identity_ilist_path(
+            identity_interval_dir, identity_id_to_name[i]),
+        1, max_open_files=max_open_files
+    ) as identity_ilist_writers:
+        for path, _ in spills:
+            replay_identity_spill(path, 1, identity_ilist_writers)
+    print("Wrote {} selected identities (of {} seen) in {:.3f} seconds".format(
+        len(selected_identities), len(screen_time), time.time() - start_time))
+    return selected_identities
+
+
+# With single_pass, the identities are selected by the screen time of the
+# exported faces (i.e., the faces where the identity is the best identity)
+# while they are streamed, instead of by get_selected_identities, which
+# counts every rekognition label in a separate scan of the face tables.
+#
+# Unless single_pass is set, a checkpoint (see save_checkpoint) holding
+# checkpoint_state and the progress of the export is saved every
+# CHECKPOINT_INTERVAL seconds, if checkpoint_state is given. Passing such a
+# checkpoint as resume_checkpoint picks the export up from there.
+#
+# With conn_args, the identities are selected on another connection while the
+# faces are exported (see DeferredIdentityWriter).
+def export_faces_and_identities(conn, session, widget_data_dir,
+                                max_open_files=MAX_OPEN_FILES, copy_binary=False,
+                                bbox_format='json', single_pass=False,
+                                checkpoint_state=None, resume_checkpoint=None,
+                                metrics=NULL_METRICS, conn_args=None,
+                                pipelined=False, coalesce_tolerance=None,
+                                video_filter=NO_VIDEO_FILTER, selected_identities=None):
+    identity_interval_dir = os.path.join(widget_data_dir, 'people')
+    os.makedirs(identity_interval_dir, exist_ok=True)
 
+    def get_identity_ilist_writers(selected_identities):
+        identity_id_to_name = dict(selected_identities)
+        return IntervalListWriterPool(
+            identity_id_to_name,
+            lambda i: get_identity_ilist_path(
+                identity_interval_dir, identity_id_to_name[i]),
+            1, max_open_files=max_open_files)
+
+    if resume_checkpoint is not None:
+        assert not single_pass, 'Cannot resume a single pass export'
+        assert resume_checkpoint['bbox_format'] == bbox_format, \
+            'The checkpoint has {} face bboxes'.format(
+                resume_checkpoint['bbox_format'])
+        assert resume_checkpoint.get('coalesce_tolerance') == coalesce_tolerance, \
+            'The checkpoint has a coalesce tolerance of {}'.format(
+                resume_checkpoint.get('coalesce_tolerance'))
+        assert (resume_checkpoint.get('video_filter')
+                or NO_VIDEO_FILTER._asdict()) == video_filter._asdict(), \
+            'The checkpoint has a different video filter'
+        after_video_id = resume_checkpoint['last_video_id']
+        print('Resuming the face export after video {}'.format(after_video_id))
+    else:
+        after_video_id = None
+
+    selection = None
+    spill_path = None
+    identity_ilist_writers = None
+    # The spill file is removed even if the export fails
+    try:
+        if single_pass:
+            spill_fd, spill_path = tempfile.mkstemp(
+                prefix='.identity-spill-', dir=widget_data_dir)
+            os.close(spill_fd)
+            identity_ilist_writers = IdentitySpillWriter(
+                spill_path, 1, get_uncounted_video_ids(conn))
+        elif resume_checkpoint is not None:
+            # The files written so far are for these identities
+            selected_identities = [
+                tuple(x) for x in resume_checkpoint['selected_identities']]
+            identity_ilist_writers = get_identity_ilist_writers(
+                selected_identities)
+            identity_ilist_writers.resume({
+                int(k): v
+                for k, v in resume_checkpoint['people_sizes'].items()})
+        elif selected_identities is not None:
+            identity_ilist_writers = get_identity_ilist_writers(
+                selected_identities)
+        elif conn_args is not None:
+            selection_executor = ThreadPoolExecutor(1)
+            selection = selection_executor.submit(
+                run_with_new_connection, conn_args, functools.partial(
+                    get_selected_identities, video_filter=video_filter))
+            spill_fd, spill_path = tempfile.mkstemp(
+                prefix='.identity-spill-', dir=widget_data_dir)
+            os.close(spill_fd)
+            identity_ilist_writers = DeferredIdentityWriter(
+                selection, get_identity_ilist_writers, spill_path, 1)
+        else:
+            start_time = time.time()
+            with metrics.timer('selected_identities'):
+                selected_identities = get_selected_identities(
+                    conn, session, video_filter=video_filter)
+            print("Fetched {} selected identities in {:.3f} seconds".format(
+                len(selected_identities), time.time() - start_time))
+            identity_ilist_writers = get_identity_ilist_writers(
+                selected_identities)
+
+        # Count the number of faces for a progress bar estimate
+        face_count = None
+        if not video_filter:
+            with metrics.timer('face_count'):
+                face_count = session.query(
+                    func.count(schema.Face.id)).scalar()
+
+        coalescer = (IntervalCoalescer(coalesce_tolerance)
+                     if coalesce_tolerance is not None else None)
+        with IntervalListMappingWriter(
+                os.path.join(widget_data_dir, 'faces.ilist.bin'), 1,
+                resume_offset=(resume_checkpoint['faces_size']
+                               if resume_checkpoint is not None else None)
+        ) as all_faces_writer, get_face_bbox_writer(
+                os.path.join(widget_data_dir, FACE_BBOX_NAME), bbox_format,
+                dict(get_all_identities(conn)),
+                resume_state=(resume_checkpoint['bbox_state']
+                              if resume_checkpoint is not None else None),
+                threads=PIPELINE_BBOX_THREADS if pipelined else 0
+        ) as face_bbox_writer:
+            last_checkpoint_time = time.time()
+
+            def on_video_done(video_id):
+                nonlocal last_checkpoint_time, selected_identities
+                if time.time() - last_checkpoint_time < CHECKPOINT_INTERVAL:
+                    return
+                people_sizes = identity_ilist_writers.checkpoint()
+                if selection is not None:
+                    selected_identities = \
+                        identity_ilist_writers.selected_identities
+                save_checkpoint(widget_data_dir, {
+                    **checkpoint_state,
+                    'bbox_format': bbox_format,
+                    'coalesce_tolerance': coalesce_tolerance,
+                    'video_filter': video_filter._asdict(),
+                    'selected_identities': selected_identities,
+                    'last_video_id': video_id,
+                    'faces_size': all_faces_writer.checkpoint(),
+                    'people_sizes': people_sizes,
+                    'bbox_state': face_bbox_writer.checkpoint()
+                })
+                last_checkpoint_time = time.time()
+
+            face_batches = get_faces_and_identities_from_db(
+                conn, session, after_video_id=after_video_id,
+                copy_binary=copy_binary, video_filter=video_filter)
+            write_faces_and_identities(
+                conn, session, face_batches, face_count, all_faces_writer,
+                identity_ilist_writers, face_bbox_writer,
+                on_video_done=(on_video_done if checkpoint_state is not None
+                               and not single_pass else None),
+                metrics=metrics, pipelined=pipelined, coalescer=coalescer)
+            with metrics.timer('write:people'):
+                identity_ilist_writers.close()
+        if coalescer is not None:
+            coalescer.print_stats()
+
+        if selection is not None:
+            selected_identities = identity_ilist_writers.selected_identities
+            print("Fetched {} selected identities alongside the faces, waited "
+                  "{:.3f} seconds".format(len(selected_identities),
+                                          identity_ilist_writers.wait_time))
+        if single_pass:
+            with metrics.timer('write_spilled_identities'):
+                selected_identities = write_spilled_identities(
+                    conn, identity_interval_dir,
+                    [(spill_path, identity_ilist_writers.screen_time)],
+                    max_open_files=max_open_files)
+    except BaseException:
+        if isinstance(identity_ilist_writers,
+                      (IdentitySpillWriter, DeferredIdentityWriter)):
+            identity_ilist_writers.discard()
+        raise
+    finally:
+        if selection is not None:
+            selection_executor.shutdown(wait=False)
+        if spill_path is not None and os.path.exists(spill_path):
+            os.remove(spill_path)
+    return selected_identities
+
+
+# Each worker gets several shards so that uneven shards balance out
+SHARDS_PER_WORKER = 4
+
+
+def init_face_worker(conn_args, snapshot_id, selected_identity_ids,
+                     max_open_files, copy_binary, bbox_format, collect_metrics,
+                     pipelined, coalesce_tolerance, video_filter):
+    conn = psycopg2.connect(**conn_args)
+    # Every worker reads from the snapshot exported by the parent, so that all
+    # of the shards are consistent with each other.
+    conn.set_session(isolation_level='REPEATABLE READ')
+    cur = conn.cursor()
+    cur.execute('SET TRANSACTION SNAPSHOT %s', (snapshot_id,))
+    export_face_shard.conn = conn
+    export_face_shard.session = get_db_session(
+        conn_args['user'], conn_args['password'], conn_args['dbname'])
+    export_face_shard.selected_identity_ids = selected_identity_ids
+    export_face_shard.max_open_files = max_open_files
+    export_face_shard.copy_binary = copy_binary
+    export_face_shard.bbox_format = bbox_format
+    export_face_shard.collect_metrics = collect_metrics
+    export_face_shard.pipelined = pipelined
+    export_face_shard.coalesce_tolerance = coalesce_tolerance
+    export_face_shard.video_filter = video_filter
+    export_face_shard.identity_id_to_name = dict(get_all_identities(conn))
+    # Without selected identities, every identity is spilled (see
+    # export_faces_and_identities with single_pass)
+    export_face_shard.uncounted_video_ids = (
+        get_uncounted_video_ids(conn) if selected_identity_ids is None
+        else None)
+
+
+def get_shard_identity_ilist_path(shard_dir, identity_id):
+    return os.path.join(shard_dir, 'people', '{}.ilist.bin'.format(identity_id))
+
+
+def get_shard_identity_spill_path(shard_dir):
+    return os.path.join(shard_dir, 'identities.spill.bin')
+
+
+# The json face bboxes of every shard go to face_bbox_path, whereas the packed
+# ones go to a store in the shard_dir, to be concatenated. Returns the
+# shard_dir, the screen time of each identity, if they were spilled, the
+# counters of the shard's StageMetrics, if collect_metrics was set, and the
+# IntervalCoalescer stats, if coalescing.
+def export_face_shard(args):
+    shard_dir, face_bbox_path, video_id_range = args
+    conn = export_face_shard.conn
+    session = export_face_shard.session
+    os.makedirs(os.path.join(shard_dir, 'people'), exist_ok=True)
+    metrics = (StageMetrics(None, 'faces') if export_face_shard.collect_metrics
+               else NULL_METRICS)
+    coalescer = (IntervalCoalescer(export_face_shard.coalesce_tolerance)
+                 if export_face_shard.coalesce_tolerance is not None else None)
+
+    if export_face_shard.selected_identity_ids is None:
+        identity_ilist_writers = IdentitySpillWriter(
+            get_shard_identity_spill_path(shard_dir), 1,
+            export_face_shard.uncounted_video_ids)
+    else:
+        identity_ilist_writers = IntervalListWriterPool(
+            export_face_shard.selected_identity_ids,
+            lambda i: get_shard_identity_ilist_path(shard_dir, i), 1,
+            max_open_files=export_face_shard.max_open_files, create_empty=False)
     with IntervalListMappingWriter(
-            os.path.join(widget_data_dir, 'faces.ilist.bin'), 1
-    ) as all_faces_writer:
-        face_iterator = get_faces_and_identities_from_db(conn, session)
+            os.path.join(shard_dir, 'faces.ilist.bin'), 1
+    ) as all_faces_writer, get_face_bbox_writer(
+            face_bbox_path, export_face_shard.bbox_format,
+            export_face_shard.identity_id_to_name,
+            threads=(PIPELINE_BBOX_THREADS if export_face_shard.pipelined
+                     else 0)
+    ) as face_bbox_writer:
+        face_batches = get_faces_and_identities_from_db(
+            conn, session, video_id_range=video_id_range,
+            copy_binary=export_face_shard.copy_binary,
+            video_filter=export_face_shard.video_filter)
+        write_faces_and_identities(
+            conn, session, face_batches, None, all_faces_writer,
+            identity_ilist_writers, face_bbox_writer, show_progress=False,
+            metrics=metrics, pipelined=export_face_shard.pipelined,
+            coalescer=coalescer)
+        face_batches.close()
+    with metrics.timer('write:people'):
+        identity_ilist_writers.close()
+    counters = metrics.get_counters() if metrics.enabled else None
+    coalesce_stats = dict(coalescer.stats) if coalescer is not None else None
+    if isinstance(identity_ilist_writers, IdentitySpillWriter):
+        return (shard_dir, dict(identity_ilist_writers.screen_time), counters,
+                coalesce_stats)
+    return shard_dir, None, counters, coalesce_stats
+export_face_shard.conn = None
+export_face_shard.session = None
+export_face_shard.selected_identity_ids = None
+export_face_shard.max_open_files = None
+export_face_shard.copy_binary = None
+export_face_shard.bbox_format = None
+export_face_shard.collect_metrics = False
+export_face_shard.pipelined = False
+export_face_shard.coalesce_tolerance = None
+export_face_shard.video_filter = NO_VIDEO_FILTER
+export_face_shard.identity_id_to_name = None
+export_face_shard.uncounted_video_ids = None
+
+
+# Same outputs as export_faces_and_identities, but the video id space is split
+# into ranges that are exported by a pool of workers, each with its own
+# connection. The partial files are concatenated in video order at the end.
+# The counters of the workers are merged into metrics.
+def export_faces_and_identities_parallel(conn_args, session, widget_data_dir,
+                                         workers, max_open_files=MAX_OPEN_FILES,
+                                         copy_binary=False, bbox_format='json',
+                                         single_pass=False, metrics=NULL_METRICS,
+                                         pipelined=False, coalesce_tolerance=None,
+                                         video_filter=NO_VIDEO_FILTER,
+                                         selected_identities=None):
+    identity_interval_dir = os.path.join(widget_data_dir, 'people')
+    os.makedirs(identity_interval_dir, exist_ok=True)
 
-        prev_face_id = None
-        for row in tqdm.tqdm(face_iterator, total=face_count):
-            (
-                face_id, video_id, frame_sampler_id, start_ms,
-                gender_id, gender_score, identity_id, identity_score, is_host,
-                bbox_x1, bbox_x2, bbox_y1, bbox_y2
-            ) = row
-            assert prev_face_id != face_id, 'Duplicate face id! {}'.format(face_id)
-            prev_face_id = face_id
-
-            if video_id != curr_video_id:
-                if curr_video_id is not None:
-                    flush_identity_accumulators(curr_video_id, curr_ilist_accumulators)
-                    if curr_video_intervals:
-                        all_faces_writer.write(curr_video_id, curr_video_intervals)
-                    if curr_video_faces:
-                        save_bboxes_for_video(curr_video_id, curr_video_faces)
-
-                curr_video_id = video_id
-                curr_ilist_accumulators = defaultdict(list)
-                curr_video_intervals = []
-                curr_video_faces = []
-
-            if frame_sampler_id == sampler_1s_id:
-                end_ms = start_ms + 1000
-            elif frame_sampler_id == sampler_3s_id:
-                end_ms = start_ms + 3000
+    # This transaction must stay open until every worker has imported the
+    # snapshot
+    snapshot_conn = psycopg2.connect(**conn_args)
+    shard_root = None
+    try:
+        snapshot_conn.set_session(isolation_level='REPEATABLE READ')
+        cur = snapshot_conn.cursor()
+        cur.execute('SELECT pg_export_snapshot()')
+        snapshot_id = cur.fetchone()[0]
+
+        if single_pass:
+            selected_identity_ids = None
+        else:
+            if selected_identities is None:
+                start_time = time.time()
+                with metrics.timer('selected_identities'):
+                    selected_identities = get_selected_identities(
+                        snapshot_conn, session, video_filter=video_filter)
+                print("Fetched {} selected identities in {:.3f} seconds".format(
+                    len(selected_identities), time.time() - start_time))
+            selected_identity_ids = {id for id, _ in selected_identities}
+
+        video_ids = sorted(get_exported_video_ids(snapshot_conn, video_filter))
+        video_id_ranges = [
+            (int(x[0]), int(x[-1]))
+            for x in np.array_split(video_ids, workers * SHARDS_PER_WORKER)
+            if len(x) > 0
+        ]
+
+        shard_root = tempfile.mkdtemp(
+            prefix='.export-shards-', dir=widget_data_dir)
+        shard_dirs = [os.path.join(shard_root, str(i))
+                      for i in range(len(video_id_ranges))]
+        if bbox_format == 'json':
+            face_bbox_paths = [os.path.join(widget_data_dir, FACE_BBOX_NAME)
+                               for _ in shard_dirs]
+        else:
+            face_bbox_paths = [os.path.join(x, FACE_BBOX_NAME) for x in shard_dirs]
+        print('Exporting faces in {} shards with {} workers'.format(
+            len(shard_dirs), workers))
+        # The workers are not forked from this process, whose other threads
+        # (see --concurrent-stages) may hold connections and locks
+        with multiprocessing.get_context('forkserver').Pool(
+            workers, initializer=init_face_worker,
+            initargs=(conn_args, snapshot_id, selected_identity_ids,
+                      max_open_files, copy_binary, bbox_format,
+                      metrics.enabled, pipelined, coalesce_tolerance,
+                      video_filter)
+        ) as p:
+            shard_screen_times = {}
+            coalescer = IntervalCoalescer(coalesce_tolerance)
+            for shard_dir, screen_time, counters, coalesce_stats in tqdm.tqdm(
+                p.imap_unordered(export_face_shard, list(zip(
+                    shard_dirs, face_bbox_paths, video_id_ranges))),
+                total=len(shard_dirs)
+            ):
+                shard_screen_times[shard_dir] = screen_time
+                if counters is not None:
+                    metrics.merge(counters)
+                if coalesce_stats is not None:
+                    coalescer.merge(coalesce_stats)
+        if coalesce_tolerance is not None:
+            coalescer.print_stats()
+
+        print('Merging shards')
+        with metrics.timer('merge'):
+            concat_files(
+                os.path.join(widget_data_dir, 'faces.ilist.bin'),
+                [os.path.join(x, 'faces.ilist.bin') for x in shard_dirs])
+            if single_pass:
+                selected_identities = write_spilled_identities(
+                    snapshot_conn, identity_interval_dir,
+                    [(get_shard_identity_spill_path(x), shard_screen_times[x])
+                     for x in shard_dirs],
+                    max_open_files=max_open_files)
             else:
-                raise Exception('Unknown frame sampler: {}'.format(frame_sampler_id))
-
-            height = bbox_y2 - bbox_y1
-            assert height > 0
-
-            interval_entry = (
-                start_ms, end_ms,
-                encode_payload(
-                    gender_id == male_gender_id,
-                    gender_id == non_binary_gender_id,
-                    is_host, height)
-            )
-            if identity_id in selected_identities:
-                curr_ilist_accumulators[identity_id].append(interval_entry)
-            curr_video_intervals.append(interval_entry)
-
-            face_meta = {
-                'g': ('u' if gender_id == non_binary_gender_id
-                      else ('m' if gender_id == male_gender_id else 'f')),
-                't': [round(start_ms / 1000, 2), round(end_ms / 1000, 2)],
-                'b': [
-                    round(bbox_x1, 2), round(bbox_y1, 2),
-                    round(bbox_x2, 2), round(bbox_y2, 2)
-                ]
-            }
-            if identity_id is not None:
-                face_meta['i'] = identity_id
-            curr_video_faces.append(face_meta)
-
-        if curr_video_id is not None:
-            flush_identity_accumulators(curr_video_id, curr_ilist_accumulators)
-            if curr_video_intervals:
-                all_faces_writer.write(curr_video_id, curr_video_intervals)
-            if curr_video_faces:
-                save_bboxes_for_video(curr_video_id, curr_video_faces)
-
-        for iw in identity_ilist_writers.values():
-            iw.close()
+                for id, name in tqdm.tqdm(selected_identities):
+                    concat_files(
+                        get_identity_ilist_path(identity_interval_dir, name),
+                        [get_shard_identity_ilist_path(x, id) for x in shard_dirs])
+            snapshot_conn.close()
+            if bbox_format == 'packed':
+                concat_face_bbox_stores(
+                    os.path.join(widget_data_dir, FACE_BBOX_NAME), face_bbox_paths)
+    finally:
+        if shard_root is not None:
+            shutil.rmtree(shard_root)
+        # Ends the transaction that holds the snapshot, if a worker failed
+        snapshot_conn.close()
+    return selected_identities
 
 
 def export_hosts(conn, widget_data_dir):
@@ -500,7 +1987,7 @@ def export_hosts(conn, widget_data_dir):
     print("Finished host export in {:.3f} seconds".format(time.time() - start_time))
 
 
-def export_videos(conn, widget_data_dir):
+def export_videos(conn, widget_data_dir, video_filter=NO_VIDEO_FILTER):
     start_time = time.time()
     video_file = os.path.join(widget_data_dir, 'videos.json')
 
@@ -523,8 +2010,8 @@ def export_videos(conn, widget_data_dir):
         LEFT JOIN show ON video.show_id = show.id
         LEFT JOIN canonical_show ON show.canonical_show_id = canonical_show.id
         LEFT JOIN channel ON channel.id=show.channel_id
-        WHERE NOT video.is_corrupt AND NOT video.is_duplicate
-    """)
+        WHERE NOT video.is_corrupt AND NOT video.is_duplicate{}
+    """.format(video_filter.sql), video_filter.params)
 
     with open(video_file, 'w') as f:
         json.dump(cur.fetchall(), f)
@@ -532,29 +2019,890 @@ def export_videos(conn, widget_data_dir):
     print("Finished video export in {:.3f} seconds".format(time.time() - start_time))
 
 
+MANIFEST_FILE = 'export-manifest.json'
+
+# Tables whose max id (or face_id) is used to find what changed since the
+# last export
+WATERMARK_COLUMNS = [
+    ('face', 'id'),
+    ('face_identity', 'face_id'),
+    ('face_gender', 'face_id'),
+    ('commercial', 'id'),
+]
+
+
+def load_manifest(widget_data_dir):
+    manifest_file = os.path.join(widget_data_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as fp:
+        return json.load(fp)
+
+
+def save_manifest(widget_data_dir, export_state, selected_identities,
+                  bbox_format, coalesce_tolerance, single_pass=False,
+                  partial=None):
+    manifest_file = os.path.join(widget_data_dir, MANIFEST_FILE)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump({
+            'watermarks': export_state['watermarks'],
+            'label_counts': export_state['label_counts'],
+            'identity_screen_times': export_state.get('identity_screen_times'),
+            'video_ids': sorted(export_state['video_ids']),
+            'selected_identities': sorted(selected_identities),
+            'bbox_format': bbox_format,
+            'coalesce_tolerance': coalesce_tolerance,
+            'single_pass': single_pass,
+            # The filters of a partial export, to merge it (see merge_export.py)
+            'partial': partial
+        }, fp)
+    os.replace(tmp_file, manifest_file)
+
+
+CHECKPOINT_FILE = 'export-checkpoint.json'
+
+# Seconds between checkpoints of a full face export
+CHECKPOINT_INTERVAL = 300
+
+
+def load_checkpoint(widget_data_dir):
+    checkpoint_file = os.path.join(widget_data_dir, CHECKPOINT_FILE)
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as fp:
+        return json.load(fp)
+
+
+# The output files must have been flushed up to the sizes in the checkpoint.
+# They are synced to disk along with the checkpoint itself, so that the
+# checkpoint never points past data that was lost.
+def save_checkpoint(widget_data_dir, checkpoint):
+    checkpoint_file = os.path.join(widget_data_dir, CHECKPOINT_FILE)
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump(checkpoint, fp)
+    os.sync()
+    os.replace(tmp_file, checkpoint_file)
+
+
+def remove_checkpoint(widget_data_dir):
+    checkpoint_file = os.path.join(widget_data_dir, CHECKPOINT_FILE)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+
+def get_exported_video_ids(conn, video_filter=NO_VIDEO_FILTER):
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM video WHERE NOT is_corrupt AND NOT is_duplicate'
+                + video_filter.sql, video_filter.params)
+    return {x[0] for x in cur.fetchall()}
+
+
+# Every video in a partial export's filter, including corrupt and duplicate
+# ones, whose entries a merge replaces (see merge_export.py)
+def get_filtered_video_ids(conn, video_filter):
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM video WHERE TRUE' + video_filter.sql,
+                video_filter.params)
+    return {x[0] for x in cur.fetchall()}
+
+
+# Count the labels per labeler on faces up to max_face_id, and separately up
+# to prev_max_face_id (the previous export's watermark), in one scan.
+def get_label_counts(conn, table, max_face_id, prev_max_face_id):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT labeler_id, face_id <= %s, COUNT(*)
+        FROM {}
+        WHERE face_id <= %s
+        GROUP BY labeler_id, face_id <= %s
+    """.format(table), (prev_max_face_id, max_face_id, prev_max_face_id))
+    counts = defaultdict(int)
+    prev_counts = defaultdict(int)
+    for labeler_id, is_prev, count in cur.fetchall():
+        # JSON object keys are strings
+        counts[str(labeler_id)] += count
+        if is_prev:
+            prev_counts[str(labeler_id)] += count
+    return dict(counts), dict(prev_counts)
+
+
+# Snapshot the watermarks, label counts and exported videos before exporting
+# anything, so that rows added during the export are picked up by the next run.
+# The labels are only counted (a scan of the label tables) with count_labels,
+# for an incremental export; the next incremental export of an export without
+# them is a full one.
+def get_export_state(conn, manifest, video_filter=NO_VIDEO_FILTER,
+                     count_labels=False):
+    cur = conn.cursor()
+    watermarks = {}
+    for table, column in WATERMARK_COLUMNS:
+        cur.execute('SELECT MAX({}) FROM {}'.format(column, table))
+        watermarks[table] = cur.fetchone()[0] or 0
+
+    label_counts = None
+    prev_label_counts = None
+    if count_labels:
+        label_counts = {}
+        prev_label_counts = {}
+        for table in ['face_identity', 'face_gender']:
+            prev_max_face_id = (manifest['watermarks'][table] if manifest
+                                else watermarks[table])
+            label_counts[table], prev_label_counts[table] = get_label_counts(
+                conn, table, watermarks[table], prev_max_face_id)
+
+    return {
+        'watermarks': watermarks,
+        'label_counts': label_counts,
+        'prev_label_counts': prev_label_counts,
+        'video_ids': get_exported_video_ids(conn, video_filter)
+    }
+
+
+# Returns a reason why the previous export cannot be updated in place, or
+# None if it can.
+def check_incremental_export(manifest, export_state, bbox_format,
+                             coalesce_tolerance, single_pass=False):
+    if manifest is None:
+        return 'no manifest from a previous export'
+    if manifest.get('partial') is not None:
+        return 'the previous export is partial'
+    if manifest.get('bbox_format', 'json') != bbox_format:
+        return 'the previous export has {} face bboxes'.format(
+            manifest.get('bbox_format', 'json'))
+    if manifest.get('coalesce_tolerance') != coalesce_tolerance:
+        return 'the previous export has a coalesce tolerance of {}'.format(
+            manifest.get('coalesce_tolerance'))
+    # The identities selected in a single pass are not the ones that
+    # get_selected_identities would select
+    if manifest.get('single_pass', False) != single_pass:
+        return 'the previous export {} select identities in a single ' \
+            'pass'.format('did' if manifest.get('single_pass', False)
+                          else 'did not')
+    for table, _ in WATERMARK_COLUMNS:
+        if export_state['watermarks'][table] < manifest['watermarks'][table]:
+            return '{} watermark went backwards'.format(table)
+    if manifest.get('label_counts') is None:
+        return 'the previous export did not count labels'
+    # Labels added to (or removed from) faces that were already exported,
+    # such as by backfill_identities_with_knn.py, cannot be located by
+    # watermark alone.
+    for table, counts in export_state['prev_label_counts'].items():
+        if counts != manifest['label_counts'][table]:
+            return 'labels on previously exported faces in {} changed'.format(
+                table)
+    return None
+
+
+# Videos with faces or labels added since the previous export
+def get_changed_video_ids(conn, watermarks):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT frame.video_id
+        FROM face
+        INNER JOIN frame ON face.frame_id = frame.id
+        WHERE face.id > {face}
+        UNION
+        SELECT frame.video_id
+        FROM face_identity
+        INNER JOIN face ON face_identity.face_id = face.id
+        INNER JOIN frame ON face.frame_id = frame.id
+        WHERE face_identity.face_id > {face_identity}
+        UNION
+        SELECT frame.video_id
+        FROM face_gender
+        INNER JOIN face ON face_gender.face_id = face.id
+        INNER JOIN frame ON face.frame_id = frame.id
+        WHERE face_gender.face_id > {face_gender}
+    """.format(**watermarks))
+    return {x[0] for x in cur.fetchall()}
+
+
+# The identities selected by an incremental export, and their screen times
+# (see get_identity_screen_times), which the manifest keeps for the next one.
+# The previous selection is reused if no identity labels were added and the
+# same videos are exported. Otherwise the previous screen times are updated
+# from the changed and removed videos, or counted over all of the videos if
+# the previous export did not save them (e.g., it was a full one).
+def get_incremental_selected_identities(conn, session, manifest, export_state,
+                                        changed_video_ids, removed_video_ids):
+    screen_times = manifest.get('identity_screen_times')
+    prev_video_ids = set(manifest['video_ids'])
+    max_face_id = export_state['watermarks']['face_identity']
+    if screen_times is None:
+        screen_times = get_identity_screen_times(conn, session, max_face_id)
+    elif (
+        export_state['label_counts']['face_identity']
+            == manifest['label_counts']['face_identity']
+        and export_state['video_ids'] == prev_video_ids
+    ):
+        return ([tuple(x) for x in manifest['selected_identities']],
+                screen_times)
+    else:
+        screen_times = update_identity_screen_times(
+            conn, session, screen_times, max_face_id,
+            manifest['watermarks']['face_identity'], changed_video_ids,
+            (changed_video_ids | removed_video_ids) & prev_video_ids)
+    return select_identities(conn, screen_times), screen_times
+
+
+# Update the outputs of a previous export_faces_and_identities in place. Only
+# the changed videos are queried; their entries are spliced into
+# faces.ilist.bin and the existing people files. Identities that newly cross
+# the screen time threshold have their full history queried.
+def export_faces_and_identities_incremental(
+    conn, session, widget_data_dir, changed_video_ids, removed_video_ids,
+    prev_selected_identities, selected_identities,
+    max_open_files=MAX_OPEN_FILES, copy_binary=False, bbox_format='json',
+    metrics=NULL_METRICS, pipelined=False, coalesce_tolerance=None
+):
+    identity_interval_dir = os.path.join(widget_data_dir, 'people')
+    os.makedirs(identity_interval_dir, exist_ok=True)
+
+    face_bbox_path = os.path.join(widget_data_dir, FACE_BBOX_NAME)
+
+    prev_selected_identities = dict(prev_selected_identities)
+    kept_identities = {id: name for id, name in selected_identities
+                       if id in prev_selected_identities}
+    added_identities = {id: name for id, name in selected_identities
+                        if id not in prev_selected_identities}
+    dropped_identities = {
+        id: name for id, name in prev_selected_identities.items()
+        if id not in kept_identities}
+    print('Identities: {} kept, {} added, {} dropped'.format(
+        len(kept_identities), len(added_identities), len(dropped_identities)))
+
+    if bbox_format == 'json':
+        for video_id in removed_video_ids:
+            face_bbox_file = os.path.join(face_bbox_path, '{}.json'.format(video_id))
+            if os.path.exists(face_bbox_file):
+                os.remove(face_bbox_file)
+
+    coalescer = (IntervalCoalescer(coalesce_tolerance)
+                 if coalesce_tolerance is not None else None)
+    delta_dir = tempfile.mkdtemp(prefix='.export-delta-', dir=widget_data_dir)
+    # Json face bboxes are overwritten in place, packed ones are spliced
+    if bbox_format == 'json':
+        delta_face_bbox_path = face_bbox_path
+    else:
+        delta_face_bbox_path = os.path.join(delta_dir, FACE_BBOX_NAME)
+    try:
+        print('Exporting {} changed videos'.format(len(changed_video_ids)))
+        delta_ilist_writers = IntervalListWriterPool(
+            kept_identities,
+            lambda i: os.path.join(delta_dir, '{}.ilist.bin'.format(i)), 1,
+            max_open_files=max_open_files, create_empty=False)
+        face_delta_file = os.path.join(delta_dir, 'faces.ilist.bin')
+        with IntervalListMappingWriter(
+                face_delta_file, 1
+        ) as all_faces_writer, get_face_bbox_writer(
+                delta_face_bbox_path, bbox_format, dict(get_all_identities(conn)),
+                threads=PIPELINE_BBOX_THREADS if pipelined else 0
+        ) as face_bbox_writer:
+            face_batches = get_faces_and_identities_from_db(
+                conn, session, video_ids=changed_video_ids,
+                copy_binary=copy_binary)
+            write_faces_and_identities(
+                conn, session, face_batches, None, all_faces_writer,
+                delta_ilist_writers, face_bbox_writer, metrics=metrics,
+                pipelined=pipelined, coalescer=coalescer)
+            face_batches.close()
+        with metrics.timer('write:people'):
+            delta_ilist_writers.close()
+
+        print('Splicing changed videos into existing files')
+        drop_ids = changed_video_ids | removed_video_ids
+        with metrics.timer('splice'):
+            splice_interval_file(
+                os.path.join(widget_data_dir, 'faces.ilist.bin'),
+                face_delta_file, drop_ids, 1)
+            for id, name in tqdm.tqdm(kept_identities.items()):
+                splice_interval_file(
+                    get_identity_ilist_path(identity_interval_dir, name),
+                    os.path.join(delta_dir, '{}.ilist.bin'.format(id)),
+                    drop_ids, 1)
+            if bbox_format == 'packed':
+                splice_face_bbox_store(
+                    face_bbox_path, delta_face_bbox_path, drop_ids)
+    finally:
+        shutil.rmtree(delta_dir)
+
+    if added_identities:
+        print('Exporting {} new identities'.format(len(added_identities)))
+        identity_ilist_writers = IntervalListWriterPool(
+            added_identities,
+            lambda i: get_identity_ilist_path(
+                identity_interval_dir, added_identities[i]),
+            1, max_open_files=max_open_files)
+        face_batches = get_faces_and_identities_from_db(
+            conn, session, identity_ids=set(added_identities),
+            copy_binary=copy_binary)
+        write_faces_and_identities(
+            conn, session, face_batches, None, None,
+            identity_ilist_writers, None, metrics=metrics,
+            pipelined=pipelined, coalescer=coalescer)
+        face_batches.close()
+        with metrics.timer('write:people'):
+            identity_ilist_writers.close()
+
+    for name in dropped_identities.values():
+        identity_ilist_file = get_identity_ilist_path(identity_interval_dir, name)
+        if os.path.exists(identity_ilist_file):
+            os.remove(identity_ilist_file)
+    if coalescer is not None:
+        coalescer.print_stats()
+
+
+PARTITION_DIR = 'partitions'
+PARTITION_MANIFEST_FILE = 'partition-manifest.json'
+
+
+# Returns the partition of each exported video: its year, or its month for the
+# (denser) videos sampled at 1s
+def get_video_partitions(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            id,
+            CASE WHEN time < '{start_1s}' THEN TO_CHAR(time, 'YYYY')
+                 ELSE TO_CHAR(time, 'YYYY-MM') END
+        FROM video
+        WHERE NOT is_corrupt AND NOT is_duplicate
+    """.format(start_1s=SAMPLER_1S_START_TIME))
+    return dict(cur.fetchall())
+
+
+# Returns the first day of a partition and the first day after it
+def get_partition_dates(key):
+    if len(key) == 4:
+        year = int(key)
+        return '{:04d}-01-01'.format(year), '{:04d}-01-01'.format(year + 1)
+    year, month = (int(x) for x in key.split('-'))
+    return ('{:04d}-{:02d}-01'.format(year, month),
+            '{:04d}-{:02d}-01'.format(year + month // 12, month % 12 + 1))
+
+
+# Returns the [first, last] video id ranges of each partition, such that every
+# exported video with an id in a range is in that partition
+def get_partition_video_id_ranges(video_partitions):
+    ranges = defaultdict(list)
+    prev_key = None
+    for video_id in sorted(video_partitions):
+        key = video_partitions[video_id]
+        if key == prev_key:
+            ranges[key][-1][1] = video_id
+        else:
+            ranges[key].append([video_id, video_id])
+        prev_key = key
+    return ranges
+
+
+def load_partition_manifests(partition_dir):
+    manifests = {}
+    if os.path.isdir(partition_dir):
+        for key in os.listdir(partition_dir):
+            manifest_file = os.path.join(
+                partition_dir, key, PARTITION_MANIFEST_FILE)
+            if os.path.exists(manifest_file):
+                with open(manifest_file) as fp:
+                    manifests[key] = json.load(fp)
+    return manifests
+
+
+def save_partition_manifest(path, key, num_videos, video_id_ranges):
+    manifest_file = os.path.join(path, PARTITION_MANIFEST_FILE)
+    tmp_file = manifest_file + '.tmp'
+    start, end = get_partition_dates(key)
+    with open(tmp_file, 'w') as fp:
+        json.dump({
+            'partition': key,
+            'start': start,
+            'end': end,
+            'num_videos': num_videos,
+            'video_id_ranges': video_id_ranges
+        }, fp)
+    os.replace(tmp_file, manifest_file)
+
+
+# Returns the partitions (in manifests) of the given video ids, e.g., to find
+# where removed videos were
+def find_video_partitions(manifests, video_ids):
+    ranges = sorted((a, b, key) for key, manifest in manifests.items()
+                    for a, b in manifest['video_id_ranges'])
+    starts = [x[0] for x in ranges]
+    keys = set()
+    for video_id in video_ids:
+        i = bisect.bisect_right(starts, video_id) - 1
+        if i >= 0 and video_id <= ranges[i][1]:
+            keys.add(ranges[i][2])
+    return keys
+
+
+def split_interval_file(path, video_partitions, get_partition_path,
+                        payload_len, keys, create_empty=False):
+    """Copy each entry of an ilist (or iset) file into the file of the
+    partition of its video, for the partitions in keys. Unless create_empty,
+    files are only created for partitions with entries."""
+    fps = {}
+    try:
+        if create_empty:
+            for key in keys:
+                fps[key] = open(get_partition_path(key), 'wb',
+                                buffering=WRITE_BUFFER_SIZE)
+        if not os.path.exists(path):
+            return
+        for id_, data in iter_interval_file_entries(path, payload_len):
+            key = video_partitions.get(id_)
+            if key not in keys:
+                continue
+            fp = fps.get(key)
+            if fp is None:
+                fp = fps[key] = open(get_partition_path(key), 'wb',
+                                     buffering=WRITE_BUFFER_SIZE)
+            fp.write(data)
+    finally:
+        for fp in fps.values():
+            fp.close()
+
+
+# Split faces.ilist.bin, commercials.iset.bin and the people files into
+# partitions/<key>/, by the time of their videos (see get_video_partitions),
+# so that the viewer can load only the partitions of a date range. Each
+# partition has a manifest with the ids of its videos.
+#
+# Given the changed (or removed) videos since the previous export, only the
+# partitions of those videos are rewritten. The people files of identities
+# that were added or dropped, and the commercials if they changed, are updated
+# in the other partitions.
+def export_partitions(conn, widget_data_dir, selected_identities,
+                      changed_video_ids=None, prev_selected_identities=None,
+                      commercials_changed=True):
+    start_time = time.time()
+    partition_dir = os.path.join(widget_data_dir, PARTITION_DIR)
+    identity_interval_dir = os.path.join(widget_data_dir, 'people')
+    faces_file = os.path.join(widget_data_dir, 'faces.ilist.bin')
+    commercials_file = os.path.join(widget_data_dir, 'commercials.iset.bin')
+
+    video_partitions = get_video_partitions(conn)
+    video_id_ranges = get_partition_video_id_ranges(video_partitions)
+    prev_manifests = load_partition_manifests(partition_dir)
+
+    if changed_video_ids is None or not prev_manifests:
+        rewrite_keys = set(video_id_ranges) | set(prev_manifests)
+    else:
+        rewrite_keys = (
+            {video_partitions[v] for v in changed_video_ids
+             if v in video_partitions}
+            | find_video_partitions(prev_manifests, changed_video_ids))
+        rewrite_keys |= set(video_id_ranges) - set(prev_manifests)
+    # Partitions that are no longer needed are removed
+    write_keys = rewrite_keys & set(video_id_ranges)
+    print('Rewriting {} of {} partitions'.format(
+        len(write_keys), len(video_id_ranges)))
+
+    def get_tmp_dir(key):
+        return os.path.join(partition_dir, '.{}.tmp'.format(key))
+
+    for key in write_keys:
+        tmp_dir = get_tmp_dir(key)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir, 'people'))
+
+    split_interval_file(
+        faces_file, video_partitions,
+        lambda key: os.path.join(get_tmp_dir(key), 'faces.ilist.bin'), 1,
+        write_keys, create_empty=True)
+    split_interval_file(
+        commercials_file, video_partitions,
+        lambda key: os.path.join(get_tmp_dir(key), 'commercials.iset.bin'), 0,
+        write_keys, create_empty=True)
+    for _, name in tqdm.tqdm(selected_identities):
+        split_interval_file(
+            get_identity_ilist_path(identity_interval_dir, name),
+            video_partitions,
+            lambda key: get_identity_ilist_path(
+                os.path.join(get_tmp_dir(key), 'people'), name),
+            1, write_keys)
+
+    for key in write_keys:
+        tmp_dir = get_tmp_dir(key)
+        dst_dir = os.path.join(partition_dir, key)
+        if os.path.exists(dst_dir):
+            old_dir = os.path.join(partition_dir, '.{}.old'.format(key))
+            os.replace(dst_dir, old_dir)
+            os.replace(tmp_dir, dst_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.replace(tmp_dir, dst_dir)
+    for key in rewrite_keys - write_keys:
+        shutil.rmtree(os.path.join(partition_dir, key), ignore_errors=True)
+
+    keep_keys = set(video_id_ranges) - rewrite_keys
+    if keep_keys:
+        selected_names = {name for _, name in selected_identities}
+        prev_names = {name for _, name in prev_selected_identities or []}
+        for name in tqdm.tqdm(selected_names - prev_names):
+            split_interval_file(
+                get_identity_ilist_path(identity_interval_dir, name),
+                video_partitions,
+                lambda key: get_identity_ilist_path(
+                    os.path.join(partition_dir, key, 'people'), name),
+                1, keep_keys)
+        for name in prev_names - selected_names:
+            for key in keep_keys:
+                identity_ilist_file = get_identity_ilist_path(
+                    os.path.join(partition_dir, key, 'people'), name)
+                if os.path.exists(identity_ilist_file):
+                    os.remove(identity_ilist_file)
+        if commercials_changed:
+            split_interval_file(
+                commercials_file, video_partitions,
+                lambda key: os.path.join(
+                    partition_dir, key, 'commercials.iset.bin'),
+                0, keep_keys, create_empty=True)
+
+    # The ranges of any partition can change when videos are added or removed
+    num_videos = defaultdict(int)
+    for key in video_partitions.values():
+        num_videos[key] += 1
+    for key, ranges in video_id_ranges.items():
+        save_partition_manifest(os.path.join(partition_dir, key), key,
+                                num_videos[key], ranges)
+    print("Finished partition export in {:.3f} seconds".format(
+        time.time() - start_time))
+
+
+NO_COMMERCIALS_DIR = 'no-commercials'
+
+
+# Write no-commercials/faces.ilist.bin and no-commercials/people/, with the
+# time in commercials (in commercials.iset.bin) cut out of every interval, so
+# that the viewer does not have to intersect them at query time. Entries left
+# without intervals are dropped.
+def export_no_commercials(widget_data_dir, selected_identities):
+    start_time = time.time()
+    out_dir = os.path.join(widget_data_dir, NO_COMMERCIALS_DIR)
+    tmp_dir = out_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(os.path.join(tmp_dir, 'people'))
+
+    # Copied out of the file, which is closed after
+    with IntervalFileReader(
+            os.path.join(widget_data_dir, 'commercials.iset.bin'), 0
+    ) as reader:
+        commercials = {
+            video_id: merge_overlapping(x['start'].astype(np.int64),
+                                        x['end'].astype(np.int64))
+            for video_id, x in reader.items()}
+
+    dtype = get_interval_list_dtype(1)
+    ms_before = 0
+    ms_after = 0
+
+    def write_excluded(src_path, dst_path):
+        nonlocal ms_before, ms_after
+        with IntervalListMappingWriter(dst_path, 1) as writer:
+            if not os.path.exists(src_path):
+                return
+            for video_id, data in iter_interval_file_entries(src_path, 1):
+                intervals = np.frombuffer(data, dtype=dtype,
+                                          offset=U32_PAIR.size)
+                if video_id in commercials:
+                    result = subtract_intervals(
+                        intervals, *commercials[video_id])
+                else:
+                    result = intervals
+                ms_before += int((intervals['end'] - intervals['start']).sum())
+                ms_after += int((result['end'] - result['start']).sum())
+                if len(result) > 0:
+                    writer.write_array(video_id, result)
+
+    write_excluded(os.path.join(widget_data_dir, 'faces.ilist.bin'),
+                   os.path.join(tmp_dir, 'faces.ilist.bin'))
+    print('Faces outside of commercials: {:.1f} of {:.1f} hours'.format(
+        ms_after / 3600000, ms_before / 3600000))
+    for _, name in tqdm.tqdm(selected_identities):
+        write_excluded(
+            get_identity_ilist_path(
+                os.path.join(widget_data_dir, 'people'), name),
+            get_identity_ilist_path(os.path.join(tmp_dir, 'people'), name))
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    print("Finished no-commercials export in {:.3f} seconds".format(
+        time.time() - start_time))
+
+
+# Run fn(conn, session) as a telemetry stage
+def run_export_stage(telemetry, name, outputs, fn, conn, session):
+    with telemetry.stage(name, outputs=outputs):
+        fn(conn, session)
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('widget_dir', type=str)
     parser.add_argument('--db-name', type=str, default='tvnews')
     parser.add_argument('--db-user', type=str, default='admin')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Update the previous export in widget_dir, only '
+                             'exporting videos that changed since')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes for a full face export')
+    parser.add_argument('--max-open-files', type=int, default=MAX_OPEN_FILES,
+                        help='Max people files to keep open at once (per process)')
+    parser.add_argument('--copy-binary', action='store_true',
+                        help='Stream the faces with a binary COPY instead of '
+                             'a server side cursor')
+    parser.add_argument('--bbox-format', choices=BBOX_FORMATS, default='json',
+                        help='Write the face bboxes as one json file per '
+                             'video, or as a packed store (see face_bboxes.py)')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='Select identities by the screen time of their '
+                             'exported faces, during a full face export, '
+                             'instead of with a separate query')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume a full export that did not finish from '
+                             'its last checkpoint')
+    parser.add_argument('--concurrent-stages', action='store_true',
+                        help='Run the host, video and commercial exports and '
+                             'the identity selection on their own connections, '
+                             'alongside the face export')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Fetch, encode and write the faces in separate '
+                             'threads')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Merge the intervals of a video with the same '
+                             'payload that follow each other')
+    parser.add_argument('--coalesce-tolerance', type=int, default=0,
+                        help='Max gap in ms between intervals to merge, with '
+                             '--coalesce')
+    parser.add_argument('--exclude-commercials', action='store_true',
+                        help='Also write faces.ilist.bin and the people files '
+                             'without the time in commercials, to {}/'.format(
+                                 NO_COMMERCIALS_DIR))
+    parser.add_argument('--partition', action='store_true',
+                        help='Also split the interval files by year (by month '
+                             'for videos sampled at 1s) into {}/'.format(
+                                 PARTITION_DIR))
+    parser.add_argument('--since', type=str,
+                        help='Only export videos from this date (YYYY-MM-DD) '
+                             'on, to merge over a full export with '
+                             'merge_export.py')
+    parser.add_argument('--until', type=str,
+                        help='Only export videos before this date')
+    parser.add_argument('--channel', type=str, action='append',
+                        dest='channels',
+                        help='Only export videos of this channel (repeatable)')
+    parser.add_argument('--video-ids-file', type=str,
+                        help='Only export the videos with the ids in this '
+                             'file, one per line')
+    parser.add_argument('--identities-from', type=str,
+                        help='Widget dir of the full export a partial export '
+                             'is for, whose selected identities are used')
+    parser.add_argument('--metrics-file', type=str,
+                        help='Append the metrics of each stage to this file, '
+                             'as JSON lines (see telemetry.py)')
     return parser.parse_args()
 
 
-def main(widget_dir, db_name, db_user):
+def main(widget_dir, db_name, db_user, incremental, workers, max_open_files,
+         copy_binary, bbox_format, single_pass, resume, concurrent_stages,
+         pipelined, coalesce, coalesce_tolerance, exclude_commercials,
+         partition, since, until, channels, video_ids_file, identities_from,
+         metrics_file):
     start_time = time.time()
+    if resume and (incremental or workers > 1 or single_pass):
+        raise Exception('Only a single process full export can be resumed')
+    if incremental and single_pass:
+        raise Exception('An incremental export cannot select identities in a '
+                        'single pass')
+
+    filter_video_ids = None
+    if video_ids_file is not None:
+        with open(video_ids_file) as fp:
+            filter_video_ids = {int(x) for x in fp.read().split()}
+    video_filter = get_video_filter(since, until, channels, filter_video_ids)
+    if video_filter and (incremental or partition or exclude_commercials):
+        raise Exception('A partial export cannot be incremental, partitioned '
+                        'or exclude commercials (see merge_export.py)')
+    if identities_from is not None and (not video_filter or single_pass):
+        raise Exception('--identities-from is for partial exports')
+
+    if not coalesce:
+        coalesce_tolerance = None
+
+    telemetry = Telemetry(metrics_file)
+    total_metrics = telemetry.start_stage('total')
 
     password = os.getenv("POSTGRES_PASSWORD")
-    conn = psycopg2.connect(dbname=db_name, user=db_user,
-                            host='localhost', password=password)
+    conn_args = {
+        'dbname': db_name, 'user': db_user, 'host': 'localhost',
+        'password': password
+    }
+    conn = psycopg2.connect(**conn_args)
     session = get_db_session(db_user, password, db_name)
 
     os.makedirs(widget_dir, exist_ok=True)
 
-    export_hosts(conn, widget_dir)
-    export_videos(conn, widget_dir)
-    export_commercials(conn, session, widget_dir)
-    export_faces_and_identities(conn, session, widget_dir)
-
+    manifest = load_manifest(widget_dir) if incremental else None
+    checkpoint = None
+    if resume:
+        checkpoint = load_checkpoint(widget_dir)
+        if checkpoint is None:
+            print('No checkpoint to resume from, starting over')
+    else:
+        # The files it points into are about to be overwritten
+        remove_checkpoint(widget_dir)
+
+    if checkpoint is not None:
+        # The state at the start of the export that is being resumed
+        export_state = dict(checkpoint['export_state'])
+        export_state['video_ids'] = set(export_state['video_ids'])
+    else:
+        with telemetry.stage('export_state'):
+            export_state = get_export_state(
+                conn, manifest, video_filter, count_labels=incremental)
+
+    # A partial export for a full export has its identities, so that it can
+    # be merged into it
+    selected_identities = None
+    if identities_from is not None:
+        base_manifest = load_manifest(identities_from)
+        if base_manifest is None:
+            raise Exception('No manifest in {}'.format(identities_from))
+        selected_identities = [
+            tuple(x) for x in base_manifest['selected_identities']]
+
+    # These do not depend on each other or on the face export
+    small_exports = [
+        ('hosts', {'hosts': os.path.join(widget_dir, 'hosts.csv')},
+         lambda conn, session: export_hosts(conn, widget_dir)),
+        ('videos', {'videos': os.path.join(widget_dir, 'videos.json')},
+         lambda conn, session: export_videos(conn, widget_dir, video_filter)),
+    ]
+    commercial_export = (
+        'commercials',
+        {'commercials': os.path.join(widget_dir, 'commercials.iset.bin')},
+        lambda conn, session: export_commercials(
+            conn, session, widget_dir, video_filter))
+
+    reason = (check_incremental_export(manifest, export_state, bbox_format,
+                                       coalesce_tolerance, single_pass)
+              if incremental else None)
+    if incremental and reason is None:
+        prev_video_ids = set(manifest['video_ids'])
+        removed_video_ids = prev_video_ids - export_state['video_ids']
+        changed_video_ids = (
+            get_changed_video_ids(conn, manifest['watermarks'])
+            | (export_state['video_ids'] - prev_video_ids)
+        ) & export_state['video_ids']
+        print('Incremental export: {} changed and {} removed videos'.format(
+            len(changed_video_ids), len(removed_video_ids)))
+
+        if (
+            export_state['watermarks']['commercial'] != manifest['watermarks']['commercial']
+            or export_state['video_ids'] != prev_video_ids
+        ):
+            small_exports.append(commercial_export)
+    else:
+        if incremental:
+            print('Running a full export: {}'.format(reason))
+        small_exports.append(commercial_export)
+
+    if concurrent_stages:
+        small_export_executor = ThreadPoolExecutor(len(small_exports))
+        small_export_futures = [
+            small_export_executor.submit(
+                run_with_new_connection, conn_args,
+                functools.partial(run_export_stage, telemetry, name, outputs, fn))
+            for name, outputs, fn in small_exports]
+    else:
+        for name, outputs, fn in small_exports:
+            run_export_stage(telemetry, name, outputs, fn, conn, session)
+
+    if incremental and reason is None:
+        with telemetry.stage('faces') as metrics:
+            selection_start_time = time.time()
+            with metrics.timer('selected_identities'):
+                selected_identities, export_state['identity_screen_times'] = \
+                    get_incremental_selected_identities(
+                        conn, session, manifest, export_state,
+                        changed_video_ids, removed_video_ids)
+            print("Fetched {} selected identities in {:.3f} seconds".format(
+                len(selected_identities), time.time() - selection_start_time))
+            export_faces_and_identities_incremental(
+                conn, session, widget_dir, changed_video_ids, removed_video_ids,
+                manifest['selected_identities'], selected_identities,
+                max_open_files=max_open_files,
+                copy_binary=copy_binary, bbox_format=bbox_format,
+                metrics=metrics, pipelined=pipelined,
+                coalesce_tolerance=coalesce_tolerance)
+    else:
+        with telemetry.stage('faces') as metrics:
+            if workers > 1:
+                selected_identities = export_faces_and_identities_parallel(
+                    conn_args, session, widget_dir, workers,
+                    max_open_files=max_open_files, copy_binary=copy_binary,
+                    bbox_format=bbox_format, single_pass=single_pass,
+                    metrics=metrics, pipelined=pipelined,
+                    coalesce_tolerance=coalesce_tolerance,
+                    video_filter=video_filter,
+                    selected_identities=selected_identities)
+            else:
+                selected_identities = export_faces_and_identities(
+                    conn, session, widget_dir, max_open_files=max_open_files,
+                    copy_binary=copy_binary, bbox_format=bbox_format,
+                    single_pass=single_pass,
+                    checkpoint_state={'export_state': {
+                        **export_state,
+                        'video_ids': sorted(export_state['video_ids'])
+                    }},
+                    resume_checkpoint=checkpoint, metrics=metrics,
+                    conn_args=conn_args if concurrent_stages else None,
+                    pipelined=pipelined, coalesce_tolerance=coalesce_tolerance,
+                    video_filter=video_filter,
+                    selected_identities=selected_identities)
+
+    if concurrent_stages:
+        for future in small_export_futures:
+            future.result()
+        small_export_executor.shutdown()
+
+    if exclude_commercials:
+        with telemetry.stage('no_commercials', outputs={
+                'no_commercials': os.path.join(widget_dir, NO_COMMERCIALS_DIR)}):
+            export_no_commercials(widget_dir, selected_identities)
+
+    if partition:
+        with telemetry.stage('partitions', outputs={
+                'partitions': os.path.join(widget_dir, PARTITION_DIR)}):
+            if incremental and reason is None:
+                export_partitions(
+                    conn, widget_dir, selected_identities,
+                    changed_video_ids=changed_video_ids | removed_video_ids,
+                    prev_selected_identities=manifest['selected_identities'],
+                    commercials_changed=commercial_export in small_exports)
+            else:
+                export_partitions(conn, widget_dir, selected_identities)
+
+    partial = None
+    if video_filter:
+        partial = {
+            'since': since, 'until': until, 'channels': channels,
+            'video_ids_file': video_ids_file,
+            'video_ids': sorted(get_filtered_video_ids(conn, video_filter))
+        }
+    save_manifest(widget_dir, export_state, selected_identities, bbox_format,
+                  coalesce_tolerance, single_pass, partial)
+    remove_checkpoint(widget_dir)
+
+    telemetry.end_stage(total_metrics)
+    telemetry.close()
     print("Total time to export: {:3f} seconds".format(time.time() - start_time))
 
 
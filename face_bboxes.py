@@ -0,0 +1,360 @@
+"""
+Packed store for the face bboxes, an alternative to one face-bboxes/<video>.json
+file per video (see export.py --bbox-format).
+
+A store at <path> is three files:
+
+<path>.bin: fixed width face records (FACE_RECORD_DTYPE), grouped by video
+<path>.index.bin: one VIDEO_INDEX_DTYPE entry per video, sorted by video id,
+    with the offset (in records) and number of faces of the video
+<path>.identities.json: the names of the identities that appear in the store
+
+Times are in milliseconds (multiples of 10) and bbox coordinates in hundredths,
+which is the precision of the JSON files, so FaceBboxReader.get returns exactly
+what the JSON file of the video contains.
+
+The export passes the faces of a video to the writers as FaceColumns, numpy
+columns that are rounded and encoded (to records or to the JSON of the video)
+a whole video at a time.
+"""
+
+import json
+import os
+from typing import Dict, Iterable, List, Set, Tuple
+import numpy as np
+
+
+FACE_RECORD_DTYPE = np.dtype([
+    ('start_ms', '<u4'),
+    ('end_ms', '<u4'),
+    # x1, y1, x2, y2 in hundredths
+    ('bbox', '<i2', (4,)),
+    # 'm', 'f' or 'u'
+    ('gender', 'S1'),
+    ('identity_id', '<i4'),
+])
+
+VIDEO_INDEX_DTYPE = np.dtype([
+    ('video_id', '<u4'),
+    ('offset', '<u8'),
+    ('count', '<u4'),
+])
+
+NO_IDENTITY = -1
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def get_record_path(path: str) -> str:
+    return path + '.bin'
+
+
+def get_index_path(path: str) -> str:
+    return path + '.index.bin'
+
+
+def get_identities_path(path: str) -> str:
+    return path + '.identities.json'
+
+
+def get_store_paths(path: str) -> List[str]:
+    return [get_record_path(path), get_index_path(path),
+            get_identities_path(path)]
+
+
+def _load_array(path: str, dtype: np.dtype, mmap: bool = True) -> np.ndarray:
+    # np.memmap cannot map an empty file
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode='r')
+    return np.fromfile(path, dtype=dtype)
+
+
+def _load_identities(path: str) -> Dict[int, str]:
+    identities_path = get_identities_path(path)
+    if not os.path.exists(identities_path):
+        return {}
+    with open(identities_path) as fp:
+        return {int(k): v for k, v in json.load(fp).items()}
+
+
+def _save_identities(path: str, identity_id_to_name: Dict[int, str]) -> None:
+    with open(get_identities_path(path), 'w') as fp:
+        json.dump({str(k): v for k, v in sorted(identity_id_to_name.items())}, fp)
+
+
+def _to_hundredths(x: float) -> int:
+    return int(round(x * 100))
+
+
+def to_hundredths(x: np.ndarray) -> np.ndarray:
+    """round(v, 2) * 100 of each value, as integers"""
+    y = x * 100
+    k = np.rint(y)
+    # y is inexact, so values close to a tie are rounded by Python, which
+    # rounds the exact decimal value
+    near_tie = np.abs(y - np.floor(y) - 0.5) < 1e-6
+    if np.any(near_tie):
+        k[near_tie] = [round(round(v, 2) * 100) for v in x[near_tie].tolist()]
+    return k.astype(np.int64)
+
+
+def _format_hundredths(k: int) -> str:
+    # Same as repr(k / 100), for the JSON files
+    if k < 0:
+        return '-' + _format_hundredths(-k)
+    q, r = divmod(k, 100)
+    if r == 0:
+        return '{}.0'.format(q)
+    if r % 10 == 0:
+        return '{}.{}'.format(q, r // 10)
+    return '{}.{:02d}'.format(q, r)
+
+
+def _format_rounded(x: np.ndarray) -> List[str]:
+    """repr(round(v, 2)) of each value"""
+    k = to_hundredths(x)
+    values, inverse = np.unique(k, return_inverse=True)
+    strs = np.array([_format_hundredths(v) for v in values.tolist()],
+                    dtype=object)[inverse.reshape(-1)]
+    # Values that round to -0.0
+    strs[(k == 0) & np.signbit(x)] = '-0.0'
+    return strs.tolist()
+
+
+class FaceColumns(object):
+    """
+    The faces of a video as numpy columns: start_ms and end_ms, bbox (x1, y1,
+    x2, y2), gender ('m', 'f' or 'u') and identity_id (NO_IDENTITY if none).
+    Times and bboxes are rounded to hundredths (of seconds) when encoded,
+    like the values in the JSON files.
+    """
+
+    def __init__(self, start_ms: np.ndarray, end_ms: np.ndarray,
+                 bbox: np.ndarray, gender: np.ndarray, identity_id: np.ndarray):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.bbox = bbox
+        self.gender = gender
+        self.identity_id = identity_id
+
+    def __len__(self) -> int:
+        return len(self.start_ms)
+
+    def to_records(self) -> np.ndarray:
+        records = np.zeros(len(self), dtype=FACE_RECORD_DTYPE)
+        records['start_ms'] = to_hundredths(self.start_ms / 1000) * 10
+        records['end_ms'] = to_hundredths(self.end_ms / 1000) * 10
+        bbox = to_hundredths(self.bbox)
+        assert np.all(np.abs(bbox) <= np.iinfo(np.int16).max), \
+            'bbox out of range'
+        records['bbox'] = bbox
+        records['gender'] = self.gender
+        records['identity_id'] = self.identity_id
+        return records
+
+    def to_json(self, identity_id_to_name: Dict[int, str]) -> str:
+        """Same as json.dumps of the dict in face-bboxes/<video_id>.json"""
+        starts = _format_rounded(self.start_ms / 1000)
+        ends = _format_rounded(self.end_ms / 1000)
+        x1, y1, x2, y2 = (_format_rounded(self.bbox[:, i]) for i in range(4))
+        identity_ids = self.identity_id.tolist()
+        faces = [
+            '{{"g": "{}", "t": [{}, {}], "b": [{}, {}, {}, {}]{}}}'.format(
+                g, t0, t1, b0, b1, b2, b3,
+                '' if i == NO_IDENTITY else ', "i": {}'.format(i))
+            for g, t0, t1, b0, b1, b2, b3, i in zip(
+                self.gender.tolist(), starts, ends, x1, y1, x2, y2,
+                identity_ids)
+        ]
+        ids = [[identity_id_to_name.get(i, ''), i]
+               for i in sorted(set(identity_ids) - {NO_IDENTITY})]
+        return '{{"faces": [{}], "ids": {}}}'.format(
+            ', '.join(faces), json.dumps(ids))
+
+
+class FaceBboxStoreWriter(object):
+    """Writes the faces of each video, in increasing video id order, in the
+    same dict format as the JSON files (see export.py)"""
+
+    def __init__(self, path: str, identity_id_to_name: Dict[int, str],
+                 resume_state: dict = None):
+        self._path = path
+        self._identity_id_to_name = identity_id_to_name
+        if resume_state is None:
+            self._fp = open(get_record_path(path), 'wb',
+                            buffering=WRITE_BUFFER_SIZE)
+            self._index = []
+            self._offset = 0
+            self._identity_ids = set()
+        else:
+            # Continue from the state returned by checkpoint
+            index = _load_array(get_index_path(path), VIDEO_INDEX_DTYPE,
+                                mmap=False)[:resume_state['videos']]
+            assert len(index) == resume_state['videos'], 'Truncated index'
+            self._index = [tuple(x) for x in index.tolist()]
+            self._offset = resume_state['records']
+            self._identity_ids = set(_load_identities(path))
+            self._fp = open(get_record_path(path), 'r+b',
+                            buffering=WRITE_BUFFER_SIZE)
+            self._fp.truncate(self._offset * FACE_RECORD_DTYPE.itemsize)
+            self._fp.seek(0, os.SEEK_END)
+        # Of the record file
+        self.bytes_written = self._offset * FACE_RECORD_DTYPE.itemsize
+
+    def __enter__(self) -> 'FaceBboxStoreWriter':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def write(self, video_id: int, faces) -> None:
+        """Write the faces of a video, as FaceColumns or as a list of dicts"""
+        if isinstance(faces, FaceColumns):
+            self.write_records(video_id, faces.to_records())
+            return
+        self.write_records(video_id, np.array([
+            (
+                _to_hundredths(f['t'][0]) * 10,
+                _to_hundredths(f['t'][1]) * 10,
+                [_to_hundredths(x) for x in f['b']],
+                f['g'],
+                f.get('i', NO_IDENTITY)
+            ) for f in faces
+        ], dtype=FACE_RECORD_DTYPE))
+
+    def write_records(self, video_id: int, records: np.ndarray) -> None:
+        assert len(self._index) == 0 or self._index[-1][0] < video_id, \
+            'Videos must be written in increasing order'
+        self._identity_ids.update(np.unique(
+            records['identity_id'][records['identity_id'] != NO_IDENTITY]
+        ).tolist())
+        self._fp.write(records.tobytes())
+        self._index.append((video_id, self._offset, len(records)))
+        self._offset += len(records)
+        self.bytes_written += records.nbytes
+
+    def _save_index(self) -> None:
+        np.array(self._index, dtype=VIDEO_INDEX_DTYPE).tofile(
+            get_index_path(self._path))
+        _save_identities(self._path, {
+            i: self._identity_id_to_name.get(i, '') for i in self._identity_ids})
+
+    def checkpoint(self) -> dict:
+        """Flush the records and save the index so far. Returns the state to
+        pass as resume_state to continue from here."""
+        self._fp.flush()
+        self._save_index()
+        return {'videos': len(self._index), 'records': self._offset}
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            self._save_index()
+
+
+# Write the videos of each of sources to path, skipping the video ids in its
+# drop set. Sources are (path, drop_ids) and must not have videos in common
+# (after dropping).
+def _merge_stores(path: str, sources: List[Tuple[str, Set[int]]]) -> None:
+    entries = []
+    identity_id_to_name = {}
+    for i, (src_path, drop_ids) in enumerate(sources):
+        index = _load_array(get_index_path(src_path), VIDEO_INDEX_DTYPE,
+                            mmap=False)
+        keep = ~np.isin(index['video_id'], list(drop_ids))
+        entries.extend((int(v), i, int(o), int(c))
+                       for v, o, c in index[keep].tolist())
+        identity_id_to_name.update(_load_identities(src_path))
+    entries.sort()
+    for a, b in zip(entries, entries[1:]):
+        assert a[0] != b[0], 'Duplicate video id: {}'.format(a[0])
+
+    records = [_load_array(get_record_path(src_path), FACE_RECORD_DTYPE)
+               for src_path, _ in sources]
+    tmp_path = path + '.tmp'
+    new_index = np.zeros(len(entries), dtype=VIDEO_INDEX_DTYPE)
+    identity_ids = set()
+    offset = 0
+    with open(get_record_path(tmp_path), 'wb', buffering=WRITE_BUFFER_SIZE) as fp:
+        for j, (video_id, i, src_offset, count) in enumerate(entries):
+            video_records = records[i][src_offset:src_offset + count]
+            fp.write(video_records.tobytes())
+            identity_ids.update(
+                video_records['identity_id'][
+                    video_records['identity_id'] != NO_IDENTITY].tolist())
+            new_index[j] = (video_id, offset, count)
+            offset += count
+    new_index.tofile(get_index_path(tmp_path))
+    _save_identities(tmp_path, {
+        i: identity_id_to_name.get(i, '') for i in identity_ids})
+    del records
+
+    for src, dst in zip(get_store_paths(tmp_path), get_store_paths(path)):
+        os.replace(src, dst)
+
+
+# Concatenate stores with disjoint videos (e.g., from a sharded export)
+def concat_face_bbox_stores(path: str, src_paths: Iterable[str]) -> None:
+    _merge_stores(path, [(x, set()) for x in src_paths])
+
+
+# Replace the videos in drop_ids of the store at path with the videos of the
+# store at delta_path (the same approach as export.splice_interval_file)
+def splice_face_bbox_store(path: str, delta_path: str, drop_ids: Set[int]) -> None:
+    _merge_stores(path, [(path, drop_ids), (delta_path, set())])
+
+
+class FaceBboxReader(object):
+    """Memory maps a store and returns the faces of a video in the format of
+    the face-bboxes/<video>.json files"""
+
+    def __init__(self, path: str):
+        self._records = _load_array(get_record_path(path), FACE_RECORD_DTYPE)
+        self._index = _load_array(get_index_path(path), VIDEO_INDEX_DTYPE)
+        self._identity_id_to_name = _load_identities(path)
+
+    def __contains__(self, video_id: int) -> bool:
+        return self._find(video_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def video_ids(self) -> np.ndarray:
+        return np.asarray(self._index['video_id'])
+
+    def _find(self, video_id: int):
+        i = np.searchsorted(self._index['video_id'], video_id)
+        if i < len(self._index) and self._index['video_id'][i] == video_id:
+            return self._index[i]
+        return None
+
+    def get_records(self, video_id: int) -> np.ndarray:
+        """The raw FACE_RECORD_DTYPE records of a video"""
+        entry = self._find(video_id)
+        if entry is None:
+            raise KeyError(video_id)
+        offset = int(entry['offset'])
+        return self._records[offset:offset + int(entry['count'])]
+
+    def get(self, video_id: int) -> dict:
+        """Same as json.load of face-bboxes/<video_id>.json"""
+        records = self.get_records(video_id)
+        faces = []
+        for start_ms, end_ms, bbox, gender, identity_id in records.tolist():
+            face = {
+                'g': gender.decode(),
+                't': [round(start_ms / 1000, 2), round(end_ms / 1000, 2)],
+                'b': [round(x / 100, 2) for x in bbox],
+            }
+            if identity_id != NO_IDENTITY:
+                face['i'] = identity_id
+            faces.append(face)
+        identity_ids = sorted({f['i'] for f in faces if 'i' in f})
+        return {
+            'faces': faces,
+            'ids': [[self._identity_id_to_name.get(i, ''), i]
+                    for i in identity_ids]
+        }
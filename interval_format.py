@@ -0,0 +1,27 @@
+"""
+Layout of the intervals in the interval files written by export.py and read
+by interval_reader.py. An interval is a u32 start and a u32 end (both in ms)
+and, in an ilist, a payload of 1, 2, 4 or 8 bytes, all little-endian.
+"""
+
+import numpy as np
+
+
+PAYLOAD_DTYPES = {1: '<u1', 2: '<u2', 4: '<u4', 8: '<u8'}
+
+INTERVAL_SET_DTYPE = np.dtype([('start', '<u4'), ('end', '<u4')])
+
+
+def get_interval_list_dtype(payload_len: int) -> np.dtype:
+    assert payload_len in PAYLOAD_DTYPES, \
+        'Unsupported payload length: {}'.format(payload_len)
+    return np.dtype([
+        ('start', '<u4'), ('end', '<u4'),
+        ('payload', PAYLOAD_DTYPES[payload_len])])
+
+
+def get_interval_dtype(payload_len: int) -> np.dtype:
+    """Interval dtype of an ilist, or of an iset with a payload_len of 0"""
+    if payload_len == 0:
+        return INTERVAL_SET_DTYPE
+    return get_interval_list_dtype(payload_len)
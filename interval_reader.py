@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""
+Read the interval files written by export.py (faces.ilist.bin,
+people/*.ilist.bin and commercials.iset.bin) without the viewer.
+
+A file is a sequence of entries, one per video, sorted by video id: a u32
+video id, a u32 interval count, then the intervals (u32 start, u32 end and,
+in an ilist, a payload). IntervalFileReader memory maps a file and indexes
+the entries by video id, so the intervals of a video are a zero-copy numpy
+view into the file.
+
+Run as a script to check the files of an export:
+
+    python interval_reader.py <widget_dir>
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+from typing import Iterator, Tuple
+import numpy as np
+
+from interval_format import get_interval_dtype
+
+
+U32_PAIR = struct.Struct('<II')
+
+INDEX_DTYPE = np.dtype([
+    ('id', '<u4'),
+    # Of the first interval, in bytes
+    ('offset', '<u8'),
+    ('count', '<u4'),
+])
+
+
+def get_index_cache_path(path: str) -> str:
+    return path + '.index.npz'
+
+
+class IntervalFileReader(object):
+    """
+    Memory maps an ilist or iset file (payload_len of 0). The index of the
+    entries is built with a scan of the entry headers, or, with cache_index,
+    loaded from (and saved to) a file next to it, which is rebuilt if the
+    file has changed since.
+    """
+
+    def __init__(self, path: str, payload_len: int, cache_index: bool = False):
+        self.path = path
+        self.dtype = get_interval_dtype(payload_len)
+        self._fp = open(path, 'rb')
+        self._size = os.fstat(self._fp.fileno()).st_size
+        # A zero length file cannot be mapped
+        self._buf = (mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+                     if self._size > 0 else b'')
+
+        self.index = None
+        if cache_index:
+            self.index = self._load_index_cache()
+        if self.index is None:
+            self.index = self._build_index()
+            if cache_index:
+                self._save_index_cache()
+
+    def __enter__(self) -> 'IntervalFileReader':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, id_: int) -> bool:
+        return self._find(id_) is not None
+
+    def __iter__(self) -> Iterator[Tuple[int, np.ndarray]]:
+        return self.items()
+
+    def ids(self) -> np.ndarray:
+        return self.index['id']
+
+    def _build_index(self) -> np.ndarray:
+        entries = []
+        offset = 0
+        while offset < self._size:
+            assert offset + U32_PAIR.size <= self._size, \
+                'Truncated file: {}'.format(self.path)
+            id_, n = U32_PAIR.unpack_from(self._buf, offset)
+            offset += U32_PAIR.size
+            entries.append((id_, offset, n))
+            offset += n * self.dtype.itemsize
+        assert offset == self._size, 'Truncated file: {}'.format(self.path)
+        return np.array(entries, dtype=INDEX_DTYPE)
+
+    def _load_index_cache(self):
+        cache_path = get_index_cache_path(self.path)
+        if not os.path.exists(cache_path):
+            return None
+        with np.load(cache_path) as cache:
+            if (
+                int(cache['size']) != self._size
+                or int(cache['mtime_ns']) != os.stat(self.path).st_mtime_ns
+            ):
+                return None
+            return cache['index']
+
+    def _save_index_cache(self) -> None:
+        np.savez(get_index_cache_path(self.path), index=self.index,
+                 size=np.uint64(self._size),
+                 mtime_ns=np.int64(os.stat(self.path).st_mtime_ns))
+
+    def _find(self, id_: int):
+        # Entries are sorted by id in files written by export.py
+        i = np.searchsorted(self.index['id'], id_)
+        if i < len(self.index) and self.index['id'][i] == id_:
+            return i
+        return None
+
+    def _view(self, i: int) -> np.ndarray:
+        return np.frombuffer(self._buf, dtype=self.dtype,
+                             count=int(self.index['count'][i]),
+                             offset=int(self.index['offset'][i]))
+
+    def get(self, id_: int) -> np.ndarray:
+        """Intervals of a video, as a read-only view into the file"""
+        i = self._find(id_)
+        if i is None:
+            raise KeyError(id_)
+        return self._view(i)
+
+    def items(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """Yield (video id, intervals) for every entry, in file order"""
+        for i, id_ in enumerate(self.index['id'].tolist()):
+            yield id_, self._view(i)
+
+    def close(self) -> None:
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        self._buf = b''
+        self._fp.close()
+
+
+# Returns a list of problems with an interval file: ids out of order,
+# empty or invalid intervals and, given valid_ids, unexpected ids
+def check_interval_file(reader: IntervalFileReader, valid_ids=None):
+    problems = []
+    ids = reader.ids()
+    if np.any(ids[1:] <= ids[:-1]):
+        problems.append('ids are not strictly increasing')
+    if np.any(reader.index['count'] == 0):
+        problems.append('empty entries')
+    if valid_ids is not None:
+        unexpected = np.setdiff1d(ids, valid_ids)
+        if len(unexpected) > 0:
+            problems.append('{} unexpected ids, e.g., {}'.format(
+                len(unexpected), unexpected[0]))
+    for id_, intervals in reader.items():
+        if np.any(intervals['end'] <= intervals['start']):
+            problems.append('invalid interval in {}'.format(id_))
+            break
+        if np.any(intervals['start'][1:] < intervals['start'][:-1]):
+            problems.append('unsorted intervals in {}'.format(id_))
+            break
+    return problems
+
+
+# Returns every (id, interval) in a file as an opaque key, to compare intervals
+# across files
+def get_interval_keys(reader: IntervalFileReader) -> np.ndarray:
+    keys = np.empty(reader.index['count'].sum(), dtype=[
+        ('id', '>u4'), ('interval', 'V{}'.format(reader.dtype.itemsize))])
+    keys['id'] = np.repeat(reader.ids(), reader.index['count'])
+    if len(keys) > 0:
+        keys['interval'] = np.concatenate(
+            [x for _, x in reader.items()]).view(keys.dtype['interval'])
+    return keys.view('V{}'.format(keys.dtype.itemsize))
+
+
+# Returns a list of problems with the people file of an identity: every
+# interval in it must also be in faces.ilist.bin, given as the sorted
+# get_interval_keys of faces.ilist.bin
+def check_identity_file(reader: IntervalFileReader, face_keys: np.ndarray):
+    keys = get_interval_keys(reader)
+    if len(keys) == 0:
+        return []
+    i = np.minimum(np.searchsorted(face_keys, keys), len(face_keys) - 1)
+    missing = np.nonzero(face_keys[i] != keys)[0]
+    if len(missing) > 0:
+        video_id = np.repeat(reader.ids(), reader.index['count'])[missing[0]]
+        return ['{} intervals are not in faces, e.g., in video {}'.format(
+            len(missing), video_id)]
+    return []
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('widget_dir', type=str)
+    parser.add_argument('--cache-index', action='store_true',
+                        help='Save the indexes next to the files')
+    return parser.parse_args()
+
+
+def main(widget_dir, cache_index):
+    with open(os.path.join(widget_dir, 'videos.json')) as fp:
+        video_ids = np.array(sorted(v[0] for v in json.load(fp)))
+
+    # Coalesced intervals (export.py --coalesce) of an identity are not
+    # intervals of faces.ilist.bin
+    coalesced = False
+    manifest_file = os.path.join(widget_dir, 'export-manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as fp:
+            coalesced = json.load(fp).get('coalesce_tolerance') is not None
+
+    num_problems = 0
+
+    def report(name, problems):
+        nonlocal num_problems
+        num_problems += len(problems)
+        for problem in problems:
+            print('{}: {}'.format(name, problem))
+
+    with IntervalFileReader(
+            os.path.join(widget_dir, 'commercials.iset.bin'), 0, cache_index
+    ) as reader:
+        report('commercials.iset.bin', check_interval_file(reader, video_ids))
+        print('commercials.iset.bin: {} videos, {} intervals'.format(
+            len(reader), reader.index['count'].sum()))
+
+    with IntervalFileReader(
+            os.path.join(widget_dir, 'faces.ilist.bin'), 1, cache_index
+    ) as faces_reader:
+        report('faces.ilist.bin', check_interval_file(faces_reader, video_ids))
+        print('faces.ilist.bin: {} videos, {} intervals'.format(
+            len(faces_reader), faces_reader.index['count'].sum()))
+
+        face_keys = np.sort(get_interval_keys(faces_reader))
+        people_dir = os.path.join(widget_dir, 'people')
+        people_files = sorted(x for x in os.listdir(people_dir)
+                              if x.endswith('.ilist.bin'))
+        for name in people_files:
+            try:
+                reader = IntervalFileReader(
+                    os.path.join(people_dir, name), 1, cache_index)
+            except AssertionError as e:
+                report(name, [str(e)])
+                continue
+            with reader:
+                report(name, check_interval_file(reader, video_ids)
+                       + ([] if coalesced
+                          else check_identity_file(reader, face_keys)))
+        print('people: {} files'.format(len(people_files)))
+
+    print('{} problems'.format(num_problems))
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Merge a partial export (export.py with --since/--until, --channel or
+--video-ids-file, written to a staging directory) over a full export in
+widget_dir, e.g., to re-export a month or a channel after a fix without
+re-running the whole export.
+
+The entries of every video in the filter of the partial export are replaced
+by its own in faces.ilist.bin, commercials.iset.bin, the people files, the
+face bboxes and videos.json; videos in the filter that are no longer
+exported (e.g., marked as corrupt) are removed. The partial export must have
+the selected identities of the full export (see export.py --identities-from).
+The no-commercials files and the partitions of widget_dir, if it has them,
+are updated too.
+
+The manifest of widget_dir keeps its watermarks, so the next incremental
+export still picks up everything that changed since the full export.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+import psycopg2
+
+from export import (
+    FACE_BBOX_NAME, NO_COMMERCIALS_DIR, PARTITION_DIR, get_identity_ilist_path,
+    splice_interval_file, export_no_commercials, export_partitions,
+    load_manifest, save_manifest)
+from face_bboxes import splice_face_bbox_store
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('staging_dir', type=str,
+                        help='Output of a partial export')
+    parser.add_argument('widget_dir', type=str,
+                        help='Output of a full export, updated in place')
+    parser.add_argument('--db-name', type=str, default='tvnews')
+    parser.add_argument('--db-user', type=str, default='admin')
+    return parser.parse_args()
+
+
+# Returns a reason why the partial export cannot be merged, or None if it can
+def check_merge(staging_manifest, manifest):
+    if staging_manifest is None or staging_manifest.get('partial') is None:
+        return 'the staging dir is not a partial export'
+    if manifest is None:
+        return 'no manifest in the widget dir'
+    if manifest.get('partial') is not None:
+        return 'the widget dir is a partial export'
+    for key, default in [('bbox_format', 'json'), ('coalesce_tolerance', None)]:
+        if staging_manifest.get(key, default) != manifest.get(key, default):
+            return 'the exports have a different {}'.format(key)
+    if staging_manifest['selected_identities'] != manifest['selected_identities']:
+        return 'the exports have different selected identities'
+    return None
+
+
+def merge_face_bboxes(staging_dir, widget_dir, bbox_format, drop_ids):
+    face_bbox_path = os.path.join(widget_dir, FACE_BBOX_NAME)
+    staging_face_bbox_path = os.path.join(staging_dir, FACE_BBOX_NAME)
+    if bbox_format == 'packed':
+        splice_face_bbox_store(face_bbox_path, staging_face_bbox_path, drop_ids)
+        return
+
+    for video_id in drop_ids:
+        face_bbox_file = os.path.join(face_bbox_path, '{}.json'.format(video_id))
+        if os.path.exists(face_bbox_file):
+            os.remove(face_bbox_file)
+    os.makedirs(face_bbox_path, exist_ok=True)
+    for name in os.listdir(staging_face_bbox_path):
+        shutil.copyfile(os.path.join(staging_face_bbox_path, name),
+                        os.path.join(face_bbox_path, name))
+
+
+def merge_videos(staging_dir, widget_dir, drop_ids):
+    video_file = os.path.join(widget_dir, 'videos.json')
+    with open(video_file) as fp:
+        videos = [v for v in json.load(fp) if v[0] not in drop_ids]
+    with open(os.path.join(staging_dir, 'videos.json')) as fp:
+        videos.extend(json.load(fp))
+
+    tmp_file = video_file + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump(videos, fp)
+    os.replace(tmp_file, video_file)
+
+
+def main(staging_dir, widget_dir, db_name, db_user):
+    start_time = time.time()
+    staging_manifest = load_manifest(staging_dir)
+    manifest = load_manifest(widget_dir)
+    reason = check_merge(staging_manifest, manifest)
+    if reason is not None:
+        raise Exception('Cannot merge: {}'.format(reason))
+
+    selected_identities = [tuple(x) for x in manifest['selected_identities']]
+    staging_video_ids = set(staging_manifest['video_ids'])
+    drop_ids = set(staging_manifest['partial']['video_ids']) | staging_video_ids
+    print('Merging {} videos ({} exported)'.format(
+        len(drop_ids), len(staging_video_ids)))
+
+    splice_interval_file(
+        os.path.join(widget_dir, 'faces.ilist.bin'),
+        os.path.join(staging_dir, 'faces.ilist.bin'), drop_ids, 1)
+    splice_interval_file(
+        os.path.join(widget_dir, 'commercials.iset.bin'),
+        os.path.join(staging_dir, 'commercials.iset.bin'), drop_ids, 0)
+    for _, name in selected_identities:
+        splice_interval_file(
+            get_identity_ilist_path(os.path.join(widget_dir, 'people'), name),
+            get_identity_ilist_path(os.path.join(staging_dir, 'people'), name),
+            drop_ids, 1)
+    merge_face_bboxes(staging_dir, widget_dir,
+                      manifest.get('bbox_format', 'json'), drop_ids)
+    merge_videos(staging_dir, widget_dir, drop_ids)
+    shutil.copyfile(os.path.join(staging_dir, 'hosts.csv'),
+                    os.path.join(widget_dir, 'hosts.csv'))
+    print("Merged the partial export in {:.3f} seconds".format(
+        time.time() - start_time))
+
+    if os.path.exists(os.path.join(widget_dir, NO_COMMERCIALS_DIR)):
+        export_no_commercials(widget_dir, selected_identities)
+    if os.path.exists(os.path.join(widget_dir, PARTITION_DIR)):
+        conn = psycopg2.connect(
+            dbname=db_name, user=db_user, host='localhost',
+            password=os.getenv("POSTGRES_PASSWORD"))
+        export_partitions(conn, widget_dir, selected_identities,
+                          changed_video_ids=drop_ids,
+                          prev_selected_identities=selected_identities,
+                          commercials_changed=False)
+        conn.close()
+
+    # The identity screen times are not kept, as the merged videos change them
+    save_manifest(widget_dir, {
+        'watermarks': manifest['watermarks'],
+        'label_counts': manifest['label_counts'],
+        'video_ids': (set(manifest['video_ids']) - drop_ids) | staging_video_ids
+    }, selected_identities, manifest.get('bbox_format', 'json'),
+        manifest.get('coalesce_tolerance'), manifest.get('single_pass', False))
+    print("Total time to merge: {:.3f} seconds".format(time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Create the indexes declared in schema.py that are missing from the database.
+
+The indexes are built with CREATE INDEX CONCURRENTLY, so the database stays
+writable while they build. A concurrent build that fails leaves an invalid
+index behind, which is dropped and rebuilt on the next run. Indexes that
+schema.py no longer declares (RETIRED_INDEXES) are dropped.
+"""
+
+import argparse
+import os
+import re
+import time
+import psycopg2
+import sqlalchemy
+from sqlalchemy.schema import CreateIndex
+
+import schema
+
+# Indexes that were declared in schema.py, but were not used by the queries
+# they were meant for, and slowed down the writes to the face tables
+RETIRED_INDEXES = [
+    'ix_face_identity_labeler_id_face_id_score',
+    'ix_face_identity_identity_id_labeler_id',
+    'ix_face_gender_labeler_id_face_id',
+]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the statements without running them')
+    parser.add_argument('--db-name', type=str, default='tvnews')
+    parser.add_argument('--db-user', type=str, default='admin')
+    return parser.parse_args()
+
+
+def get_invalid_indexes(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT index_class.relname
+        FROM pg_index
+        INNER JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+        WHERE NOT pg_index.indisvalid
+    """)
+    return {x[0] for x in cur.fetchall()}
+
+
+def get_missing_indexes(engine, invalid_indexes):
+    inspector = sqlalchemy.inspect(engine)
+    table_names = set(inspector.get_table_names())
+    for table in schema.Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            print('Skipping missing table: {}'.format(table.name))
+            continue
+        existing = {x['name'] for x in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            if index.name not in existing or index.name in invalid_indexes:
+                yield index
+
+
+def get_create_index_sql(engine, index):
+    sql = str(CreateIndex(index).compile(dialect=engine.dialect))
+    return re.sub(r'^CREATE (UNIQUE )?INDEX',
+                  r'CREATE \1INDEX CONCURRENTLY IF NOT EXISTS', sql)
+
+
+def main(dry_run, db_name, db_user):
+    password = os.getenv('POSTGRES_PASSWORD')
+    engine = sqlalchemy.create_engine(
+        'postgresql://{}:{}@localhost/{}'.format(db_user, password, db_name))
+    conn = psycopg2.connect(dbname=db_name, user=db_user,
+                            host='localhost', password=password)
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    for name in RETIRED_INDEXES:
+        sql = 'DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name)
+        print(sql)
+        if not dry_run:
+            cur.execute(sql)
+
+    invalid_indexes = get_invalid_indexes(conn)
+    analyze_tables = set()
+    for index in get_missing_indexes(engine, invalid_indexes):
+        statements = []
+        if index.name in invalid_indexes:
+            statements.append('DROP INDEX CONCURRENTLY {}'.format(index.name))
+        statements.append(get_create_index_sql(engine, index))
+
+        for sql in statements:
+            print(sql)
+            if not dry_run:
+                start_time = time.time()
+                cur.execute(sql)
+                print('Finished in {:.3f} seconds'.format(
+                    time.time() - start_time))
+        analyze_tables.add(index.table.name)
+
+    # Refresh the planner statistics for the tables that were indexed
+    for table in sorted(analyze_tables):
+        print('ANALYZE {}'.format(table))
+        if not dry_run:
+            cur.execute('ANALYZE {}'.format(table))
+    print('Done!')
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Compare the row sources for the big face query in export.py on a database
+populated by synthetic_db.py:
+
+cursor: the server side cursor, one Python tuple per row, turned into
+    batches of numpy columns (what export.py feeds to
+    write_faces_and_identities)
+copy-batches: binary COPY decoded into numpy columns (what export.py
+    --copy-binary feeds to write_faces_and_identities)
+
+The columns from both sources are checked to be identical.
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import psycopg2
+
+sys.path.append('../')
+import util
+from export import (
+    FACE_COPY_COLUMNS, get_face_batches_from_db,
+    get_faces_and_identities_from_db)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Report the fastest of this many runs')
+    parser.add_argument('--db-name', type=str, default='tvnews_synthetic')
+    parser.add_argument('--db-user', type=str, default='admin')
+    return parser.parse_args()
+
+
+def run_cursor(conn, session):
+    return sum(len(batch['face_id'])
+               for batch in get_faces_and_identities_from_db(conn, session))
+
+
+def run_copy_batches(conn, session):
+    return sum(len(batch['face_id'])
+               for batch in get_face_batches_from_db(conn, session))
+
+
+# Concatenate the batches of a source into one array per column
+def get_columns(face_batches):
+    batches = list(face_batches)
+    return {name: np.concatenate([x[name] for x in batches])
+            for name, _ in FACE_COPY_COLUMNS}
+
+
+def main(repeat, db_name, db_user):
+    password = os.getenv('POSTGRES_PASSWORD')
+    session = util.get_db_session(db_user, password, db_name)
+    conn = psycopg2.connect(dbname=db_name, user=db_user,
+                            host='localhost', password=password)
+
+    cursor_columns = get_columns(get_faces_and_identities_from_db(conn, session))
+    copy_columns = get_columns(get_face_batches_from_db(conn, session))
+    for name, _ in FACE_COPY_COLUMNS:
+        assert cursor_columns[name].dtype == copy_columns[name].dtype and \
+            np.array_equal(cursor_columns[name], copy_columns[name],
+                           equal_nan=cursor_columns[name].dtype.kind == 'f'), \
+            'Row sources differ in {}'.format(name)
+    del cursor_columns, copy_columns
+
+    results = []
+    for name, fn in [('cursor', run_cursor),
+                     ('copy-batches', run_copy_batches)]:
+        times = []
+        for _ in range(repeat):
+            start_time = time.time()
+            n = fn(conn, session)
+            times.append(time.time() - start_time)
+            conn.commit()
+        results.append((name, n, min(times)))
+
+    print('{:<16}{:>12}{:>12}{:>14}'.format('source', 'rows', 'seconds', 'rows/s'))
+    for name, n, seconds in results:
+        print('{:<16}{:>12}{:>12.3f}{:>14.0f}'.format(
+            name, n, seconds, n / seconds))
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
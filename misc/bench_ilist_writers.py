@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark comparing the original per-field interval writers with the
+numpy-packed writers in export.py. Both write the same synthetic interval
+lists and the outputs are checked to be byte-for-byte identical.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+sys.path.append('../')
+from export import IntervalListMappingWriter, IntervalSetMappingWriter
+
+
+# The writers as they were before they were changed to pack each video into
+# a single buffer.
+class LegacyIntervalListMappingWriter(object):
+
+    def __init__(self, path: str, payload_len: int):
+        self._fp = open(path, 'wb')
+        self._payload_len = payload_len
+
+    def __enter__(self) -> 'LegacyIntervalListMappingWriter':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self._fp.close()
+
+    def write(self, id_: int, intervals: List[Tuple[int, int, int]]) -> None:
+        self._fp.write(id_.to_bytes(4, byteorder='little'))
+        self._fp.write(len(intervals).to_bytes(4, byteorder='little'))
+        for a, b, c in intervals:
+            assert b > a, 'invalid interval: ({}, {})'.format(a, b)
+            self._fp.write(a.to_bytes(4, byteorder='little'))
+            self._fp.write(b.to_bytes(4, byteorder='little'))
+            self._fp.write(c.to_bytes(self._payload_len, byteorder='little'))
+
+
+class LegacyIntervalSetMappingWriter(object):
+
+    def __init__(self, path: str):
+        self._fp = open(path, 'wb')
+
+    def __enter__(self) -> 'LegacyIntervalSetMappingWriter':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self._fp.close()
+
+    def write(self, id_: int, intervals: List[Tuple[int, int]]) -> None:
+        self._fp.write(id_.to_bytes(4, byteorder='little'))
+        self._fp.write(len(intervals).to_bytes(4, byteorder='little'))
+        for a, b in intervals:
+            assert b > a, 'invalid interval: ({}, {})'.format(a, b)
+            self._fp.write(a.to_bytes(4, byteorder='little'))
+            self._fp.write(b.to_bytes(4, byteorder='little'))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-videos', type=int, default=2000)
+    parser.add_argument('--faces-per-video', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_videos(n_videos, faces_per_video):
+    videos = []
+    for video_id in range(n_videos):
+        n = random.randint(0, 2 * faces_per_video)
+        starts = sorted(random.randrange(0, 3600 * 1000, 1000) for _ in range(n))
+        videos.append((video_id, [
+            (s, s + random.choice((1000, 3000)), random.randrange(256))
+            for s in starts
+        ]))
+    return videos
+
+
+def time_writer(make_writer, path, videos):
+    start_time = time.time()
+    with make_writer(path) as writer:
+        for video_id, intervals in videos:
+            writer.write(video_id, intervals)
+    return time.time() - start_time
+
+
+def compare(name, make_legacy, make_new, tmp_dir, videos, strip_payload):
+    legacy_path = os.path.join(tmp_dir, '{}.legacy.bin'.format(name))
+    new_path = os.path.join(tmp_dir, '{}.new.bin'.format(name))
+    if strip_payload:
+        videos = [(v, [(a, b) for a, b, _ in x]) for v, x in videos]
+    legacy_time = time_writer(make_legacy, legacy_path, videos)
+    new_time = time_writer(make_new, new_path, videos)
+
+    with open(legacy_path, 'rb') as fp:
+        legacy_bytes = fp.read()
+    with open(new_path, 'rb') as fp:
+        new_bytes = fp.read()
+    assert legacy_bytes == new_bytes, 'Output differs for {}'.format(name)
+
+    print('{}: {:.3f}s -> {:.3f}s ({:.1f}x), {:.1f} MB/s'.format(
+        name, legacy_time, new_time, legacy_time / new_time,
+        len(new_bytes) / new_time / 1e6))
+
+
+def main(n_videos, faces_per_video, seed):
+    random.seed(seed)
+    videos = generate_videos(n_videos, faces_per_video)
+    print('Generated {} intervals in {} videos'.format(
+        sum(len(x) for _, x in videos), len(videos)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compare('ilist',
+                lambda p: LegacyIntervalListMappingWriter(p, 1),
+                lambda p: IntervalListMappingWriter(p, 1),
+                tmp_dir, videos, False)
+        compare('iset',
+                LegacyIntervalSetMappingWriter,
+                IntervalSetMappingWriter,
+                tmp_dir, videos, True)
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the stages of the export and import scripts end to end on a
+synthetic dataset, in throwaway databases on the local Postgres:
+
+1. <db-name> is created and populated by synthetic_db.py, and export.py's
+   export_videos, export_commercials, get_selected_identities and
+   export_faces_and_identities are run against it.
+2. Its tables are dumped to CSV and loaded into <db-name>_import with
+   import.py's load_via_copy and parallel_load_via_copy.
+3. Synthetic pipeline outputs (bboxes.json, genders.json, etc.) are written
+   for --pipeline-videos new videos and imported into <db-name>_import with
+   pipeline_import.process_video. Each phase of process_video is timed.
+
+The results (seconds, rows/s and MB/s of each stage) are saved as JSON to
+--output. Rows are the rows (or intervals) produced or consumed by a stage
+and bytes are the size of its output files (export) or input files (import).
+
+Both databases are dropped first if they exist, and again at the end unless
+--keep-dbs is given. Do not point this at the production database.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+import psycopg2
+
+sys.path.append('../')
+import export
+import pipeline_import
+import util
+from interval_reader import IntervalFileReader
+from synthetic_db import CHANNELS, FPS, SHOWS_PER_CHANNEL, create_tables, populate
+
+# import is a keyword
+db_import = importlib.import_module('import')
+
+
+# In dependency order. The tables import.py loads with COPY are timed, the
+# others (loaded by load_videos and load_hosts_staff in import.py) are
+# copied the same way as setup.
+IMPORT_TABLES = [
+    ('labeler', 'copy'),
+    ('frame_sampler', 'copy'),
+    ('gender', 'copy'),
+    ('identity', 'copy'),
+    ('channel', None),
+    ('canonical_show', None),
+    ('show', None),
+    ('video', None),
+    ('channel_host', None),
+    ('canonical_show_host', None),
+    ('commercial', 'copy'),
+    ('frame', 'parallel_copy'),
+    ('face', 'parallel_copy'),
+    ('face_gender', 'parallel_copy'),
+    ('face_identity', 'parallel_copy'),
+]
+
+# The process_video phases, with the pipeline output files each one reads
+PIPELINE_PHASES = [
+    ('load_video_data', ['metadata.json', 'bboxes.json', 'genders.json',
+                         'identities.json', 'identities_propogated.json',
+                         'commercials.json', 'embeddings.json',
+                         'captions.srt', 'captions_orig.srt']),
+    ('import_video', []),
+    ('import_faces', []),
+    ('import_face_genders', []),
+    ('import_face_identities', []),
+    ('import_commercials', []),
+    ('update_resolved_labels', []),
+    ('save_embeddings', []),
+    ('save_captions', []),
+]
+
+PIPELINE_START_TIME = datetime(2022, 6, 1)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-videos', type=int, default=200)
+    parser.add_argument('--video-minutes', type=int, default=10)
+    parser.add_argument('--n-identities', type=int, default=2000)
+    parser.add_argument('--pipeline-videos', type=int, default=20,
+                        help='Number of videos to import with pipeline_import.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--copy-binary', action='store_true',
+                        help='Passed to the face export')
+    parser.add_argument('--bbox-format', choices=export.BBOX_FORMATS,
+                        default='json', help='Passed to the face export')
+    parser.add_argument('--output', type=str, default='bench_pipeline.json',
+                        help='File to save the results to')
+    parser.add_argument('--keep-dbs', action='store_true',
+                        help='Do not drop the databases at the end')
+    parser.add_argument('--db-name', type=str, default='tvnews_bench')
+    parser.add_argument('--db-user', type=str, default='admin')
+    return parser.parse_args()
+
+
+def get_conn_args(db_name, db_user, password):
+    return {
+        'dbname': db_name, 'user': db_user, 'host': 'localhost',
+        'password': password
+    }
+
+
+def recreate_database(db_name, db_user, password, create=True):
+    conn = psycopg2.connect(**get_conn_args('postgres', db_user, password))
+    conn.autocommit = True
+    cur = conn.cursor()
+    # FORCE closes the connections left open by sessions
+    cur.execute('DROP DATABASE IF EXISTS {} WITH (FORCE)'.format(db_name))
+    if create:
+        cur.execute('CREATE DATABASE {}'.format(db_name))
+    conn.close()
+
+
+def get_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+def get_interval_count(path, payload_len):
+    with IntervalFileReader(path, payload_len) as reader:
+        return int(reader.index['count'].sum())
+
+
+def get_result(stage, seconds, rows, nbytes=None):
+    return {
+        'stage': stage,
+        'seconds': seconds,
+        'rows': rows,
+        'bytes': nbytes,
+        'rows_per_s': rows / seconds if rows is not None and seconds > 0 else None,
+        'mb_per_s': (nbytes / 1e6 / seconds
+                     if nbytes is not None and seconds > 0 else None),
+    }
+
+
+def bench_export(conn, session, widget_dir, copy_binary, bbox_format):
+    results = []
+    cur = conn.cursor()
+
+    start_time = time.time()
+    export.export_videos(conn, widget_dir)
+    seconds = time.time() - start_time
+    video_file = os.path.join(widget_dir, 'videos.json')
+    with open(video_file) as fp:
+        num_videos = len(json.load(fp))
+    results.append(get_result('export_videos', seconds, num_videos,
+                              get_size(video_file)))
+
+    start_time = time.time()
+    export.export_commercials(conn, session, widget_dir)
+    seconds = time.time() - start_time
+    commercial_file = os.path.join(widget_dir, 'commercials.iset.bin')
+    results.append(get_result(
+        'export_commercials', seconds, get_interval_count(commercial_file, 0),
+        get_size(commercial_file)))
+    conn.commit()
+
+    # Rows are the face_identity rows that the query aggregates
+    cur.execute('SELECT COUNT(*) FROM face_identity')
+    num_face_identities = cur.fetchone()[0]
+    start_time = time.time()
+    selected_identities = export.get_selected_identities(conn, session)
+    seconds = time.time() - start_time
+    results.append(get_result('get_selected_identities', seconds,
+                              num_face_identities))
+    conn.commit()
+    print('Selected {} identities'.format(len(selected_identities)))
+
+    # Includes its own get_selected_identities
+    prev_size = get_size(widget_dir)
+    start_time = time.time()
+    export.export_faces_and_identities(
+        conn, session, widget_dir, copy_binary=copy_binary,
+        bbox_format=bbox_format)
+    seconds = time.time() - start_time
+    results.append(get_result(
+        'export_faces_and_identities', seconds,
+        get_interval_count(os.path.join(widget_dir, 'faces.ilist.bin'), 1),
+        get_size(widget_dir) - prev_size))
+    conn.commit()
+    return results
+
+
+def dump_tables(conn, csv_dir):
+    row_counts = {}
+    cur = conn.cursor()
+    for table, _ in IMPORT_TABLES:
+        with open(os.path.join(csv_dir, '{}.csv'.format(table)), 'w') as fp:
+            cur.copy_expert(
+                'COPY {} TO STDOUT WITH (FORMAT csv, HEADER)'.format(table), fp)
+        row_counts[table] = cur.rowcount
+    conn.commit()
+    return row_counts
+
+
+def bench_copy_import(conn_args, csv_dir, row_counts):
+    results = []
+    conn = psycopg2.connect(**conn_args)
+    for table, method in IMPORT_TABLES:
+        start_time = time.time()
+        if method == 'parallel_copy':
+            db_import.parallel_load_via_copy(conn_args, csv_dir, table)
+        else:
+            db_import.load_via_copy(conn, csv_dir, table)
+        seconds = time.time() - start_time
+        if method is not None:
+            results.append(get_result(
+                '{}:{}'.format(method, table), seconds, row_counts[table],
+                get_size(os.path.join(csv_dir, '{}.csv'.format(table)))))
+
+    for table in ['labeler', 'frame_sampler', 'gender', 'channel', 'identity',
+                  'canonical_show', 'show', 'video', 'commercial', 'frame',
+                  'face']:
+        db_import.set_id_sequence(conn, table)
+    conn.close()
+    return results
+
+
+def write_srt(path, rng, num_seconds):
+    with open(path, 'w') as fp:
+        for i, second in enumerate(range(0, num_seconds - 3, 3), 1):
+            fp.write('{}\n00:{:02d}:{:02d},000 --> 00:{:02d}:{:02d},000\n'.format(
+                i, second // 60, second % 60, (second + 3) // 60,
+                (second + 3) % 60))
+            fp.write(' '.join(rng.choice(['THE', 'NEWS', 'TONIGHT', 'WE',
+                                          'REPORT', 'FROM', 'WASHINGTON'])
+                              for _ in range(rng.randint(3, 10))))
+            fp.write('\n\n')
+        return i
+
+
+# Writes the pipeline outputs of a video, with the same distributions as
+# synthetic_db.py, and returns the number of rows each phase reads
+def write_pipeline_video(video_path, rng, video_minutes, n_identities):
+    os.makedirs(video_path)
+    num_frames = int(video_minutes * 60 * FPS)
+    rows = {}
+
+    def save(name, data):
+        with open(os.path.join(video_path, name), 'w') as fp:
+            json.dump(data, fp)
+
+    save('metadata.json', {'frames': num_frames, 'fps': FPS, 'width': 640,
+                           'height': 360})
+    rows['import_video'] = 1
+
+    bboxes, genders, identities, prop_identities, embeddings = [], [], [], [], []
+    for second in range(video_minutes * 60):
+        for _ in range(min(int(rng.expovariate(0.7)), 8)):
+            orig_face_id = len(bboxes)
+            x1, y1 = rng.random() * 0.7, rng.random() * 0.7
+            size = 0.05 + rng.random() * 0.25
+            bboxes.append([orig_face_id, {
+                'frame_num': int(second * FPS),
+                'bbox': {'x1': x1, 'x2': x1 + size, 'y1': y1, 'y2': y1 + size,
+                         'score': 0.9 + rng.random() * 0.1}
+            }])
+            genders.append([orig_face_id, 'M' if rng.random() < 0.65 else 'F',
+                            0.5 + rng.random() * 0.5])
+            embeddings.append([orig_face_id, [rng.gauss(0, 0.1)
+                                              for _ in range(pipeline_import.EMBEDDING_DIM)]])
+            r = rng.random()
+            if r < 0.35:
+                # A few faces are of people not in the identity table yet
+                identity_id = min(int(rng.paretovariate(0.8)), n_identities + 100)
+                entry = [orig_face_id, 'Person {}'.format(identity_id),
+                         0.5 + rng.random() * 0.5]
+                if r < 0.25:
+                    identities.append(entry)
+                else:
+                    prop_identities.append(entry)
+    save('bboxes.json', bboxes)
+    save('genders.json', genders)
+    save('identities.json', identities)
+    save('identities_propogated.json', prop_identities)
+    save('embeddings.json', embeddings)
+    rows['load_video_data'] = len(bboxes)
+    rows['import_faces'] = len(bboxes)
+    rows['import_face_genders'] = len(genders)
+    rows['import_face_identities'] = len(identities) + len(prop_identities)
+    rows['update_resolved_labels'] = len(bboxes)
+    rows['save_embeddings'] = len(embeddings)
+
+    commercials = []
+    for _ in range(rng.randint(2, 12)):
+        min_frame = rng.randrange(num_frames - 1)
+        commercials.append(
+            [min_frame, min(num_frames, min_frame + rng.randint(300, 5000))])
+    save('commercials.json', commercials)
+    rows['import_commercials'] = len(commercials)
+
+    rows['save_captions'] = sum(
+        write_srt(os.path.join(video_path, name), rng, video_minutes * 60)
+        for name in ['captions.srt', 'captions_orig.srt'])
+    return rows
+
+
+# Replaces the process_video phases in pipeline_import with wrappers that add
+# up the time spent in each
+def time_pipeline_phases(phase_seconds):
+    originals = {}
+    for phase, _ in PIPELINE_PHASES:
+        fn = getattr(pipeline_import, phase)
+        originals[phase] = fn
+
+        def timed(*args, _fn=fn, _phase=phase, **kwargs):
+            start_time = time.time()
+            try:
+                return _fn(*args, **kwargs)
+            finally:
+                phase_seconds[_phase] += time.time() - start_time
+        setattr(pipeline_import, phase, timed)
+    return originals
+
+
+def bench_pipeline_import(db_name, db_user, password, work_dir, n_videos,
+                          video_minutes, n_identities, seed):
+    rng = random.Random(seed)
+    import_path = os.path.join(work_dir, 'pipeline')
+    out_dirs = [os.path.join(work_dir, x)
+                for x in ['embs', 'captions', 'captions_orig']]
+    for out_dir in out_dirs:
+        os.makedirs(out_dir)
+
+    phase_rows = defaultdict(int)
+    phase_bytes = defaultdict(int)
+    video_names = []
+    for i in range(n_videos):
+        channel = rng.choice(CHANNELS)
+        video_time = PIPELINE_START_TIME + timedelta(hours=i)
+        video_name = '{}_{}_{}_show_{}'.format(
+            channel, video_time.strftime('%Y%m%d_%H%M%S'), channel,
+            rng.randrange(SHOWS_PER_CHANNEL))
+        video_path = os.path.join(import_path, video_name)
+        for phase, count in write_pipeline_video(
+                video_path, rng, video_minutes, n_identities).items():
+            phase_rows[phase] += count
+        for phase, files in PIPELINE_PHASES:
+            phase_bytes[phase] += sum(
+                get_size(os.path.join(video_path, f)) for f in files)
+        video_names.append(video_name)
+
+    session = util.get_db_session(db_user, password, db_name)
+    import_context = pipeline_import.get_import_context(session, *out_dirs)
+    phase_seconds = defaultdict(float)
+    originals = time_pipeline_phases(phase_seconds)
+    try:
+        start_time = time.time()
+        for video_name in video_names:
+            pipeline_import.process_video(
+                session, import_context, os.path.join(import_path, video_name),
+                video_name, False)
+        process_seconds = time.time() - start_time
+        start_time = time.time()
+        session.commit()
+        commit_seconds = time.time() - start_time
+    finally:
+        for phase, fn in originals.items():
+            setattr(pipeline_import, phase, fn)
+    session.close()
+
+    results = [
+        get_result('process_video:{}'.format(phase), phase_seconds[phase],
+                   phase_rows[phase], phase_bytes[phase] if files else None)
+        for phase, files in PIPELINE_PHASES
+    ]
+    results.append(get_result(
+        'process_video', process_seconds, phase_rows['import_faces'],
+        get_size(import_path)))
+    results.append(get_result('process_video:commit', commit_seconds, None))
+    return results
+
+
+def print_results(results):
+    print('{:<40}{:>10}{:>12}{:>14}{:>10}'.format(
+        'stage', 'seconds', 'rows', 'rows/s', 'MB/s'))
+    for r in results:
+        print('{:<40}{:>10.3f}{:>12}{:>14}{:>10}'.format(
+            r['stage'], r['seconds'], r['rows'] if r['rows'] is not None else '-',
+            '{:.0f}'.format(r['rows_per_s']) if r['rows_per_s'] else '-',
+            '{:.1f}'.format(r['mb_per_s']) if r['mb_per_s'] else '-'))
+
+
+def main(n_videos, video_minutes, n_identities, pipeline_videos, seed,
+         copy_binary, bbox_format, output, keep_dbs, db_name, db_user):
+    password = os.getenv('POSTGRES_PASSWORD')
+    import_db_name = db_name + '_import'
+    work_dir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    try:
+        recreate_database(db_name, db_user, password)
+        recreate_database(import_db_name, db_user, password)
+        create_tables(db_name, db_user, password)
+        create_tables(import_db_name, db_user, password)
+
+        conn = psycopg2.connect(**get_conn_args(db_name, db_user, password))
+        start_time = time.time()
+        dataset = populate(conn, n_videos, video_minutes, n_identities, seed)
+        results = [get_result('populate', time.time() - start_time,
+                              sum(dataset.values()))]
+
+        session = util.get_db_session(db_user, password, db_name)
+        widget_dir = os.path.join(work_dir, 'widget')
+        os.makedirs(widget_dir)
+        results.extend(bench_export(conn, session, widget_dir, copy_binary,
+                                    bbox_format))
+        session.close()
+
+        csv_dir = os.path.join(work_dir, 'csv')
+        os.makedirs(csv_dir)
+        row_counts = dump_tables(conn, csv_dir)
+        conn.close()
+        results.extend(bench_copy_import(
+            get_conn_args(import_db_name, db_user, password), csv_dir,
+            row_counts))
+        shutil.rmtree(csv_dir)
+
+        results.extend(bench_pipeline_import(
+            import_db_name, db_user, password, work_dir, pipeline_videos,
+            video_minutes, n_identities, seed))
+    finally:
+        shutil.rmtree(work_dir)
+        if not keep_dbs:
+            recreate_database(db_name, db_user, password, create=False)
+            recreate_database(import_db_name, db_user, password, create=False)
+
+    print_results(results)
+    with open(output, 'w') as fp:
+        json.dump({
+            'config': {
+                'n_videos': n_videos, 'video_minutes': video_minutes,
+                'n_identities': n_identities,
+                'pipeline_videos': pipeline_videos, 'seed': seed,
+                'copy_binary': copy_binary, 'bbox_format': bbox_format,
+            },
+            'dataset': dataset,
+            'time': datetime.now().isoformat(),
+            'stages': results,
+        }, fp, indent=2)
+    print('Saved results to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Compare EXPLAIN ANALYZE timings of the hot export and backfill queries on a
+database populated by synthetic_db.py:
+
+legacy: the queries filtering with DATE_PART('year', video.time), without the
+    composite and partial indexes declared in schema.py
+sargable: range predicates on video.time, without the new indexes
+indexed: range predicates on video.time, with the new indexes
+
+The composite and partial indexes are dropped first and recreated as
+migrate_indexes.py would. Since this takes a while on a large database and
+slows down its queries in the meantime, any database other than the synthetic
+one is refused unless --allow-drop-indexes is passed.
+"""
+
+import argparse
+import os
+import re
+import sys
+import psycopg2
+
+sys.path.append('../')
+import schema
+import util
+from backfill_identities_with_knn import (
+    get_sample_neg_face_ids_sql, get_sample_pos_face_ids_sql)
+from export import (
+    get_commercials_sql, get_faces_and_identities_sql, get_frame_sampler,
+    get_labeler, get_selected_identities_sql)
+from migrate_indexes import get_create_index_sql
+
+SYNTHETIC_DB_NAME = 'tvnews_synthetic'
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Report the fastest of this many runs')
+    parser.add_argument('--db-name', type=str, default=SYNTHETIC_DB_NAME)
+    parser.add_argument('--db-user', type=str, default='admin')
+    parser.add_argument('--allow-drop-indexes', action='store_true',
+                        help='Run on a database other than {}, whose indexes '
+                             'are dropped and recreated'.format(
+                                 SYNTHETIC_DB_NAME))
+    return parser.parse_args()
+
+
+def to_legacy_predicates(sql):
+    return re.sub(r"video\.time (>=|<) '(\d{4})-01-01'",
+                  r"DATE_PART('year', video.time) \1 \2", sql)
+
+
+def get_new_indexes():
+    return [
+        index for table in schema.Base.metadata.sorted_tables
+        for index in table.indexes
+        if len(index.columns) > 1
+        or index.dialect_options['postgresql']['where'] is not None
+    ]
+
+
+def get_queries(conn, session):
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM identity ORDER BY id LIMIT 1')
+    identity_id = cur.fetchone()[0]
+    cur.execute('SELECT id FROM video ORDER BY id DESC LIMIT 10')
+    recent_video_ids = [x[0] for x in cur.fetchall()]
+
+    identity_labeler_id = get_labeler(session, 'face-identity-rekognition').id
+    sampler_1s_id = get_frame_sampler(session, '1s').id
+    return [
+        ('selected_identities', get_selected_identities_sql(session)),
+        ('commercials', get_commercials_sql(session)),
+        ('faces', get_faces_and_identities_sql(session)),
+        ('faces_recent_videos', get_faces_and_identities_sql(
+            session, video_ids=recent_video_ids)),
+        ('backfill_pos_sample', get_sample_pos_face_ids_sql(
+            identity_id, identity_labeler_id, sampler_1s_id)),
+        ('backfill_neg_sample', get_sample_neg_face_ids_sql(
+            identity_id, sampler_1s_id)),
+    ]
+
+
+def explain_analyze(conn, sql, repeat):
+    cur = conn.cursor()
+    times = []
+    for _ in range(repeat):
+        cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql)
+        times.append(cur.fetchone()[0][0]['Execution Time'])
+    return min(times)
+
+
+def main(repeat, db_name, db_user, allow_drop_indexes):
+    if db_name != SYNTHETIC_DB_NAME and not allow_drop_indexes:
+        raise Exception('This drops and recreates the indexes of {}, pass '
+                        '--allow-drop-indexes to run it anyway'.format(db_name))
+    password = os.getenv('POSTGRES_PASSWORD')
+    session = util.get_db_session(db_user, password, db_name)
+    engine = session.get_bind()
+    conn = psycopg2.connect(dbname=db_name, user=db_user,
+                            host='localhost', password=password)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    queries = get_queries(conn, session)
+    new_indexes = get_new_indexes()
+    for index in new_indexes:
+        cur.execute('DROP INDEX IF EXISTS {}'.format(index.name))
+    cur.execute('ANALYZE')
+
+    results = {name: {} for name, _ in queries}
+    for name, sql in queries:
+        results[name]['legacy'] = explain_analyze(
+            conn, to_legacy_predicates(sql), repeat)
+        results[name]['sargable'] = explain_analyze(conn, sql, repeat)
+
+    for index in new_indexes:
+        cur.execute(get_create_index_sql(engine, index))
+    cur.execute('ANALYZE')
+    for name, sql in queries:
+        results[name]['indexed'] = explain_analyze(conn, sql, repeat)
+
+    print('{:<24}{:>12}{:>12}{:>12}'.format(
+        'query (ms)', 'legacy', 'sargable', 'indexed'))
+    for name, timings in results.items():
+        print('{:<24}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            name, timings['legacy'], timings['sargable'], timings['indexed']))
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
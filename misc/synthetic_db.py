@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+Fill an empty database with a synthetic dataset that has the shape of the
+real one: videos from 2010 on, sampled every 3s before 2019 and every 1s
+after, faces with knn genders (and a few manual ones), rekognition,
+propagated and backfilled identities with a long tailed popularity,
+commercials and hosts. The tables are created from schema.py and loaded
+with COPY.
+
+Do not point this at the production database.
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+import psycopg2
+import sqlalchemy
+
+sys.path.append('../')
+import schema
+from resolved_labels import (
+    BEST_IDENTITY_SQL, RESOLVED_GENDER_SQL, ResolvedLabelers,
+    format_resolved_label_sql)
+
+
+CHANNELS = ['CNN', 'FOXNEWS', 'MSNBC']
+SHOWS_PER_CHANNEL = 20
+HOSTS_PER_CHANNEL = 10
+FPS = 29.97
+
+IDENTITY_LABELERS = [
+    'face-identity-rekognition',
+    'face-identity-rekognition:augmented-l2-dist=0.7',
+    'face-identity-rekognition:backfill-synthetic_person',
+]
+LABELERS = [
+    'mtcnn', 'knn-gender', 'handlabeled-gender', 'commercials',
+    'commercials-1s', *IDENTITY_LABELERS
+]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-videos', type=int, default=1000)
+    parser.add_argument('--video-minutes', type=int, default=10)
+    parser.add_argument('--n-identities', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db-name', type=str, default='tvnews_synthetic')
+    parser.add_argument('--db-user', type=str, default='admin')
+    return parser.parse_args()
+
+
+class TableBuffer(object):
+    """Accumulates rows for one table and loads them with COPY"""
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.count = 0
+        self._buf = io.StringIO()
+
+    def add(self, *row):
+        self._buf.write('\t'.join(
+            '\\N' if x is None else str(x) for x in row))
+        self._buf.write('\n')
+        self.count += 1
+
+    def copy(self, conn):
+        self._buf.seek(0)
+        cur = conn.cursor()
+        cur.copy_expert('COPY {}({}) FROM STDIN'.format(
+            self.table, ','.join(self.columns)), self._buf)
+        self._buf = io.StringIO()
+
+
+def create_tables(db_name, db_user, password):
+    engine = sqlalchemy.create_engine(
+        'postgresql://{}:{}@localhost/{}'.format(db_user, password, db_name))
+    schema.Base.metadata.create_all(engine)
+    engine.dispose()
+
+
+def populate(conn, n_videos, video_minutes, n_identities, seed=0):
+    """Fill the (empty) tables and return the number of rows per table"""
+    rng = random.Random(seed)
+
+    def ids(table, names):
+        buf = TableBuffer(table, ['id', 'name'])
+        for i, name in enumerate(names, 1):
+            buf.add(i, name)
+        buf.copy(conn)
+        return {name: i for i, name in enumerate(names, 1)}
+
+    labeler_buf = TableBuffer('labeler', ['id', 'name', 'is_handlabel'])
+    labeler_ids = {}
+    for i, name in enumerate(LABELERS, 1):
+        labeler_buf.add(i, name, name == 'handlabeled-gender')
+        labeler_ids[name] = i
+    labeler_buf.copy(conn)
+    sampler_ids = ids('frame_sampler', ['3s', '1s'])
+    gender_ids = ids('gender', ['M', 'F', 'U'])
+    channel_ids = ids('channel', CHANNELS)
+
+    identity_buf = TableBuffer('identity', ['id', 'name', 'is_ignore'])
+    for i in range(1, n_identities + 1):
+        identity_buf.add(i, 'person {}'.format(i), False)
+    identity_buf.copy(conn)
+
+    canonical_show_buf = TableBuffer(
+        'canonical_show', ['id', 'name', 'is_recurring', 'channel_id'])
+    show_buf = TableBuffer('show', ['id', 'name', 'canonical_show_id', 'channel_id'])
+    shows = []
+    for channel, channel_id in channel_ids.items():
+        for j in range(SHOWS_PER_CHANNEL):
+            show_id = len(shows) + 1
+            name = '{} show {}'.format(channel, j)
+            canonical_show_buf.add(show_id, name, True, channel_id)
+            show_buf.add(show_id, name, show_id, channel_id)
+            shows.append((show_id, channel_id))
+    canonical_show_buf.copy(conn)
+    show_buf.copy(conn)
+
+    # A few popular identities are hosts, and show up on their channel a lot
+    channel_host_buf = TableBuffer('channel_host', ['channel_id', 'identity_id'])
+    canonical_show_host_buf = TableBuffer(
+        'canonical_show_host', ['canonical_show_id', 'identity_id'])
+    channel_hosts = {}
+    for k, channel_id in enumerate(channel_ids.values()):
+        hosts = list(range(1 + k * HOSTS_PER_CHANNEL,
+                           1 + (k + 1) * HOSTS_PER_CHANNEL))
+        channel_hosts[channel_id] = hosts
+        for identity_id in hosts[:HOSTS_PER_CHANNEL // 2]:
+            channel_host_buf.add(channel_id, identity_id)
+        for show_id, show_channel_id in shows:
+            if show_channel_id == channel_id:
+                canonical_show_host_buf.add(show_id, rng.choice(hosts))
+    channel_host_buf.copy(conn)
+    canonical_show_host_buf.copy(conn)
+
+    video_buf = TableBuffer('video', [
+        'id', 'name', 'extension', 'num_frames', 'fps', 'width', 'height',
+        'time', 'show_id', 'is_duplicate', 'is_corrupt'])
+    commercial_buf = TableBuffer(
+        'commercial', ['id', 'labeler_id', 'min_frame', 'max_frame', 'video_id'])
+    frame_buf = TableBuffer('frame', ['id', 'number', 'video_id', 'sampler_id'])
+    face_buf = TableBuffer('face', [
+        'id', 'bbox_x1', 'bbox_x2', 'bbox_y1', 'bbox_y2', 'labeler_id',
+        'score', 'frame_id'])
+    face_gender_buf = TableBuffer(
+        'face_gender', ['face_id', 'gender_id', 'labeler_id', 'score'])
+    face_identity_buf = TableBuffer(
+        'face_identity', ['face_id', 'labeler_id', 'score', 'identity_id'])
+    buffers = [video_buf, commercial_buf, frame_buf, face_buf,
+               face_gender_buf, face_identity_buf]
+
+    start_time = datetime(2010, 1, 1)
+    span_seconds = (datetime(2022, 1, 1) - start_time).total_seconds()
+    num_frames = int(video_minutes * 60 * FPS)
+    frame_id = face_id = commercial_id = 0
+    for video_id in range(1, n_videos + 1):
+        show_id, channel_id = rng.choice(shows)
+        video_time = start_time + timedelta(
+            seconds=int(span_seconds * video_id / (n_videos + 1)))
+        channel = CHANNELS[channel_id - 1]
+        video_buf.add(
+            video_id,
+            '{}_{}_show_{}'.format(channel, video_time.strftime('%Y%m%d_%H%M%S'), show_id),
+            '.mp4', num_frames, FPS, 640, 360, video_time, show_id,
+            rng.random() < 0.01, rng.random() < 0.01)
+
+        is_1s = video_time.year >= 2019
+        for _ in range(rng.randint(2, 12)):
+            min_frame = rng.randrange(num_frames - 1)
+            max_frame = min(num_frames, min_frame + rng.randint(300, 5000))
+            commercial_id += 1
+            commercial_buf.add(
+                commercial_id,
+                labeler_ids['commercials-1s' if is_1s else 'commercials'],
+                min_frame, max_frame, video_id)
+
+        stride = 1 if is_1s else 3
+        for second in range(0, video_minutes * 60, stride):
+            frame_id += 1
+            frame_buf.add(frame_id, int(second * FPS), video_id,
+                          sampler_ids['1s' if is_1s else '3s'])
+            for _ in range(min(int(rng.expovariate(0.7)), 8)):
+                face_id += 1
+                x1, y1 = rng.random() * 0.7, rng.random() * 0.7
+                size = 0.05 + rng.random() * 0.25
+                face_buf.add(face_id, x1, x1 + size, y1, y1 + size,
+                             labeler_ids['mtcnn'], 0.9 + rng.random() * 0.1,
+                             frame_id)
+
+                face_gender_buf.add(
+                    face_id, gender_ids['M' if rng.random() < 0.65 else 'F'],
+                    labeler_ids['knn-gender'], 0.5 + rng.random() * 0.5)
+                if rng.random() < 0.005:
+                    face_gender_buf.add(
+                        face_id, rng.choice(list(gender_ids.values())),
+                        labeler_ids['handlabeled-gender'], 1.)
+
+                r = rng.random()
+                if r < 0.35:
+                    if r < 0.1:
+                        identity_id = rng.choice(channel_hosts[channel_id])
+                    else:
+                        identity_id = min(
+                            int(rng.paretovariate(0.8)), n_identities)
+                    labeler = (IDENTITY_LABELERS[0] if r < 0.25
+                               else rng.choice(IDENTITY_LABELERS[1:]))
+                    face_identity_buf.add(
+                        face_id, labeler_ids[labeler],
+                        0.5 + rng.random() * 0.5, identity_id)
+
+    for buf in buffers:
+        buf.copy(conn)
+
+    cur = conn.cursor()
+    for table in ['labeler', 'frame_sampler', 'gender', 'channel', 'identity',
+                  'canonical_show', 'show', 'video', 'commercial', 'frame',
+                  'face']:
+        cur.execute("SELECT setval('{0}_id_seq', (SELECT MAX(id) FROM {0}))"
+                    .format(table))
+
+    resolved_labelers = ResolvedLabelers(
+        identity_labeler_ids=[labeler_ids[x] for x in IDENTITY_LABELERS],
+        manual_gender_labeler_id=labeler_ids['handlabeled-gender'],
+        knn_gender_labeler_id=labeler_ids['knn-gender'])
+    for sql in [BEST_IDENTITY_SQL, RESOLVED_GENDER_SQL]:
+        cur.execute(format_resolved_label_sql(sql, resolved_labelers, ''))
+    conn.commit()
+
+    conn.autocommit = True
+    cur.execute('ANALYZE')
+    conn.autocommit = False
+    return {buf.table: buf.count for buf in buffers}
+
+
+def main(n_videos, video_minutes, n_identities, seed, db_name, db_user):
+    password = os.getenv('POSTGRES_PASSWORD')
+    create_tables(db_name, db_user, password)
+    conn = psycopg2.connect(dbname=db_name, user=db_user,
+                            host='localhost', password=password)
+
+    start_time = time.time()
+    counts = populate(conn, n_videos, video_minutes, n_identities, seed)
+    for table, count in counts.items():
+        print('{}: {} rows'.format(table, count))
+    print('Populated in {:.3f} seconds'.format(time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
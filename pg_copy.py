@@ -0,0 +1,182 @@
+"""
+Stream the results of a query with COPY ... TO STDOUT WITH (FORMAT binary)
+and decode them into numpy column arrays, in large batches.
+
+The decoding is vectorized by viewing each batch of rows as a numpy
+structured array, so every row must have the same width: the query must not
+return NULLs (use COALESCE with a sentinel) and may only return fixed width
+types (e.g., integer, bigint, double precision, boolean).
+
+copy_rows goes the other way, inserting rows built in Python with a single
+COPY ... FROM STDIN instead of an INSERT per row.
+"""
+
+import io
+import queue
+import struct
+import threading
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+from psycopg2.extensions import encodings
+
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_TRAILER = b'\xff\xff'
+
+# Size of the chunks passed from the COPY thread to the decoder
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of chunks buffered between the COPY thread and the decoder
+COPY_QUEUE_SIZE = 4
+
+
+def get_copy_row_dtype(columns: List[Tuple[str, str]]) -> np.dtype:
+    """Dtype of one row of binary COPY output for (name, big-endian dtype)
+    columns. Each row is a field count followed by a length and a value for
+    each field."""
+    fields = [('_num_fields', '>i2')]
+    for name, dtype in columns:
+        fields.append(('_len_' + name, '>i4'))
+        fields.append((name, dtype))
+    return np.dtype(fields)
+
+
+class _ChunkWriter(object):
+    """File-like object for copy_expert that groups the (one per row) writes
+    into large chunks and passes them to the decoder"""
+
+    def __init__(self, chunk_queue: queue.Queue):
+        self._queue = chunk_queue
+        self._parts = []
+        self._size = 0
+        self.cancelled = False
+
+    def write(self, data) -> None:
+        if self.cancelled:
+            raise Exception('COPY cancelled')
+        self._parts.append(bytes(data))
+        self._size += len(data)
+        if self._size >= COPY_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._parts:
+            self._queue.put(b''.join(self._parts))
+            self._parts = []
+            self._size = 0
+
+
+def _run_copy(conn, sql: str, writer: _ChunkWriter, chunk_queue: queue.Queue,
+              errors: list) -> None:
+    try:
+        conn.cursor().copy_expert(
+            'COPY ({}) TO STDOUT WITH (FORMAT binary)'.format(sql), writer)
+        writer.flush()
+    except Exception as e:
+        errors.append(e)
+    finally:
+        chunk_queue.put(None)
+
+
+def _check_header(buf: bytes) -> int:
+    """Returns the size of the file header"""
+    assert buf[:len(COPY_SIGNATURE)] == COPY_SIGNATURE, 'Invalid COPY signature'
+    _, ext_len = struct.unpack_from('>iI', buf, len(COPY_SIGNATURE))
+    return len(COPY_SIGNATURE) + 8 + ext_len
+
+
+def _decode_rows(data: bytes, columns: List[Tuple[str, str]],
+                 row_dtype: np.dtype) -> Dict[str, np.ndarray]:
+    rows = np.frombuffer(data, dtype=row_dtype)
+    assert np.all(rows['_num_fields'] == len(columns)), \
+        'Unexpected number of fields'
+    batch = {}
+    for name, dtype in columns:
+        size = np.dtype(dtype).itemsize
+        assert np.all(rows['_len_' + name] == size), \
+            'Unexpected NULL or variable width value in: {}'.format(name)
+        batch[name] = rows[name].astype(np.dtype(dtype).newbyteorder('='))
+    return batch
+
+
+def iter_copy_batches(
+    conn, sql: str, columns: List[Tuple[str, str]], params=None
+) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Run sql with COPY and yield batches of rows, each a dict from column name
+    to a native-endian numpy array. columns lists the (name, big-endian
+    dtype) of each column returned by sql, e.g., ('face_id', '>i4').
+
+    COPY does not take parameters, so params (as for cursor.execute) are
+    bound into sql with mogrify.
+
+    The COPY runs in a thread, so the server keeps streaming while batches
+    are decoded and consumed.
+    """
+    if params is not None:
+        sql = conn.cursor().mogrify(sql, params).decode(encodings[conn.encoding])
+    row_dtype = get_copy_row_dtype(columns)
+    chunk_queue = queue.Queue(COPY_QUEUE_SIZE)
+    writer = _ChunkWriter(chunk_queue)
+    errors = []
+    copy_thread = threading.Thread(
+        target=_run_copy, args=(conn, sql, writer, chunk_queue, errors),
+        daemon=True)
+    copy_thread.start()
+
+    buf = b''
+    header_checked = False
+    done = False
+    try:
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is None:
+                break
+            buf += chunk
+            if not header_checked:
+                buf = buf[_check_header(buf):]
+                header_checked = True
+
+            n = len(buf) // row_dtype.itemsize
+            if n > 0:
+                split = n * row_dtype.itemsize
+                yield _decode_rows(buf[:split], columns, row_dtype)
+                buf = buf[split:]
+        done = True
+    finally:
+        if not done:
+            # The consumer stopped early; abort the COPY
+            writer.cancelled = True
+            while chunk_queue.get() is not None:
+                pass
+        copy_thread.join()
+
+    if errors:
+        raise errors[0]
+    assert buf == COPY_TRAILER, 'Missing COPY trailer'
+
+
+def _format_copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    return str(value)
+
+
+def copy_rows(cur, table: str, columns: List[str], rows: Iterable[tuple]) -> int:
+    """
+    Insert rows, tuples of values in the order of columns, into table with a
+    text COPY on cur, in its transaction. Values are formatted with str, so
+    they must be numbers, booleans or None (NULL); strings are not escaped.
+    Returns the number of rows.
+    """
+    buf = io.StringIO()
+    n = 0
+    for row in rows:
+        buf.write('\t'.join([_format_copy_value(x) for x in row]))
+        buf.write('\n')
+        n += 1
+    if n > 0:
+        buf.seek(0)
+        cur.copy_expert('COPY {} ({}) FROM STDIN'.format(
+            table, ', '.join(columns)), buf)
+    return n
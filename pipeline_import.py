@@ -3,15 +3,19 @@
 import argparse
 import json
 import os
-import shutil
 import subprocess
-from collections import Counter
-from functools import lru_cache
-from typing import Dict, NamedTuple
+import tarfile
+from collections import Counter, deque
+from contextlib import contextmanager
+from multiprocessing import Pool
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 import numpy as np
 from tqdm import tqdm
 
 import schema
+from pg_copy import copy_rows
+from resolved_labels import (
+    ResolvedLabelers, get_resolved_labelers, update_resolved_labels)
 from util import get_db_session, parse_video_name
 
 
@@ -34,6 +38,28 @@ class ImportContext(NamedTuple):
     male_gender: schema.Gender
     female_gender: schema.Gender
 
+    resolved_labelers: ResolvedLabelers
+    dimensions: 'DimensionCache'
+
+
+class VideoData(NamedTuple):
+    """The pipeline outputs of a video, read and checked by load_video_data"""
+    name: str
+    metadata: dict
+    # [orig_face_id, face_meta] from bboxes.json
+    faces: list
+    # [orig_face_id, gender, score] from genders.json
+    genders: list
+    # (orig_face_id, lower_name, score), see resolve_identities
+    identities: list
+    prop_identities: list
+    # [start_frame, end_frame] from commercials.json
+    commercials: list
+    emb_face_ids: np.ndarray
+    embs: np.ndarray
+    captions: bytes
+    orig_captions: bytes
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -47,16 +73,221 @@ def get_args():
                         help='Directory to save original captions to')
     parser.add_argument('--import-existing-videos', action='store_true',
                         help='Import videos already in the database')
-    parser.add_argument('--tmp-data-dir', type=str,
-                        default='/tmp')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes that read the pipeline '
+                             'outputs and compress the embeddings, for the '
+                             'process that writes to the database')
+    parser.add_argument('--commit-every', type=int,
+                        help='Commit after every N videos, instead of once '
+                             'at the end')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the videos committed by the last import '
+                             'of import_path (e.g., one that failed)')
     parser.add_argument('--db-name', type=str, default='tvnews')
     parser.add_argument('--db-user', type=str, default='admin')
     return parser.parse_args()
 
 
-def load_json(fpath: str):
-    with open(fpath) as fp:
-        return json.load(fp)
+# The rows of a video are written with COPY on the connection of the session,
+# in its transaction, rather than added to the session one by one
+def get_cursor(session):
+    return session.connection().connection.cursor()
+
+
+# Take n ids from the sequence of a table, in one round trip, so that rows
+# that reference each other can be built before they are written
+def reserve_ids(cur, table: str, n: int) -> List[int]:
+    if n == 0:
+        return []
+    cur.execute(
+        "SELECT nextval('{}_id_seq') FROM generate_series(1, %s)".format(table),
+        (n,))
+    return [x[0] for x in cur.fetchall()]
+
+
+class DimensionCache(object):
+    """
+    The ids of the channels, shows, identities and videos in the database, by
+    name, loaded once per import so that looking them up does not query the
+    database. Missing shows and identities are inserted, and cached.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        cur = get_cursor(session)
+        cur.execute('SELECT name, id FROM channel')
+        self.channel_ids = dict(cur.fetchall())
+        cur.execute('SELECT channel_id, name, id FROM show')
+        self.show_ids = {(channel_id, name): id
+                         for channel_id, name, id in cur.fetchall()}
+        cur.execute('SELECT name, id FROM identity')
+        self.identity_ids = dict(cur.fetchall())
+        cur.execute('SELECT name, id FROM video')
+        self.video_ids = dict(cur.fetchall())
+
+    def get_show_id(self, channel: str, show: str) -> int:
+        channel_id = self.channel_ids.get(channel)
+        assert channel_id is not None, 'Unknown channel: {}'.format(channel)
+        key = (channel_id, show)
+        if key not in self.show_ids:
+            cur = get_cursor(self.session)
+            cur.execute("""
+                INSERT INTO canonical_show (name, is_recurring, channel_id)
+                VALUES (%s, false, %s) RETURNING id
+            """, (show, channel_id))
+            canonical_show_id = cur.fetchone()[0]
+            cur.execute("""
+                INSERT INTO show (name, canonical_show_id, channel_id)
+                VALUES (%s, %s, %s) RETURNING id
+            """, (show, canonical_show_id, channel_id))
+            self.show_ids[key] = cur.fetchone()[0]
+        return self.show_ids[key]
+
+    def get_identity_ids(self, names: List[str]) -> Dict[str, int]:
+        """Returns the ids of identities by name, after inserting the missing
+        ones among names in one query"""
+        new_names = [x for x in dict.fromkeys(names)
+                     if x not in self.identity_ids]
+        if new_names:
+            for name in new_names:
+                print('Creating identity:', {'name': name})
+            cur = get_cursor(self.session)
+            cur.execute("""
+                INSERT INTO identity (name, is_ignore)
+                SELECT unnest(%s), false RETURNING name, id
+            """, (new_names,))
+            self.identity_ids.update(cur.fetchall())
+        return self.identity_ids
+
+
+def read_bytes(fpath: str) -> bytes:
+    with open(fpath, 'rb') as fp:
+        return fp.read()
+
+
+# Returns the original AWS identities and, for the faces without one, the
+# propagated identity with the most votes (the number of faces with the
+# original identity), as (orig_face_id, lower_name, score) lists
+def resolve_identities(base_entries: list, prop_entries: list
+                       ) -> Tuple[list, list]:
+    identities = []
+    base_face_ids = set()
+    name_to_count = Counter()
+    for orig_face_id, name, score in base_entries:
+        assert orig_face_id not in base_face_ids
+        base_face_ids.add(orig_face_id)
+        lower_name = name.lower()
+        name_to_count[lower_name] += 1
+        identities.append((orig_face_id, lower_name, score))
+
+    # Collect conflicting votes
+    orig_face_id_to_entries = {}
+    for orig_face_id, name, score in prop_entries:
+        if orig_face_id in base_face_ids:
+            continue
+        lower_name = name.lower()
+        lower_name_count = name_to_count[lower_name]
+        if (
+            not orig_face_id in orig_face_id_to_entries
+            or orig_face_id_to_entries[orig_face_id][-1] < lower_name_count
+        ):
+            orig_face_id_to_entries[orig_face_id] = (
+                lower_name, score, lower_name_count)
+
+    prop_identities = [
+        (orig_face_id, lower_name, score) for orig_face_id, (lower_name, score, _)
+        in sorted(orig_face_id_to_entries.items())]
+    return identities, prop_identities
+
+
+# Parse and check the pipeline outputs of a video, given a function that
+# returns the contents of one of its files. This does not touch the database,
+# so it can run in a worker process (see main).
+def parse_video_data(video_name: str, read_file: Callable[[str], bytes]
+                     ) -> VideoData:
+    def load(name):
+        return json.loads(read_file(name))
+
+    genders = load('genders.json')
+    for _, gender, score in genders:
+        assert score >= 0.5 and score <= 1., \
+            'Score has an invalid range: {}'.format(score)
+        if gender not in ('M', 'F'):
+            raise Exception('Unknown gender: {}'.format(gender))
+
+    commercials = load('commercials.json')
+    for start_frame, end_frame in commercials:
+        assert start_frame < end_frame, \
+            'Invalid commercial: {} - {}'.format(start_frame, end_frame)
+
+    identities, prop_identities = resolve_identities(
+        load('identities.json'), load('identities_propogated.json'))
+
+    orig_face_id_to_emb = {
+        orig_face_id: emb for orig_face_id, emb in load('embeddings.json')}
+    for emb in orig_face_id_to_emb.values():
+        assert len(emb) == EMBEDDING_DIM, \
+            'Incorrect embedding dim: {} != {}'.format(len(emb), EMBEDDING_DIM)
+
+    return VideoData(
+        name=video_name,
+        metadata=load('metadata.json'),
+        faces=load('bboxes.json'),
+        genders=genders,
+        identities=identities,
+        prop_identities=prop_identities,
+        commercials=commercials,
+        emb_face_ids=np.array(list(orig_face_id_to_emb), dtype=np.int64),
+        embs=np.array(list(orig_face_id_to_emb.values()), dtype=np.float32),
+        captions=read_file('captions.srt'),
+        orig_captions=read_file('captions_orig.srt'))
+
+
+def load_video_data(video_path: str, video_name: str) -> VideoData:
+    return parse_video_data(
+        video_name, lambda name: read_bytes(os.path.join(video_path, name)))
+
+
+TAR_GZ_EXT = '.tar.gz'
+TAR_ZST_EXT = '.tar.zst'
+ARCHIVE_EXTS = [TAR_GZ_EXT, TAR_ZST_EXT]
+
+
+# Open an archive as a stream of members. zstd archives are decompressed by
+# the zstd command.
+@contextmanager
+def open_archive(archive_path: str):
+    if not archive_path.endswith(TAR_ZST_EXT):
+        with tarfile.open(archive_path, mode='r|gz') as tar:
+            yield tar
+        return
+
+    cmd = ['zstd', '-dcq', archive_path]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            yield tar
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+# Read the pipeline outputs of a video from an archive of its directory, in
+# one pass over the archive, without extracting it to disk
+def load_archived_video_data(archive_path: str, video_name: str) -> VideoData:
+    files = {}
+    with open_archive(archive_path) as tar:
+        for member in tar:
+            if member.isfile():
+                files[os.path.basename(member.name)] = \
+                    tar.extractfile(member).read()
+
+    def read_file(name):
+        assert name in files, '{} is not in {}'.format(name, archive_path)
+        return files[name]
+    return parse_video_data(video_name, read_file)
 
 
 def get_import_context(
@@ -102,260 +333,236 @@ def get_import_context(
         aws_identity_labeler=aws_identity_labeler_object,
         aws_prop_identity_labeler=aws_prop_identity_labeler_object,
         male_gender=male_gender_object,
-        female_gender=female_gender_object)
+        female_gender=female_gender_object,
+        resolved_labelers=get_resolved_labelers(session),
+        dimensions=DimensionCache(session))
 
 
-def import_video(session, video_path: str,
-                 video_name: str):
-    meta_path = os.path.join(video_path, 'metadata.json')
-    meta_dict = load_json(meta_path)
+def import_video(session, import_context: ImportContext,
+                 video_data: VideoData) -> int:
+    meta_dict = video_data.metadata
 
-    channel, show, timestamp = parse_video_name(video_name)
-    show_object = get_or_create_show(session, channel, show)
+    channel, show, timestamp = parse_video_name(video_data.name)
+    show_id = import_context.dimensions.get_show_id(channel, show)
 
-    video_object = schema.Video(
-        name=video_name,
-        extension='.mp4',
-        num_frames=meta_dict['frames'],
-        fps=meta_dict['fps'],
-        width=meta_dict['width'],
-        height=meta_dict['height'],
-        time=timestamp,
-        show_id=show_object.id,
-        is_duplicate=False,
-        is_corrupt=False)
-    session.add(video_object)
-    session.flush() # need video id
-    return video_object
+    cur = get_cursor(session)
+    cur.execute("""
+        INSERT INTO video (name, extension, num_frames, fps, width, height,
+                           time, show_id, is_duplicate, is_corrupt)
+        VALUES (%s, '.mp4', %s, %s, %s, %s, %s, %s, false, false)
+        RETURNING id
+    """, (video_data.name, meta_dict['frames'], meta_dict['fps'],
+          meta_dict['width'], meta_dict['height'], timestamp, show_id))
+    video_id = cur.fetchone()[0]
+    import_context.dimensions.video_ids[video_data.name] = video_id
+    return video_id
 
 
 def import_commercials(
-    session, import_context: ImportContext, video_path: str,
-    video_object: schema.Video
+    session, import_context: ImportContext, video_data: VideoData,
+    video_id: int
 ):
-    commercial_file = os.path.join(video_path, 'commercials.json')
-    for start_frame, end_frame in load_json(commercial_file):
-        assert start_frame < end_frame, \
-            'Invalid commercial: {} - {}'.format(start_frame, end_frame)
-        commercial_object = schema.Commercial(
-            labeler_id=import_context.commercial_labeler.id,
-            max_frame=end_frame, min_frame=start_frame,
-            video_id=video_object.id)
-        session.add(commercial_object)
+    copy_rows(get_cursor(session), 'commercial',
+              ['labeler_id', 'max_frame', 'min_frame', 'video_id'], (
+        (import_context.commercial_labeler.id, end_frame, start_frame,
+         video_id)
+        for start_frame, end_frame in video_data.commercials))
 
 
 def import_faces(
-    session, import_context: ImportContext, video_path: str,
-    video_object: schema.Video
+    session, import_context: ImportContext, video_data: VideoData,
+    video_id: int
 ) -> Dict[int, int]:
-    bbox_file = os.path.join(video_path, 'bboxes.json')
-    face_id_map = {}
-    frame_objects = {}
-    for orig_face_id, face_meta in load_json(bbox_file):
-        frame_num = face_meta['frame_num']
-
-        frame_object = frame_objects.get(frame_num)
-        if frame_object is None:
-            frame_object = schema.Frame(
-                number=frame_num,
-                video_id=video_object.id,
-                sampler_id=import_context.frame_sampler.id)
-            session.add(frame_object)
-            session.flush() # Need frame ids
-            frame_objects[frame_num] = frame_object
-
-        face_object = schema.Face(
-            bbox_x1=face_meta['bbox']['x1'],
-            bbox_x2=face_meta['bbox']['x2'],
-            bbox_y1=face_meta['bbox']['y1'],
-            bbox_y2=face_meta['bbox']['y2'],
-            labeler_id=import_context.face_labeler.id,
-            score=face_meta['bbox']['score'],
-            frame_id=frame_object.id)
-        session.add(face_object)
-        session.flush() # Need face ids
-
-        face_id_map[orig_face_id] = face_object.id
-    assert len(set(face_id_map.values())) == len(face_id_map)
-    return face_id_map
+    faces = video_data.faces
+    cur = get_cursor(session)
+
+    # In order of first appearance
+    frame_nums = list(dict.fromkeys(
+        face_meta['frame_num'] for _, face_meta in faces))
+    frame_ids = dict(zip(frame_nums, reserve_ids(cur, 'frame', len(frame_nums))))
+    face_ids = reserve_ids(cur, 'face', len(faces))
+
+    copy_rows(cur, 'frame', ['id', 'number', 'video_id', 'sampler_id'], (
+        (frame_ids[frame_num], frame_num, video_id,
+         import_context.frame_sampler.id)
+        for frame_num in frame_nums))
+    copy_rows(cur, 'face', ['id', 'bbox_x1', 'bbox_x2', 'bbox_y1', 'bbox_y2',
+                            'labeler_id', 'score', 'frame_id'], (
+        (face_id, face_meta['bbox']['x1'], face_meta['bbox']['x2'],
+         face_meta['bbox']['y1'], face_meta['bbox']['y2'],
+         import_context.face_labeler.id, face_meta['bbox']['score'],
+         frame_ids[face_meta['frame_num']])
+        for face_id, (_, face_meta) in zip(face_ids, faces)))
+
+    return {orig_face_id: face_id
+            for face_id, (orig_face_id, _) in zip(face_ids, faces)}
 
 
 def import_face_genders(
-    session, import_context: ImportContext, video_path: str,
+    session, import_context: ImportContext, video_data: VideoData,
     face_id_map: Dict[int, int]
 ):
-    gender_file = os.path.join(video_path, 'genders.json')
-    for orig_face_id, gender, score in load_json(gender_file):
-        assert score >= 0.5 and score <= 1., \
-            'Score has an invalid range: {}'.format(score)
+    gender_ids = {'M': import_context.male_gender.id,
+                  'F': import_context.female_gender.id}
+    rows = []
+    for orig_face_id, gender, score in video_data.genders:
+        rows.append((face_id_map[orig_face_id], gender_ids[gender],
+                     import_context.gender_labeler.id, score))
+    copy_rows(get_cursor(session), 'face_gender',
+              ['face_id', 'gender_id', 'labeler_id', 'score'], rows)
 
-        face_id = face_id_map[orig_face_id]
-        if gender == 'M':
-            gender_id = import_context.male_gender.id
-        elif gender == 'F':
-            gender_id = import_context.female_gender.id
-        else:
-            raise Exception('Unknown gender: {}'.format(gender))
 
-        face_gender_object = schema.FaceGender(
-            face_id=face_id, gender_id=gender_id,
-            labeler_id=import_context.gender_labeler.id,
-            score=score)
-        session.add(face_gender_object)
+def import_face_identities(
+    session, import_context: ImportContext, video_data: VideoData,
+    face_id_map: Dict[int, int]
+):
+    labeled_identities = [
+        (import_context.aws_identity_labeler, video_data.identities),
+        (import_context.aws_prop_identity_labeler, video_data.prop_identities)
+    ]
+    identity_ids = import_context.dimensions.get_identity_ids([
+        lower_name for _, identities in labeled_identities
+        for _, lower_name, _ in identities])
+    rows = []
+    for labeler, identities in labeled_identities:
+        for orig_face_id, lower_name, score in identities:
+            rows.append((face_id_map[orig_face_id], labeler.id, score,
+                         identity_ids[lower_name]))
+    copy_rows(get_cursor(session), 'face_identity',
+              ['face_id', 'labeler_id', 'score', 'identity_id'], rows)
+
+
+# Returns the embeddings of a video by face id, sorted
+def get_embeddings(video_data: VideoData, face_id_map: Dict[int, int]
+                   ) -> Tuple[np.ndarray, np.ndarray]:
+    ids = np.array([face_id_map[x] for x in video_data.emb_face_ids.tolist()],
+                   dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    return ids[order], video_data.embs[order]
+
+
+def save_embeddings(emb_path: str, ids: np.ndarray, data: np.ndarray):
+    np.savez_compressed(emb_path, ids=ids, data=data)
+
+
+def save_captions(import_context, video_data: VideoData):
+    for caption_path, captions in [
+        (import_context.align_caption_path, video_data.captions),
+        (import_context.orig_caption_path, video_data.orig_captions)
+    ]:
+        with open(os.path.join(
+                caption_path, '{}.srt'.format(video_data.name)), 'wb') as fp:
+            fp.write(captions)
+
+
+# Write a video to the database, unless it is already there. Returns the
+# arguments of save_embeddings for it, or None if it was skipped.
+def write_video(
+    session, import_context: ImportContext, video_data: VideoData,
+    import_existing_videos: bool
+):
+    video_id = import_context.dimensions.video_ids.get(video_data.name)
+    if video_id is not None:
+        if not import_existing_videos:
+            print('Video: {} is already in the database'.format(
+                video_data.name))
+            return None
+    else:
+        print('Importing video: {}'.format(video_data.name))
+        video_id = import_video(session, import_context, video_data)
 
+    face_id_map = import_faces(session, import_context, video_data, video_id)
+    import_face_genders(session, import_context, video_data, face_id_map)
+    import_face_identities(session, import_context, video_data, face_id_map)
+    import_commercials(session, import_context, video_data, video_id)
+    session.flush()
+    update_resolved_labels(session, import_context.resolved_labelers,
+                           list(face_id_map.values()))
 
-@lru_cache(1024)
-def get_or_create_identity(session, **kwargs):
-    instance = session.query(schema.Identity).filter_by(**kwargs).first()
-    if not instance:
-        print('Creating identity:', kwargs)
-        instance = schema.Identity(is_ignore=False, **kwargs)
-        session.add(instance)
-        # This flush is necessary in order to populate the primary key
-        session.flush()
-    return instance
+    save_captions(import_context, video_data)
+    emb_path = os.path.join(
+        import_context.face_emb_path, '{}.npz'.format(video_data.name))
+    return (emb_path, *get_embeddings(video_data, face_id_map))
 
 
-def import_face_identities(
-    session, import_context: ImportContext, video_path: str,
-    face_id_map: Dict[int, int]
+def process_video(
+    session, import_context: ImportContext, video_path: str, video_name: str,
+    import_existing_videos: bool
 ):
-    base_identity_file = os.path.join(video_path, 'identities.json')
-    prop_identity_file = os.path.join(video_path, 'identities_propogated.json')
+    video_data = load_video_data(video_path, video_name)
+    embeddings = write_video(session, import_context, video_data,
+                             import_existing_videos)
+    if embeddings is not None:
+        save_embeddings(*embeddings)
 
-    # Add the original AWS identities
-    base_face_ids = set()
-    name_to_count = Counter()
-    for orig_face_id, name, score in load_json(base_identity_file):
-        assert orig_face_id not in base_face_ids
-        base_face_ids.add(orig_face_id)
-        face_id = face_id_map[orig_face_id]
-        lower_name = name.lower()
-        name_to_count[lower_name] += 1
-        identity_object = get_or_create_identity(session, name=lower_name)
-        face_identity_object = schema.FaceIdentity(
-            face_id=face_id, labeler_id=import_context.aws_identity_labeler.id,
-            score=score, identity_id=identity_object.id)
-        session.add(face_identity_object)
 
-    # Collect conflicting votes
-    orig_face_id_to_entries = {}
-    for orig_face_id, name, score in load_json(prop_identity_file):
-        if orig_face_id in base_face_ids:
-            continue
-        lower_name = name.lower()
-        lower_name_count = name_to_count[lower_name]
-        if (
-            not orig_face_id in orig_face_id_to_entries
-            or orig_face_id_to_entries[orig_face_id][-1] < lower_name_count
-        ):
-            orig_face_id_to_entries[orig_face_id] = (
-                lower_name, score, lower_name_count)
+def get_video_name(entry: str) -> str:
+    for ext in ARCHIVE_EXTS:
+        if entry.endswith(ext):
+            return entry[:-len(ext)]
+    return entry
 
-    # Add the propagated AWS identities
-    for orig_face_id, (lower_name, score, _) in sorted(orig_face_id_to_entries.items()):
-        face_id = face_id_map[orig_face_id]
-        identity_object = get_or_create_identity(session, name=lower_name)
-        face_identity_object = schema.FaceIdentity(
-            face_id=face_id,
-            labeler_id=import_context.aws_prop_identity_labeler.id,
-            score=score, identity_id=identity_object.id)
-        session.add(face_identity_object)
-
-
-def save_embeddings(import_context, video_path, video_name, face_id_map):
-    emb_file = os.path.join(video_path, 'embeddings.json')
-    face_id_to_emb = {
-        face_id_map[orig_face_id]: emb
-        for orig_face_id, emb in load_json(emb_file)
-    }
-    for emb in face_id_to_emb.values():
-        assert len(emb) == EMBEDDING_DIM, \
-            'Incorrect embedding dim: {} != {}'.format(len(emb), EMBEDDING_DIM)
 
-    emb_path = os.path.join(
-        import_context.face_emb_path, '{}.npz'.format(video_name))
-    sorted_ids = list(sorted(face_id_to_emb))
-    np.savez_compressed(
-        emb_path, ids=np.array(sorted_ids, dtype=np.int64),
-        data=np.array([face_id_to_emb[i] for i in sorted_ids],
-                      dtype=np.float32))
-
-
-def save_captions(import_context, video_path, video_name):
-    align_caption_out_path = os.path.join(
-        import_context.align_caption_path, '{}.srt'.format(video_name))
-    align_caption_path = os.path.join(video_path, 'captions.srt')
-    shutil.copyfile(align_caption_path, align_caption_out_path)
-
-    orig_caption_out_path = os.path.join(
-        import_context.orig_caption_path, '{}.srt'.format(video_name))
-    orig_caption_path = os.path.join(video_path, 'captions_orig.srt')
-    shutil.copyfile(orig_caption_path, orig_caption_out_path)
-
-
-@lru_cache(1024)
-def get_or_create_show(session, channel: str, show: str):
-    channel_object = session.query(schema.Channel).filter_by(
-        name=channel
-    ).one()
-    assert channel_object, 'Unknown channel: {}'.format(channel)
+# Read the pipeline outputs of an entry of the import path: a directory or a
+# .tar.gz or .tar.zst archive of one. Returns None if it is neither.
+def load_pipeline_output(import_path: str, entry: str) -> Optional[VideoData]:
+    for ext in ARCHIVE_EXTS:
+        if entry.endswith(ext):
+            return load_archived_video_data(
+                os.path.join(import_path, entry), entry[:-len(ext)])
 
-    show_object = session.query(schema.Show).filter_by(
-        channel_id=channel_object.id, name=show
-    ).first()
-    if show_object:
-        return show_object
-    else:
-        canonical_show_object = schema.CanonicalShow(
-            name=show, is_recurring=False, channel_id=channel_object.id)
-        session.add(canonical_show_object)
-        session.flush() # need canonical show id
+    video_path = os.path.join(import_path, entry)
+    if not os.path.isdir(video_path):
+        print('{} is not a directory'.format(video_path))
+        return None
+    return load_video_data(video_path, entry)
 
-        show_object = schema.Show(
-            name=show, canonical_show_id=canonical_show_object.id,
-            channel_id=channel_object.id)
-        session.add(show_object)
-        session.flush() # need show id
-        return show_object
 
+# Run fn on each of args in pool, yielding the results in order, with at most
+# max_pending results buffered ahead of the consumer
+def imap_bounded(pool, fn, args, max_pending):
+    pending = deque()
+    for x in args:
+        pending.append(pool.apply_async(fn, x))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
-TAR_GZ_EXT = '.tar.gz'
 
+# Videos buffered per worker, ahead of the database writer
+PARSE_QUEUE_SIZE = 2
 
-def process_video(
-    session, import_context: ImportContext, video_path: str, video_name: str,
-    import_existing_videos: bool
-):
-    video_object = session.query(schema.Video).filter_by(
-        name=video_name
-    ).first()
-    if video_object:
-        if not import_existing_videos:
-            print('Video: {} is already in the database'.format(video_name))
-            return
-    else:
-        print('Importing video: {}'.format(video_name))
-        video_object = import_video(session, video_path, video_name)
-
-    face_id_map = import_faces(session, import_context, video_path,
-                               video_object)
-    import_face_genders(session, import_context, video_path, face_id_map)
-    import_face_identities(session, import_context, video_path, face_id_map)
-    import_commercials(session, import_context, video_path, video_object)
-    session.flush()
 
-    save_embeddings(import_context, video_path, video_name, face_id_map)
-    save_captions(import_context, video_path, video_name)
+# The videos of an import path committed by its last import
+def get_journal(session, import_path: str) -> Set[str]:
+    cur = get_cursor(session)
+    cur.execute('SELECT video_name FROM import_journal WHERE import_path = %s',
+                (import_path,))
+    return {x[0] for x in cur.fetchall()}
 
 
-# Note: do not make this multiprocessed, it will prevent the transactional
-# commit structure
-def main(import_path, face_emb_path, align_caption_path, orig_caption_path,
-         tmp_data_dir, import_existing_videos, db_name, db_user):
-    password = os.getenv('POSTGRES_PASSWORD')
-    session = get_db_session(db_user, password, db_name)
+def clear_journal(session, import_path: str):
+    get_cursor(session).execute(
+        'DELETE FROM import_journal WHERE import_path = %s', (import_path,))
+
 
+def add_to_journal(session, import_path: str, video_names: List[str]):
+    get_cursor(session).execute("""
+        INSERT INTO import_journal (import_path, video_name)
+        SELECT %s, unnest(%s)
+    """, (import_path, video_names))
+
+
+# Videos are imported in a single transaction, or in one per --commit-every
+# videos, so the database is only written to by this process. The videos of
+# each transaction are added to the journal (see schema.ImportJournal) in
+# that transaction, so that --resume skips exactly the committed ones. With
+# --workers, the pipeline outputs are read and parsed, and the embeddings
+# compressed, by a pool of workers.
+def main(import_path, face_emb_path, align_caption_path, orig_caption_path,
+         import_existing_videos, workers, commit_every, resume, db_name,
+         db_user):
     assert os.path.isdir(face_emb_path), \
         'Face emb path does not exist! {}'.format(face_emb_path)
     assert os.path.isdir(align_caption_path), \
@@ -363,26 +570,76 @@ def main(import_path, face_emb_path, align_caption_path, orig_caption_path,
     assert os.path.isdir(orig_caption_path), \
         'Raw caption path does not exist! {}'.format(orig_caption_path)
 
+    # Before connecting, so that the workers do not inherit the connection
+    pool = Pool(workers) if workers > 1 else None
+
+    password = os.getenv('POSTGRES_PASSWORD')
+    session = get_db_session(db_user, password, db_name)
     import_context = get_import_context(
         session, face_emb_path, align_caption_path, orig_caption_path)
-    for video_name in tqdm(sorted(os.listdir(import_path))):
-        if video_name.endswith(TAR_GZ_EXT):
-            archive_path = os.path.join(import_path, video_name)
-            os.makedirs(tmp_data_dir, exist_ok=True)
-            subprocess.check_call(['tar', '-xzf', archive_path, '-C', tmp_data_dir])
-            video_name = video_name[:-len(TAR_GZ_EXT)]
-            video_path = os.path.join(tmp_data_dir, video_name)
-            process_video(session, import_context, video_path,
-                          video_name, import_existing_videos)
-            shutil.rmtree(video_path)
-        else:
-            video_path = os.path.join(import_path, video_name)
-            if not os.path.isdir(video_path):
-                print('{} is not a directory'.format(video_path))
+    schema.Base.metadata.create_all(
+        session.get_bind(), tables=[schema.ImportJournal.__table__])
+
+    entries = sorted(os.listdir(import_path))
+    journal_path = os.path.abspath(import_path)
+    if resume:
+        committed_names = get_journal(session, journal_path)
+        print('Resuming: {} videos were committed'.format(len(committed_names)))
+        entries = [x for x in entries
+                   if get_video_name(x) not in committed_names]
+    else:
+        clear_journal(session, journal_path)
+        session.commit()
+    if not import_existing_videos:
+        # Videos already in the database are skipped before they are read
+        new_entries = []
+        for entry in entries:
+            video_name = get_video_name(entry)
+            if video_name in import_context.dimensions.video_ids:
+                print('Video: {} is already in the database'.format(video_name))
+            else:
+                new_entries.append(entry)
+        entries = new_entries
+    load_args = [(import_path, x) for x in entries]
+    if pool is not None:
+        video_datas = imap_bounded(pool, load_pipeline_output, load_args,
+                                   PARSE_QUEUE_SIZE * workers)
+    else:
+        video_datas = (load_pipeline_output(*x) for x in load_args)
+
+    batch = []
+    embedding_saves = []
+
+    def commit_batch():
+        # The embeddings are saved before their faces are committed
+        for x in embedding_saves:
+            x.get()
+        embedding_saves.clear()
+        if batch:
+            add_to_journal(session, journal_path, batch)
+        session.commit()
+        batch.clear()
+
+    try:
+        for video_data in tqdm(video_datas, total=len(entries)):
+            if video_data is None:
+                continue
+            embeddings = write_video(session, import_context, video_data,
+                                     import_existing_videos)
+            if embeddings is None:
                 continue
-            process_video(session, import_context, video_path, video_name,
-                          import_existing_videos)
-    session.commit()
+            if pool is not None:
+                embedding_saves.append(
+                    pool.apply_async(save_embeddings, embeddings))
+            else:
+                save_embeddings(*embeddings)
+            batch.append(video_data.name)
+            if commit_every is not None and len(batch) >= commit_every:
+                commit_batch()
+        commit_batch()
+    finally:
+        if pool is not None:
+            pool.terminate()
     print('Done!')
 
 
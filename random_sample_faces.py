@@ -4,7 +4,7 @@ import os
 import argparse
 import json
 import time
-import sqlalchemy
+from datetime import datetime
 from sqlalchemy.sql.expression import func
 
 import util
@@ -54,7 +54,9 @@ def main(out_file, n, no_random, year, channel, video, db_name, db_user):
         schema.Face).join(schema.Frame).join(schema.Video)
     if year is not None:
         sample_query = sample_query.filter(
-            sqlalchemy.extract('year', schema.Video.time) == year)
+            schema.Video.time >= datetime(year, 1, 1)
+        ).filter(
+            schema.Video.time < datetime(year + 1, 1, 1))
     if video is not None:
         sample_query = sample_query.filter(schema.Video.name == video)
     if channel is not None:
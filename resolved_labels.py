@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Maintain the face_best_identity and face_resolved_gender tables, which hold
+the identity and gender that the export uses for each face:
+
+face_best_identity: the most confident rekognition identity (including
+    propagated and backfilled labels) for each face
+face_resolved_gender: the gender for each face, with manual labels taking
+    precedence over knn labels
+
+pipeline_import.py and backfill_identities_with_knn.py update these for the
+faces they label. Run this script to rebuild both tables from scratch, e.g.,
+after labels were changed by other means.
+"""
+
+import argparse
+import os
+import time
+from typing import List, NamedTuple
+from sqlalchemy import text
+
+import schema
+from util import get_db_session
+
+
+class ResolvedLabelers(NamedTuple):
+    identity_labeler_ids: List[int]
+    manual_gender_labeler_id: int
+    knn_gender_labeler_id: int
+
+
+def get_resolved_labelers(session) -> ResolvedLabelers:
+    identity_labelers = session.query(schema.Labeler).filter(
+        schema.Labeler.name.in_([
+            'face-identity-rekognition',
+            'face-identity-rekognition:augmented-l2-dist=0.7'
+        ]) | schema.Labeler.name.like('face-identity-rekognition:backfill-%')
+    ).all()
+    manual_gender_labeler = session.query(schema.Labeler).filter_by(
+        name='handlabeled-gender'
+    ).one()
+    knn_gender_labeler = session.query(schema.Labeler).filter_by(
+        name='knn-gender'
+    ).one()
+    return ResolvedLabelers(
+        identity_labeler_ids=sorted(x.id for x in identity_labelers),
+        manual_gender_labeler_id=manual_gender_labeler.id,
+        knn_gender_labeler_id=knn_gender_labeler.id)
+
+
+# Ties are broken arbitrarily, and faces whose scores are all NULL get no
+# identity.
+BEST_IDENTITY_SQL = """
+    INSERT INTO face_best_identity (face_id, identity_id, score)
+    SELECT DISTINCT ON (face_id) face_id, identity_id, score
+    FROM face_identity
+    WHERE labeler_id IN ({identities}) AND score IS NOT NULL{face_filter}
+    ORDER BY face_id, score DESC
+"""
+
+RESOLVED_GENDER_SQL = """
+    INSERT INTO face_resolved_gender (face_id, gender_id, score)
+    SELECT DISTINCT ON (face_id) face_id, gender_id, score
+    FROM face_gender
+    WHERE labeler_id IN ({manual_gender}, {knn_gender}){face_filter}
+    ORDER BY face_id, labeler_id = {manual_gender} DESC
+"""
+
+
+def format_resolved_label_sql(sql, labelers: ResolvedLabelers, face_filter):
+    return sql.format(
+        identities=','.join(str(x) for x in labelers.identity_labeler_ids),
+        manual_gender=labelers.manual_gender_labeler_id,
+        knn_gender=labelers.knn_gender_labeler_id,
+        face_filter=face_filter)
+
+
+# Recompute the resolved labels for the given faces. This must be called after
+# their face_identity and face_gender rows are flushed, in the same transaction.
+def update_resolved_labels(session, labelers: ResolvedLabelers,
+                           face_ids: List[int]):
+    if len(face_ids) == 0:
+        return
+    params = {'face_ids': list(face_ids)}
+    face_filter = ' AND face_id = ANY(:face_ids)'
+    session.execute(text(
+        'DELETE FROM face_best_identity WHERE face_id = ANY(:face_ids)'
+    ), params)
+    session.execute(text(
+        'DELETE FROM face_resolved_gender WHERE face_id = ANY(:face_ids)'
+    ), params)
+    session.execute(text(format_resolved_label_sql(
+        BEST_IDENTITY_SQL, labelers, face_filter)), params)
+    session.execute(text(format_resolved_label_sql(
+        RESOLVED_GENDER_SQL, labelers, face_filter)), params)
+
+
+def rebuild_resolved_labels(session, labelers: ResolvedLabelers):
+    start_time = time.time()
+    print('Rebuilding face_best_identity')
+    session.execute(text('TRUNCATE face_best_identity'))
+    session.execute(text(format_resolved_label_sql(
+        BEST_IDENTITY_SQL, labelers, '')))
+    print('Rebuilding face_resolved_gender')
+    session.execute(text('TRUNCATE face_resolved_gender'))
+    session.execute(text(format_resolved_label_sql(
+        RESOLVED_GENDER_SQL, labelers, '')))
+    print('Rebuilt resolved labels in {:.3f} seconds'.format(
+        time.time() - start_time))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-name', type=str, default='tvnews')
+    parser.add_argument('--db-user', type=str, default='admin')
+    return parser.parse_args()
+
+
+def main(db_name, db_user):
+    password = os.getenv('POSTGRES_PASSWORD')
+    session = get_db_session(db_user, password, db_name)
+
+    schema.Base.metadata.create_all(session.get_bind(), tables=[
+        schema.FaceBestIdentity.__table__,
+        schema.FaceResolvedGender.__table__])
+
+    rebuild_resolved_labels(session, get_resolved_labelers(session))
+    session.commit()
+    print('Done!')
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
@@ -41,6 +41,12 @@ class Video(Base):
     is_duplicate = Column(Boolean, nullable=False)
     is_corrupt = Column(Boolean, nullable=False)
 
+    __table_args__ = (
+        # Almost every query skips corrupt and duplicate videos
+        Index('ix_video_time_valid', time,
+              postgresql_where=text('NOT is_corrupt AND NOT is_duplicate')),
+    )
+
 class FrameSampler(Base):
     __tablename__ = 'frame_sampler'
     id = Column(Integer, primary_key=True)
@@ -53,6 +59,10 @@ class Frame(Base):
     video_id = Column(Integer, ForeignKey('video.id'), nullable=False, index=True)
     sampler_id = Column(Integer, ForeignKey('frame_sampler.id'))
 
+    __table_args__ = (
+        Index('ix_frame_video_id_sampler_id_number', video_id, sampler_id, number),
+    )
+
 class Labeler(Base):
     __tablename__ = 'labeler'
     id = Column(Integer, primary_key=True)
@@ -105,6 +115,10 @@ class Commercial(Base):
     min_frame = Column(Integer, nullable=False)
     video_id = Column(Integer, ForeignKey('video.id'), nullable=False, index=True)
 
+    __table_args__ = (
+        Index('ix_commercial_labeler_id_video_id', labeler_id, video_id),
+    )
+
 class ChannelHosts(Base):
     __tablename__ = 'channel_host'
     channel_id = Column(Integer, ForeignKey('channel.id'), primary_key=True)
@@ -114,3 +128,27 @@ class CanonicalShowHosts(Base):
     __tablename__ = 'canonical_show_host'
     canonical_show_id = Column(Integer, ForeignKey('canonical_show.id'), primary_key=True)
     identity_id = Column(Integer, ForeignKey('identity.id'), primary_key=True)
+
+# Derived from face_identity and face_gender, and maintained by
+# resolved_labels.py. These hold the labels that the export uses for each face.
+
+class FaceBestIdentity(Base):
+    __tablename__ = 'face_best_identity'
+    face_id = Column(Integer, ForeignKey('face.id'), primary_key=True)
+    identity_id = Column(Integer, ForeignKey('identity.id'), nullable=False, index=True)
+    score = Column(Float)
+
+class FaceResolvedGender(Base):
+    __tablename__ = 'face_resolved_gender'
+    face_id = Column(Integer, ForeignKey('face.id'), primary_key=True)
+    gender_id = Column(Integer, ForeignKey('gender.id'), nullable=False)
+    score = Column(Float)
+
+# Written by pipeline_import.py in the transaction of each batch of videos it
+# commits, so that an import that failed can be resumed (see --resume)
+
+class ImportJournal(Base):
+    __tablename__ = 'import_journal'
+    import_path = Column(String, primary_key=True)
+    video_name = Column(String, primary_key=True)
+    committed = Column(DateTime, server_default=func.now(), nullable=False)
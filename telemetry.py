@@ -0,0 +1,232 @@
+"""
+Structured metrics for the stages of export.py (see --metrics-file), saved as
+JSON lines so that runs can be compared, e.g., to catch regressions in the
+nightly export.
+
+Every stage (hosts, videos, commercials, faces, ...) writes one record with
+"event": "stage" when it ends, and long stages (the face export) also write
+"event": "sample" records every SAMPLE_INTERVAL seconds while they run. A
+record has:
+
+stage, time (unix), pid
+elapsed_s: wall time since the start of the stage
+cpu_s: user and system CPU time of the process and its finished children
+timers: seconds spent in named parts of the stage, e.g., db_wait (blocked on
+    the next row from the database) or write:<output> (encoding and writing
+    an output)
+other_s: elapsed_s minus the timers, which in the face export is the Python
+    loop that turns rows into intervals and bboxes. With export.py --workers
+    or --pipelined, the timers of the face stage add up the time of several
+    workers or threads, so this is left out.
+rows, rows_per_s: rows (e.g., faces) processed
+bytes: bytes written to each output
+open_files: file descriptors open in the process
+peak_rss_mb: peak resident memory of the process, or of its largest child
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Iterator
+
+
+SAMPLE_INTERVAL = 30
+
+
+def get_size(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+def get_cpu_time() -> float:
+    total = 0.
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def get_open_file_count():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class StageMetrics(object):
+    """
+    Counters for one stage. If telemetry is None, the counters are still
+    collected (e.g., in a worker process, to be merged by the parent) but no
+    records are written. A disabled StageMetrics does nothing at all, so code
+    can take one unconditionally.
+    """
+
+    def __init__(self, telemetry, stage: str, enabled: bool = True):
+        self.telemetry = telemetry
+        self.stage = stage
+        self.enabled = enabled
+        self.timers = defaultdict(float)
+        self.rows = 0
+        self.bytes = {}
+        self._start_time = time.time()
+        self._start_cpu_time = get_cpu_time()
+        self._last_sample_time = self._start_time
+        # Whether the timers add up time from several threads or processes
+        self._overlapping = False
+
+    @contextmanager
+    def _timer(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start_time
+
+    def timer(self, name: str):
+        """Context manager that adds the time spent in it to a timer"""
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name)
+
+    def timed_iter(self, iterator: Iterable, name: str = 'db_wait') -> Iterator:
+        """Wrap an iterator, adding the time spent waiting on it to a timer"""
+        if not self.enabled:
+            return iterator
+        return self._timed_iter(iter(iterator), name)
+
+    def _timed_iter(self, iterator: Iterator, name: str) -> Iterator:
+        timers = self.timers
+        perf_counter = time.perf_counter
+        while True:
+            start_time = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                timers[name] += perf_counter() - start_time
+            yield item
+
+    def set_overlapping(self) -> None:
+        """Note that the timers are updated from several threads"""
+        self._overlapping = True
+
+    def add_rows(self, n: int) -> None:
+        if self.enabled:
+            self.rows += n
+
+    def set_bytes(self, output: str, n: int) -> None:
+        if self.enabled:
+            self.bytes[output] = n
+
+    def get_counters(self) -> dict:
+        """The counters, to merge into another StageMetrics"""
+        return {'timers': dict(self.timers), 'rows': self.rows,
+                'bytes': dict(self.bytes)}
+
+    def merge(self, counters: dict) -> None:
+        if not self.enabled:
+            return
+        self._overlapping = True
+        for name, seconds in counters['timers'].items():
+            self.timers[name] += seconds
+        self.rows += counters['rows']
+        for output, n in counters['bytes'].items():
+            self.bytes[output] = self.bytes.get(output, 0) + n
+
+    def get_record(self, event: str) -> dict:
+        now = time.time()
+        elapsed = now - self._start_time
+        return {
+            'event': event,
+            'stage': self.stage,
+            'time': now,
+            'pid': os.getpid(),
+            'elapsed_s': elapsed,
+            'cpu_s': get_cpu_time() - self._start_cpu_time,
+            'timers': dict(self.timers),
+            'other_s': (None if self._overlapping
+                        else elapsed - sum(self.timers.values())),
+            'rows': self.rows,
+            'rows_per_s': self.rows / elapsed if elapsed > 0 else None,
+            'bytes': dict(self.bytes),
+            'open_files': get_open_file_count(),
+            'peak_rss_mb': get_peak_rss_mb(),
+        }
+
+    def sample_due(self) -> bool:
+        return (self.enabled and self.telemetry is not None
+                and time.time() - self._last_sample_time >= self.telemetry.sample_interval)
+
+    def sample(self) -> None:
+        """Write a sample record (call when sample_due)"""
+        self._last_sample_time = time.time()
+        self.telemetry.emit(self.get_record('sample'))
+
+
+NULL_METRICS = StageMetrics(None, None, enabled=False)
+
+
+class Telemetry(object):
+    """Writes the metrics of each stage to path, or nowhere if it is None"""
+
+    def __init__(self, path: str = None, sample_interval: float = SAMPLE_INTERVAL):
+        self.enabled = path is not None
+        self.sample_interval = sample_interval
+        self._fp = open(path, 'a') if path is not None else None
+        # Stages can run in threads
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'Telemetry':
+        return self
+
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def emit(self, record: dict) -> None:
+        if self._fp is not None:
+            with self._lock:
+                self._fp.write(json.dumps(record) + '\n')
+                self._fp.flush()
+
+    def start_stage(self, stage: str) -> StageMetrics:
+        if not self.enabled:
+            return NULL_METRICS
+        return StageMetrics(self, stage)
+
+    def end_stage(self, metrics: StageMetrics,
+                  outputs: Dict[str, str] = None) -> None:
+        """Write the record of a stage. The size of the files (or
+        directories) in outputs is added to the bytes of the stage, unless
+        already counted."""
+        if not metrics.enabled:
+            return
+        for output, path in (outputs or {}).items():
+            if output not in metrics.bytes:
+                metrics.bytes[output] = get_size(path)
+        self.emit(metrics.get_record('stage'))
+
+    @contextmanager
+    def stage(self, stage: str, outputs: Dict[str, str] = None):
+        metrics = self.start_stage(stage)
+        yield metrics
+        self.end_stage(metrics, outputs)
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,89 @@
+"""
+Tests of the face column batches in export.py: turning the rows of the cursor
+into columns (iter_face_batches) and splitting batches at the video
+boundaries (iter_video_columns).
+"""
+
+import os
+import random
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from export import (
+    FACE_COPY_COLUMNS, NULL_ID, iter_face_batches, iter_video_columns)
+
+
+class ListCursor(object):
+    """Stands in for a cursor over rows"""
+
+    def __init__(self, rows):
+        self._rows = list(rows)
+        self.closed = False
+
+    def fetchmany(self, size):
+        batch, self._rows = self._rows[:size], self._rows[size:]
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+def make_rows(rng, num_videos=20):
+    rows = []
+    face_id = 0
+    for video_id in range(1, num_videos + 1):
+        for _ in range(rng.randrange(1, 30)):
+            face_id += 1
+            has_identity = rng.random() < 0.5
+            rows.append((
+                face_id, video_id, 1, rng.randrange(100000),
+                rng.choice([None, 1, 2]), rng.choice([None, 0.5]),
+                rng.randrange(1, 100) if has_identity else None,
+                rng.random() if has_identity else None,
+                rng.random() < 0.1,
+                rng.random(), rng.random(), rng.random(), rng.random()))
+    return rows
+
+
+def test_iter_face_batches():
+    rows = [(1, 10, 1, 0, None, None, None, None, False, 0.1, 0.2, 0.3, 0.4),
+            (2, 10, 1, 1000, 3, 0.9, 7, 0.8, True, 0.5, 0.6, 0.7, 0.8)]
+    cur = ListCursor(rows)
+    batches = list(iter_face_batches(cur, batch_size=1))
+    assert cur.closed
+    assert len(batches) == 2
+    batch = batches[0]
+    assert set(batch) == {name for name, _ in FACE_COPY_COLUMNS}
+    assert batch['gender_id'].tolist() == [NULL_ID]
+    assert batch['identity_id'].tolist() == [NULL_ID]
+    assert np.isnan(batch['identity_score'][0])
+    assert batches[1]['identity_id'].tolist() == [7]
+    assert batches[1]['is_host'].tolist() == [True]
+
+
+def test_iter_video_columns_splits_at_videos():
+    rng = random.Random(0)
+    rows = make_rows(rng)
+    expected = {}
+    for row in rows:
+        expected.setdefault(row[1], []).append(row[0])
+
+    for batch_size in [1, 2, 7, 50, 1000]:
+        videos = list(iter_video_columns(
+            iter_face_batches(ListCursor(rows), batch_size=batch_size)))
+        assert [video_id for video_id, _ in videos] == sorted(expected)
+        for video_id, columns in videos:
+            assert columns['face_id'].tolist() == expected[video_id]
+            assert np.all(columns['video_id'] == video_id)
+            assert all(len(x) == len(columns['face_id'])
+                       for x in columns.values())
+
+
+def test_iter_video_columns_skips_empty_batches():
+    rows = make_rows(random.Random(1), num_videos=2)
+    empty = {name: np.zeros(0, dtype=np.dtype(dtype).newbyteorder('='))
+             for name, dtype in FACE_COPY_COLUMNS}
+    batches = ([empty] + list(iter_face_batches(ListCursor(rows), batch_size=5))
+               + [empty])
+    assert [video_id for video_id, _ in iter_video_columns(batches)] == [1, 2]
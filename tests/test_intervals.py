@@ -0,0 +1,125 @@
+"""
+Tests of the interval helpers in export.py (IntervalCoalescer and
+subtract_intervals), against brute-force models on a millisecond grid.
+"""
+
+import os
+import random
+import sys
+from collections import Counter, defaultdict
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from export import IntervalCoalescer, get_interval_list_dtype, subtract_intervals
+
+
+def make_intervals(tuples):
+    return np.array(sorted(tuples), dtype=get_interval_list_dtype(1))
+
+
+def get_total_time(intervals):
+    return int((intervals['end'].astype(np.int64) - intervals['start']).sum())
+
+
+def get_coverage(intervals):
+    """Milliseconds covered by each payload"""
+    coverage = defaultdict(set)
+    for start, end, payload in intervals.tolist():
+        coverage[payload].update(range(start, end))
+    return coverage
+
+
+# Disjoint intervals for each payload, separated by gaps of 1 to max_gap ms
+def random_disjoint_intervals(rng, num_payloads=3, max_gap=50):
+    tuples = []
+    for payload in range(num_payloads):
+        t = rng.randrange(100)
+        for _ in range(rng.randrange(1, 20)):
+            length = rng.randrange(1, 100)
+            tuples.append((t, t + length, payload))
+            t += length + rng.randrange(1, max_gap)
+    return tuples
+
+
+def test_coalesce_without_tolerance_keeps_coverage():
+    rng = random.Random(0)
+    coalescer = IntervalCoalescer(0)
+    for _ in range(300):
+        intervals = make_intervals(random_disjoint_intervals(rng))
+        result = coalescer._coalesce(intervals)
+        assert get_total_time(result) == get_total_time(intervals)
+        assert get_coverage(result) == get_coverage(intervals)
+
+
+def test_coalesce_merges_adjacent_intervals():
+    intervals = make_intervals([(0, 1000, 1), (1000, 2000, 1), (2000, 3000, 1),
+                                (1000, 2000, 2)])
+    result = IntervalCoalescer(0)._coalesce(intervals)
+    assert result.tolist() == [(0, 3000, 1), (1000, 2000, 2)]
+
+
+def test_coalesce_keeps_simultaneous_faces_apart():
+    # Two faces of the same person on screen at once, for two seconds
+    intervals = make_intervals([(0, 1000, 1), (0, 1000, 1),
+                                (1000, 2000, 1), (1000, 2000, 1)])
+    result = IntervalCoalescer(0)._coalesce(intervals)
+    assert result.tolist() == [(0, 2000, 1), (0, 2000, 1)]
+
+    rng = random.Random(1)
+    coalescer = IntervalCoalescer(0)
+    for _ in range(300):
+        # Layers of the same disjoint intervals
+        tuples = random_disjoint_intervals(rng)
+        layers = rng.randrange(1, 4)
+        intervals = make_intervals(tuples * layers)
+        result = coalescer._coalesce(intervals)
+        assert get_total_time(result) == get_total_time(intervals)
+        starts = Counter((x[0], x[2]) for x in result.tolist())
+        assert all(n % layers == 0 for n in starts.values())
+
+
+def test_coalesce_tolerance_only_fills_small_gaps():
+    rng = random.Random(2)
+    for tolerance in [0, 10, 25, 60]:
+        coalescer = IntervalCoalescer(tolerance)
+        for _ in range(200):
+            tuples = random_disjoint_intervals(rng, num_payloads=1)
+            intervals = make_intervals(tuples)
+
+            expected = []
+            for start, end, payload in sorted(tuples):
+                if expected and start - expected[-1][1] <= tolerance:
+                    expected[-1] = (expected[-1][0], end, payload)
+                else:
+                    expected.append((start, end, payload))
+            assert coalescer._coalesce(intervals).tolist() == expected
+
+
+def test_coalesce_counts_stats():
+    coalescer = IntervalCoalescer(0)
+    coalescer.coalesce(make_intervals([(0, 10, 1), (10, 20, 1)]), 'faces')
+    assert coalescer.stats['faces'] == [2, 1, 20, 20]
+
+
+def test_subtract_intervals():
+    rng = random.Random(3)
+    for _ in range(300):
+        intervals = make_intervals(
+            random_disjoint_intervals(rng, num_payloads=2, max_gap=20))
+        excluded = sorted(
+            (s, s + rng.randrange(1, 60))
+            for s in rng.sample(range(0, 1500, 60), rng.randrange(0, 8)))
+        excluded_starts = np.array([x[0] for x in excluded], dtype=np.uint32)
+        excluded_ends = np.array([x[1] for x in excluded], dtype=np.uint32)
+        result = subtract_intervals(intervals, excluded_starts, excluded_ends)
+
+        excluded_ms = set()
+        for start, end in excluded:
+            excluded_ms.update(range(start, end))
+        expected = {payload: ms - excluded_ms
+                    for payload, ms in get_coverage(intervals).items()}
+        coverage = get_coverage(result)
+        for payload in set(expected) | set(coverage):
+            assert coverage.get(payload, set()) == expected.get(payload, set())
+        assert np.all(result['end'] > result['start'])
+        assert np.all(np.diff(result['start'].astype(np.int64)) >= 0)